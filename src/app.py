@@ -1,5 +1,7 @@
+from startup import startup_step, startup_finished, get_boot_profile
+
 import dash
-from dash import Dash, html, dcc, Input, Output, callback, ctx, State, clientside_callback
+from dash import Dash, html, dcc, Input, Output, callback, ctx, State, clientside_callback, DiskcacheManager, Patch
 from dash.dash_table import DataTable, FormatTemplate
 from dash.dash_table.Format import Format, Scheme, Trim
 from dash.exceptions import PreventUpdate
@@ -8,18 +10,73 @@ import dash_bootstrap_components as dbc
 import plotly.graph_objects as go
 
 import collections
+import numpy as np
 import pandas as pd
+import flask
 import json
-import plotly.express as px
-import plotly.graph_objs as go
+from plotly.colors import make_colorscale
 import warnings
 import base64
+import functools
+# pandas loads numpy and pyarrow itself, and diskcache (~4 ms) is needed at boot by the background callback manager,
+# so importing them up front adds nothing measurable to a cold start; python startup.py shows where boot time goes.
+import pyarrow as pa
+import diskcache
+import hashlib
+import os
+import time
+import urllib.parse
+import zlib
+
+from workbooks import read_sheet, download_workbook
+from history import get_history, get_monthly_deltas, get_history_stamp
+from artifacts import read_artifact, get_artifact_sha1, get_state_data_versions, get_current_build_id
+from search import build_search_index, search, get_entry_label
+from geometry import get_geometry_url, find_geometry_asset
+
+startup_step('imports')
 
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
+# Slow loads run as background jobs in their own processes, with results kept on local disk, so gunicorn workers
+# stay free to answer other requests while a cold OneDrive download is in progress.
+background_callback_manager = DiskcacheManager(diskcache.Cache('../cache/background_callbacks'))
+
+# Parsed workbooks and geometry, shared by every worker on the host through diskcache's SQLite index, with a small
+# per-worker LRU of frames in front so hot ones skip unpickling. The LRU is capped in bytes, so each worker adds at
+# most that much RSS however many workers there are. Treat anything returned from here as read-only.
+frame_cache = diskcache.Cache('../cache/frames')
+frame_cache_expire_seconds = 10 * 60
+memory_cache = collections.OrderedDict()
+memory_cache_max_bytes = 32 * 1024 * 1024
+memory_cache_max_age_seconds = 60
+# precompute.py sets this so a build always reads the workbooks, and leaves the fresh frames for the workers.
+refresh_shared_cache = False
+
+# Per-town miles computed from ride files by rides.py; a state with a file here uses them instead of the workbook's.
+ride_coverage_dir = '../data/rides'
+# Per-town road miles computed from an OpenStreetMap extract by roads.py, used the same way for Total (mi)/25 Pct.
+road_miles_dir = '../data/roads'
+
+# Rows per block of a streamed CSV response from the /api routes.
+api_csv_chunk_rows = 1000
+
+# Most results the town search dropdown lists for one query.
+search_result_limit = 10
+
+# Simplification of the town outlines drawn while a county's full map loads; ~200 m, a few kilobytes a county.
+outline_tolerance_degrees = 0.002
+
+# How often open sessions ask whether a refresh published new data for their state.
+data_version_poll_seconds = 60
+
+# The /debug routes describe the server's internals, so they answer only with this set or Flask in debug mode.
+debug_routes = False
+
 app = Dash(__name__, suppress_callback_exceptions=True, external_stylesheets=[
-    dbc.themes.SPACELAB, dbc.icons.FONT_AWESOME])
+    dbc.themes.SPACELAB, dbc.icons.FONT_AWESOME], background_callback_manager=background_callback_manager)
 server = app.server
+startup_step('disk caches and Dash app')
 
 # app.config.supress_callback_exceptions = True
 
@@ -29,6 +86,34 @@ fixed = Format(precision=2, scheme=Scheme.fixed)
 max_50_pct_color_scale = ['white', 'gold', 'red']
 max_100_pct_color_scale = ['white', 'gold', 'orange', 'red']
 
+# customdata columns of each choropleth map type, in hover order.
+choropleth_hover_fields = {
+    'state': ['County', 'Actual Pct', 'Pct Towns Cycled'],
+    'county': ['County', 'Town', 'Actual Pct'],
+}
+# Dropdown values a click on a feature drills down to, embedded in layout.meta so map_clicked can run clientside.
+choropleth_drilldown_fields = {
+    'state': ['County'],
+    'county': ['County', 'Town'],
+}
+percent_hover_fields = ['Actual Pct', 'Pct Towns Cycled']
+
+# Column types of the compact summary and town frames; anything else numeric is left as it was read.
+name_fields = ['State', 'County', 'Town']
+integer_fields = ['geoid', 'pbpFIPS', 'OBJECTID', 'Total Towns']
+
+# Header names each kind of sheet is read by, as (wanted, required); wanted columns are read when a sheet has them.
+summary_sheet_columns = (['County', 'Total (mi)', '25 Pct', 'Actual Pct', 'Actual (mi)', 'Total Towns',
+                          'Pct Towns Cycled', 'geoid', 'OBJECTID'],
+                         ['County', 'Total (mi)', '25 Pct', 'Actual Pct', 'Actual (mi)', 'Total Towns',
+                          'Pct Towns Cycled'])
+county_sheet_columns = (['County', 'Town', 'Total (mi)', '25 Pct', 'Actual Pct', 'Actual (mi)', 'pbpFIPS',
+                         'OBJECTID', 'Zoom'],
+                        ['County', 'Town', 'Total (mi)', '25 Pct', 'Actual Pct', 'Actual (mi)', 'Zoom'])
+marker_sheet_columns = (['County', 'Town', 'Latitude', 'Longitude', 'Marker Description'],
+                        ['County', 'Town', 'Latitude', 'Longitude', 'Marker Description'])
+float32_fields = ['Total (mi)', '25 Pct', 'Actual Pct', 'Actual (mi)', 'Pct Towns Cycled', 'Zoom']
+
 latitude = 44.18294737
 longitude = -69.25990211
 zoom = 7.75
@@ -41,9 +126,118 @@ summary_columns = [
     dict(id='Actual (mi)', name='Miles Cycled', type='numeric', format=fixed),
     dict(id='Total Towns', name='Total Towns'),
     dict(id='Pct Towns Cycled', name='Towns Cycled', type='numeric', format=percentage),
+    dict(id='Trend', name='Trend', presentation='markdown'),
     dict(id='geoid', name='Geo Id')
 ]
 
+# Field the Trend column of the state and town tables charts.
+sparkline_field = 'Actual Pct'
+
+
+def get_shared(key, loader, expire=frame_cache_expire_seconds, keep_in_memory=True):
+    now = time.monotonic()
+    if not refresh_shared_cache and key in memory_cache:
+        loaded_at, value, nbytes = memory_cache[key]
+        if now - loaded_at < memory_cache_max_age_seconds:
+            memory_cache.move_to_end(key)
+            return value
+
+    value = None if refresh_shared_cache else frame_cache.get(key)
+    if value is None:
+        # One worker loads while the others wait for it, so a cold key is downloaded once per host.
+        with diskcache.Lock(frame_cache, ('lock',) + key, expire=120):
+            value = None if refresh_shared_cache else frame_cache.get(key)
+            if value is None:
+                print('...shared cache miss: ' + str(key))
+                value = loader()
+                frame_cache.set(key, value, expire=expire)
+
+    # Only frames are kept, as their size is cheap to know; geometry and the like sit behind caches of their own.
+    if not keep_in_memory or not isinstance(value, pd.DataFrame):
+        return value
+    memory_cache[key] = (now, value, int(value.memory_usage(deep=True).sum()))
+    memory_cache.move_to_end(key)
+    while sum(nbytes for loaded_at, value_in_memory, nbytes in memory_cache.values()) > memory_cache_max_bytes:
+        memory_cache.popitem(last=False)
+    return value
+
+
+def load_workbook_shared(onedrive_link):
+    # Raw bytes, so every sheet of a workbook comes from one download. Only parsed frames are worth the memory tier.
+    onedrive_direct_link = create_onedrive_directdownload(onedrive_link)
+    return get_shared(('workbook', onedrive_direct_link), lambda: download_workbook(onedrive_direct_link),
+                      keep_in_memory=False)
+
+
+def read_sheet_shared(cache_key, onedrive_link, sheet_name=0, columns=None, nrows=None, compact=False):
+    # nrows is part of the key, so a row count that changes with the summary is never served the old frame.
+    def loader():
+        df = read_sheet(load_workbook_shared(onedrive_link), sheet_name, columns, nrows)
+        return compact_frame(df) if compact else df
+    return get_shared(cache_key + (nrows,), loader)
+
+
+def get_sheet_columns(columns, locations_field):
+    # Adds the geoid column a map is drawn on, which StateWQData names per state and county, to a sheet's schema.
+    wanted, required = columns
+    return wanted + [locations_field] * (locations_field not in wanted), required + [locations_field]
+
+
+def compact_frame(df):
+    # Names become categoricals, ids become integers and percentages and miles float32. These frames sit in every
+    # cache tier, so this is where most of the per-state footprint goes.
+    dtypes = {}
+    for field in df.columns:
+        if field in name_fields:
+            dtypes[field] = 'category'
+        elif field in integer_fields:
+            dtypes[field] = 'Int32' if df[field].isna().any() else 'int32'
+        elif field in float32_fields:
+            dtypes[field] = 'float32'
+    return df.astype(dtypes)
+
+
+def get_cache_memory_report():
+    # Bytes held per state (or 'config' for the state registry) in this worker's LRU, against its cap, plus the
+    # size of the host-wide disk tier.
+    print('\nfunction get_cache_memory_report')
+    report = {}
+    for key, (loaded_at, value, nbytes) in memory_cache.items():
+        owner = 'config' if key[0] == 'StateWQData' else key[1]
+        owner_report = report.setdefault(owner, {'entries': 0, 'bytes': 0})
+        owner_report['entries'] += 1
+        owner_report['bytes'] += nbytes
+
+    return {'memory_tier': report, 'memory_tier_max_bytes': memory_cache_max_bytes,
+            'disk_tier_bytes': frame_cache.volume()}
+
+
+def read_geometry_json(geometry_file):
+    with open(geometry_file) as r:
+        return json.load(r)
+
+
+def load_geometry_json(geometry_file):
+    # Keyed on the file's mtime, so an edited boundary file is picked up without expiring the rest.
+    return get_shared(('geometry', geometry_file, os.path.getmtime(geometry_file)),
+                      lambda: read_geometry_json(geometry_file), expire=None)
+
+
+@functools.lru_cache(maxsize=64)
+def _get_geometry_file_url(geometry_file, mtime, locations_field, locations):
+    geometry_json = load_geometry_json(geometry_file)
+    if locations is not None:
+        location_set = set(locations)
+        geometry_json = dict(geometry_json, features=[f for f in geometry_json['features'] if
+                                                      f['properties'][locations_field] in location_set])
+    return get_geometry_url(geometry_json)
+
+
+def get_geometry_file_url(geometry_file, locations_field=None, locations=None):
+    # What figures and stores carry in place of a geometry file: the URL of its asset, or of only the features whose
+    # locations_field is in locations (a tuple).
+    return _get_geometry_file_url(geometry_file, os.path.getmtime(geometry_file), locations_field, locations)
+
 
 def create_onedrive_directdownload(onedrive_link):
     print('\nfunction create_onedrive_directdownload')
@@ -53,37 +247,176 @@ def create_onedrive_directdownload(onedrive_link):
     return resultUrl
 
 
+def encode_data_store(df):
+    # Arrow IPC stream, base64 encoded so it can live in a dcc.Store and keep its dtypes on the way back.
+    table = pa.Table.from_pandas(df, preserve_index=False).replace_schema_metadata(None)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema, options=pa.ipc.IpcWriteOptions(compression='zstd')) as writer:
+        writer.write_table(table)
+    return base64.b64encode(sink.getvalue().to_pybytes()).decode('utf-8')
+
+
+@functools.lru_cache(maxsize=32)
+def decode_data_store(data_store):
+    # Cached by payload, so every callback handed the same store shares one decoded frame. Treat it as read-only.
+    # Streams appended after the first, separated by ';', hold changed rows (see append_data_store_rows); each
+    # replaces the rows with the same Town, or County for a state summary, in place.
+    print('\nfunction decode_data_store')
+    frames = []
+    for payload in data_store.split(';'):
+        with pa.ipc.open_stream(base64.b64decode(payload)) as reader:
+            frames.append(reader.read_all().to_pandas())
+    df = frames[0]
+    for df_changed in frames[1:]:
+        key = 'Town' if 'Town' in df.columns else 'County'
+        df_merged = pd.concat([df, df_changed], ignore_index=True)
+        df_latest = df_merged.drop_duplicates(key, keep='last').set_index(key, drop=False)
+        df = df_latest.loc[df_merged[key].drop_duplicates()].reset_index(drop=True)
+    return df
+
+
+def get_changed_rows(df_previous, df_current, key_field):
+    # Keys of rows that were added, removed or have any differing value, compared row by row on key_field.
+    # Compared as objects, since categoricals from two snapshots rarely share the same categories.
+    previous = df_previous.astype(object).set_index(key_field)
+    current = df_current.astype(object).set_index(key_field)
+    if list(previous.columns) != list(current.columns):
+        return set(previous.index) | set(current.index)
+
+    common = current.index.intersection(previous.index)
+    df_a = previous.loc[common]
+    df_b = current.loc[common]
+    unchanged = ((df_a == df_b) | (df_a.isna() & df_b.isna())).all(axis=1)
+
+    return (set(current.index.difference(previous.index)) | set(previous.index.difference(current.index)) |
+            set(common[~unchanged.to_numpy()]))
+
+
+def append_data_store_rows(df_changed):
+    # A Patch that sends only the changed rows of a data store, for decode_data_store to lay over the ones it has.
+    patch = Patch()
+    # An Add on the store's string itself; `patch += ...` would rebind the name rather than record the operation.
+    patch.__iadd__(';' + encode_data_store(df_changed))
+    return patch
+
+
 def load_state_summary(selected_state):
     print('\nfunction load_state_summary')
     # onedrive_link = "https://1drv.ms/x/s!An0k-SnslkINyjUdvZ4llcQGIT5V?e=hvKTIq"
     df_state = df_StateWQData.loc[df_StateWQData.State == selected_state]
     link = df_state.iloc[0]['StateOneDriveLink']
     countyCount = df_state.iloc[0]['CountyCount']
-    onedrive_direct_link = create_onedrive_directdownload(link)
 
     # print('\nloading df_summary...')
-    if selected_state == 'New England':
-        df_summary = pd.read_excel(onedrive_direct_link,
-                                   usecols=[0, 1, 3, 5, 8, 9, 19, 21, 29], nrows=countyCount)
-    else:
-        df_summary = pd.read_excel(onedrive_direct_link,
-                                   usecols=[0, 2, 4, 7, 8, 18, 20, 28], nrows=countyCount)
+    # Read by header name; the positional usecols were [0, 1, 3, 5, 8, 9, 19, 21, 29] for 'New England' and
+    # [0, 2, 4, 7, 8, 18, 20, 28] for the states.
+    df_summary = read_sheet_shared(('summary', selected_state), link,
+                                   columns=get_sheet_columns(summary_sheet_columns,
+                                                             df_state.iloc[0]['GeoidPropertyName']),
+                                   nrows=int(countyCount), compact=True)
     # print('\df_summary:')
     # print(df_summary)
 
+    df_road_miles = load_road_miles(selected_state)
+    if df_road_miles is not None:
+        df_summary = apply_road_miles_to_summary(df_summary, df_road_miles)
+
+    df_coverage = load_ride_coverage(selected_state)
+    if df_coverage is not None:
+        df_summary = apply_ride_coverage_to_summary(df_summary, df_coverage)
+
     return df_summary
 
 
+def get_ride_coverage_file(selected_state):
+    return os.path.join(ride_coverage_dir, selected_state + '.feather')
+
+
+def load_ride_coverage(selected_state):
+    # County, Town, 25 Pct and Actual (mi) of every town, ride miles where rides.py counted any and the workbook's
+    # elsewhere, or None while the state has no ride file.
+    coverage_file = get_ride_coverage_file(selected_state)
+    if not os.path.exists(coverage_file):
+        return None
+    return get_shared(('rides', selected_state, os.path.getmtime(coverage_file)),
+                      lambda: compact_frame(pd.read_feather(coverage_file)), expire=None)
+
+
+def get_town_values(df, df_values, field):
+    # df_values[field] lined up with df's County/Town rows, falling back to df's own value for towns df_values lacks.
+    values = df_values.set_index([df_values.County.astype(str), df_values.Town.astype(str)])[field]
+    values = values.reindex(pd.MultiIndex.from_arrays([df.County.astype(str), df.Town.astype(str)])).to_numpy()
+    return pd.Series(values, index=df.index).fillna(df[field]).astype('float32')
+
+
+def get_actual_pct(df):
+    # Towns without any road count as 0% rather than dividing by zero.
+    return (df['Actual (mi)'] / df['Total (mi)'].where(df['Total (mi)'] > 0)).fillna(0).astype('float32')
+
+
+def apply_ride_coverage_to_towns(df_towns, df_coverage):
+    df = df_towns.copy()
+    df['Actual (mi)'] = get_town_values(df, df_coverage, 'Actual (mi)')
+    df['Actual Pct'] = get_actual_pct(df)
+    return df
+
+
+def apply_ride_coverage_to_summary(df_summary, df_coverage):
+    # A town counts as cycled once its ride miles reach its 25% target.
+    df_counties = df_coverage.assign(cycled=df_coverage['Actual (mi)'] >= df_coverage['25 Pct']) \
+        .groupby(df_coverage.County.astype(str)).agg(miles=('Actual (mi)', 'sum'), cycled=('cycled', 'mean'))
+
+    df = df_summary.copy()
+    counties = df.County.astype(str)
+    df['Actual (mi)'] = counties.map(df_counties.miles).fillna(df['Actual (mi)']).astype('float32')
+    df['Actual Pct'] = get_actual_pct(df)
+    df['Pct Towns Cycled'] = counties.map(df_counties.cycled).fillna(df['Pct Towns Cycled']).astype('float32')
+    return df
+
+
+def get_road_miles_file(selected_state):
+    return os.path.join(road_miles_dir, selected_state + '.feather')
+
+
+def load_road_miles(selected_state):
+    # County, Town, Total (mi) and 25 Pct of every town roads.py measured, or None while the state has no road file.
+    road_miles_file = get_road_miles_file(selected_state)
+    if not os.path.exists(road_miles_file):
+        return None
+    return get_shared(('roads', selected_state, os.path.getmtime(road_miles_file)),
+                      lambda: compact_frame(pd.read_feather(road_miles_file)), expire=None)
+
+
+def apply_road_miles_to_towns(df_towns, df_road_miles):
+    df = df_towns.copy()
+    df['Total (mi)'] = get_town_values(df, df_road_miles, 'Total (mi)')
+    df['25 Pct'] = get_town_values(df, df_road_miles, '25 Pct')
+    df['Actual Pct'] = get_actual_pct(df)
+    return df
+
+
+def apply_road_miles_to_summary(df_summary, df_road_miles):
+    df_counties = df_road_miles.groupby(df_road_miles.County.astype(str))[['Total (mi)', '25 Pct']].sum()
+
+    df = df_summary.copy()
+    counties = df.County.astype(str)
+    for field in ['Total (mi)', '25 Pct']:
+        df[field] = counties.map(df_counties[field]).fillna(df[field]).astype('float32')
+    df['Actual Pct'] = get_actual_pct(df)
+    return df
+
+
 def load_state_historical_markers(selected_state):
     # onedrive_link = "https://1drv.ms/x/s!An0k-SnslkINyjUdvZ4llcQGIT5V?e=hvKTIq"
     df_state = df_StateWQData.loc[df_StateWQData.State == selected_state]
-    link = df_state.iloc[0]['StateHistoricalMarkerOneDriveLink']
     # countyCount = df_state.iloc[0]['CountyCount']
-    onedrive_direct_link = create_onedrive_directdownload(link)
 
     if selected_state == 'New Hampshire':
         print('\nfunction load_state_historical_markers for ' + selected_state)
-        df_historical_markers = pd.read_excel(onedrive_direct_link, sheet_name='Highway Markers')
+        # Only New Hampshire has a marker workbook; the other states' links are blank.
+        link = df_state.iloc[0]['StateHistoricalMarkerOneDriveLink']
+        df_historical_markers = read_sheet_shared(('markers', selected_state), link, sheet_name='Highway Markers',
+                                                  columns=marker_sheet_columns)
         # df_markers.dropna(subset=['Latitude'])
         # df_summary = pd.read_excel(onedrive_direct_link,
         #                            usecols=[0, 1, 3, 5, 8, 9, 19, 21, 29], nrows=countyCount)
@@ -96,20 +429,78 @@ def load_state_historical_markers(selected_state):
     return df_historical_markers.dropna(subset=['Latitude'])
 
 
-def get_county_json(chosen_state):
-    print('\nfunction get_county_json for state ' + chosen_state)
+def get_state_geometry_file(chosen_state):
     if chosen_state == 'Maine':
-        r = open('../geojsonFiles/Maine_County_Boundaries.geojson.json')
-        # r = open('geojsonFiles/New_England_County_Boundaries.geojson.json')
+        return '../geojsonFiles/Maine_County_Boundaries.geojson.json'
+        # return 'geojsonFiles/New_England_County_Boundaries.geojson.json'
     elif chosen_state == 'New Hampshire':
-        r = open('../geojsonFiles/New_Hampshire_County_Boundaries.geojson.json')
+        return '../geojsonFiles/New_Hampshire_County_Boundaries.geojson.json'
     else:
-        r = open('../geojsonFiles/New_England_County_Boundaries.geojson.json')
+        return '../geojsonFiles/New_England_County_Boundaries.geojson.json'
+
 
-    counties = json.load(r)
+def get_county_json(chosen_state):
+    print('\nfunction get_county_json for state ' + chosen_state)
+    counties = load_geometry_json(get_state_geometry_file(chosen_state))
     return counties
 
 
+@functools.lru_cache(maxsize=2)
+def get_base_choropleth_layout(map_type):
+    # The layout depends only on the map type, so it is built once and reused for every state, county and color
+    # field. Geometry is not part of it; load_geometry_json caches that per file.
+    print('\nfunction get_base_choropleth_layout for ' + map_type + ' map')
+
+    base_layout = go.Figure(layout=dict(mapbox={'domain': {'x': [0.0, 1.0], 'y': [0.0, 1.0]},
+                                                'style': 'carto-positron'},
+                                        legend={'tracegroupgap': 0},
+                                        margin={"r": 1, "t": 1, "l": 1, "b": 1})).to_plotly_json()['layout']
+    if map_type == 'state':
+        base_layout['height'] = 700
+
+    return base_layout
+
+
+def create_choropleth_figure(geometry_file, map_type, df, locations_field, color_field, color_scale, color_range,
+                             latitude, longitude, zoom, filter_features=False):
+    base_layout = get_base_choropleth_layout(map_type)
+
+    locations = df[locations_field].to_numpy()
+    hover_fields = choropleth_hover_fields[map_type]
+
+    hover_lines = [locations_field + '=%{location}']
+    for i, field in enumerate(hover_fields):
+        value = '%{z' if field == color_field else '%{customdata[' + str(i) + ']'
+        value += ':.2%}' if field in percent_hover_fields else '}'
+        hover_lines.append(field + '=' + value)
+
+    if filter_features:
+        geometry_url = get_geometry_file_url(geometry_file, locations_field, tuple(sorted(set(locations.tolist()))))
+    else:
+        geometry_url = get_geometry_file_url(geometry_file)
+
+    trace = {'coloraxis': 'coloraxis',
+             'customdata': df[hover_fields].to_numpy(dtype=object),
+             'geojson': geometry_url,
+             'hovertemplate': '<br>'.join(hover_lines) + '<extra></extra>',
+             'locations': locations,
+             'marker': {'opacity': 0.75},
+             'name': '',
+             'subplot': 'mapbox',
+             'z': df[color_field].to_numpy(),
+             'type': 'choroplethmapbox'}
+
+    layout = dict(base_layout)
+    layout['mapbox'] = dict(base_layout['mapbox'], center={'lat': latitude, 'lon': longitude}, zoom=zoom)
+    layout['coloraxis'] = {'colorbar': {'title': {'text': color_field}, 'tickformat': '.0%'},
+                           'colorscale': make_colorscale(color_scale),
+                           'cmin': 0, 'cmax': color_range}
+    layout['meta'] = {'drilldown': dict(zip([str(location) for location in locations.tolist()],
+                                            df[choropleth_drilldown_fields[map_type]].to_numpy().tolist()))}
+
+    return {'data': [trace], 'layout': layout}
+
+
 def create_state_map(chosen_state, df_cleaned_summary, color_field):
     print("\nfunction create_state_map: " + chosen_state)
     df_state = df_StateWQData.loc[df_StateWQData.State == chosen_state]
@@ -120,11 +511,6 @@ def create_state_map(chosen_state, df_cleaned_summary, color_field):
     geoidPropertyName = df_state.iloc[0]['GeoidPropertyName']
     # print('geoidPropertyName: ' + geoidPropertyName)
 
-    counties = get_county_json(chosen_state)
-
-    counties['features'] = [f for f in counties['features'] if
-                            f['properties'][geoidPropertyName] in df_cleaned_summary[geoidPropertyName].unique()]
-
     if color_field == 'Actual Pct':
         color_scale = max_50_pct_color_scale
         color_range = .5
@@ -132,18 +518,9 @@ def create_state_map(chosen_state, df_cleaned_summary, color_field):
         color_scale = max_100_pct_color_scale
         color_range = 1
 
-    fig = px.choropleth_mapbox(df_cleaned_summary, geojson=counties, locations=geoidPropertyName, color=color_field,
-                               color_continuous_scale=color_scale,
-                               mapbox_style="carto-positron",
-                               zoom=zoom,
-                               center={"lat": latitude, "lon": longitude},
-                               opacity=0.75,
-                               range_color=[0, color_range],
-                               hover_data={'County': True, 'Actual Pct': ':.2%', 'Pct Towns Cycled': ':.2%'},
-                               height=700
-                               )
-    fig = fig.update_layout(margin={"r": 1, "t": 1, "l": 1, "b": 1})
-    fig.update_coloraxes(colorbar_tickformat='.0%')
+    fig = create_choropleth_figure(get_state_geometry_file(chosen_state), 'state', df_cleaned_summary,
+                                   geoidPropertyName, color_field, color_scale, color_range,
+                                   latitude, longitude, zoom, filter_features=True)
     return fig
 
 
@@ -155,16 +532,24 @@ def create_region_map(color_field):
 
     # clean data for display in table
     df_cleaned_summary = df_summary.dropna()
-    cleaned_summary_json = df_cleaned_summary.to_json(orient='split')
 
     # create state map
     region_map = create_state_map(selected_state, df_cleaned_summary, color_field)
     return region_map
 
 
+def read_state_wq_data(config_file):
+    with open(config_file, 'rb') as f:
+        return read_sheet(f.read())
+
+
 def getStateWQData():
     print('function getStateWQData')
-    df = pd.read_excel('../data/StateWQData.xlsx')
+    # Keyed on the file's mtime with no expiry, like geometry, so a worker started after the site sat idle gets the
+    # parsed registry from the disk tier instead of opening the workbook.
+    config_file = '../data/StateWQData.xlsx'
+    df = get_shared(('StateWQData', os.path.getmtime(config_file)), lambda: read_state_wq_data(config_file),
+                    expire=None)
     # usecols=[0, 2, 4, 7, 8, 20, 28], nrows=16)
     print('\ndf:')
     # print(df)
@@ -175,6 +560,7 @@ df_StateWQData = getStateWQData()
 
 states = df_StateWQData.State.unique()
 print(states)
+startup_step('StateWQData')
 
 dict_state = {}
 
@@ -211,6 +597,16 @@ card_main_form = dbc.Card(
                 dbc.Col(dcc.Dropdown(id='town_dropdown', options={}, searchable=False, style={"color": "#000000"}),
                         xs=9, sm=4, md=4, lg=3, xl=4),
             ]),
+            dbc.Row([
+                dbc.Label("Find", width='auto'),
+                dbc.Col(dcc.Dropdown(id='town_search', options=[], searchable=True, placeholder='Any town or county',
+                                     style={"color": "#000000"}),
+                        xs=9, sm=8, md=10, lg=6, xl=4),
+            ], className='mt-2'),
+            dbc.Row([
+                dbc.Col(dbc.Progress(id='load_progress', value=0, striped=True, animated=True,
+                                     style={'visibility': 'hidden'}), className='mt-2'),
+            ]),
             dbc.Row([
                 dbc.Col(dcc.Store(id='summary_data_store')),
                 dbc.Col(dcc.Store(id='county_data_store')),
@@ -219,7 +615,15 @@ card_main_form = dbc.Card(
                 dbc.Col(dcc.Store(id='state_map_store')),
                 dbc.Col(dcc.Store(id='state_table_store')),
                 dbc.Col(dcc.Store(id='county_map_cache')),
+                dbc.Col(dcc.Store(id='county_outline_store')),
                 dbc.Col(dcc.Store(id='town_table_store')),
+                dbc.Col(dcc.Store(id='data_version_store')),
+                dbc.Col(dcc.Store(id='plan_store')),
+                dbc.Col(dcc.Store(id='search_target_store')),
+                dbc.Col(dcc.Store(id='town_view_request_store')),
+                dbc.Col(dcc.Store(id='town_view_prefetch_store')),
+                dbc.Col(dcc.Store(id='view_locations_store')),
+                dbc.Col(dcc.Interval(id='data_version_interval', interval=data_version_poll_seconds * 1000)),
                 # signal value to trigger callbacks
                 dbc.Col(dcc.Store(id='redisplay_map_signal')),
             ])
@@ -231,6 +635,9 @@ card_main_form = dbc.Card(
     outline=False,  # True = remove the block colors from the background and header
 )
 
+# Its figure is set per page load by serve_layout.
+region_graph = dcc.Graph(id='my_choropleth', className="h-100")
+
 card_graph = dbc.Card([
     dbc.Row([
         dcc.RadioItems
@@ -246,9 +653,16 @@ card_graph = dbc.Card([
         )
     ],
         className='border py-2 mb-4 fs-5 text-white'),
+    dbc.Row([
+        dbc.Col(dcc.Input(id='plan_budget', type='number', min=0, placeholder='Mile budget', debounce=True)),
+        dbc.Col(dcc.Input(id='plan_goal', type='number', min=0, max=100, placeholder='Towns cycled goal %',
+                          debounce=True)),
+        dbc.Col(html.Div(id='plan_summary', className='text-white'), width=8),
+    ],
+        className='mb-4'),
     dbc.Row([
         # dcc.Graph(id='my_choropleth', figure=usa_base_map(), className="h-100"),
-        dcc.Graph(id='my_choropleth', figure=create_region_map('Pct Towns Cycled'), className="h-100")
+        region_graph
     ])
 ],
     body=True, color="secondary",
@@ -256,7 +670,7 @@ card_graph = dbc.Card([
     className="p-4 bg-secondary",
 )
 
-app.layout = dbc.Container([
+main_layout = dbc.Container([
     dbc.Row([dbc.Col(html.H2("Browse WandrerQuest Data by Map", className='text-center bg-primary text-white p-2'))
              ]),
     dbc.Row([dbc.Col(card_main_form, className="mx-1")
@@ -282,37 +696,27 @@ app.layout = dbc.Container([
 )
 
 
-def load_county_by_name(selected_state, county_name, summary_data):
-    print('\nfunction load_county_by_name')
-    if selected_state:
-        print('...selected_state: ' + str(selected_state))
-
-    if county_name:
-        print('...county_name: ' + str(county_name))
-    else:
-        return []
+@functools.lru_cache(maxsize=2)
+def get_region_map(build_id):
+    # The New England map the page opens on, from the current build or else built live, once per build.
+    print('\nfunction get_region_map for build ' + str(build_id))
+    return read_artifact('state', 'New England', 'map', 'Pct Towns Cycled') or create_region_map('Pct Towns Cycled')
 
-    df_wq = df_StateWQData.loc[df_StateWQData['State'] == selected_state]
-    # link = df_wq['StateOneDriveLink']
-    link = df_wq.iloc[0]['StateOneDriveLink']
-    # link = df_wq.iloc[0]['CountyOneDriveLink']
-    onedrive_direct_link = create_onedrive_directdownload(link)
 
-    df_summary = pd.read_json(summary_data, orient='split')
-    row_count = int(df_summary.loc[df_summary['County'] == county_name]['Total Towns'])
-    df = pd.read_excel(onedrive_direct_link, sheet_name=county_name,
-                       # usecols=[0, 1, 2, 4, 7, 8, 27],
-                       usecols=[0, 1, 2, 4, 7, 8, 18, 19],
-                       nrows=row_count)
-    # df = pd.read_excel(onedrive_direct_link, sheet_name=county_name)
+def serve_layout():
+    # Dash calls this for each page load instead of the layout being built at import, so a worker answers before the
+    # region map's workbook and geometry are loaded; the first visit loads them.
+    region_graph.figure = get_region_map(get_current_build_id())
+    return main_layout
 
-    df['id'] = df['Town']
 
-    return df.sort_values('Town')
+app.layout = serve_layout
+startup_step('layout')
 
 
-def load_town_boundaries(selected_state, county_name, summary_data):
-    print('\nfunction load_town_boundaries')
+def load_county_by_name(selected_state, county_name, summary_data, ride_coverage=True):
+    # ride_coverage=False leaves out the miles rides.py counted, for rides.py itself to start from.
+    print('\nfunction load_county_by_name')
     if selected_state:
         print('...selected_state: ' + str(selected_state))
 
@@ -321,22 +725,28 @@ def load_town_boundaries(selected_state, county_name, summary_data):
     else:
         return []
 
-    # me_onedrive_link = "https://1drv.ms/x/s!An0k-SnslkINyjUdvZ4llcQGIT5V?e=hvKTIq"
-    # me_onedrive_direct_link = create_onedrive_directdownload(me_onedrive_    link)
     df_wq = df_StateWQData.loc[df_StateWQData['State'] == selected_state]
     # link = df_wq['StateOneDriveLink']
-    link = df_wq.iloc[0]['TownBoundariesExcelOneDriveLink']
-    onedrive_direct_link = create_onedrive_directdownload(link)
+    link = df_wq.iloc[0]['StateOneDriveLink']
+    # link = df_wq.iloc[0]['CountyOneDriveLink']
+    locations_field = df_wq.loc[df_wq['CountyName'] == county_name].iloc[0]['GeoidPropertyName']
 
-    df_summary = pd.read_json(summary_data, orient='split')
+    df_summary = decode_data_store(summary_data)
     row_count = int(df_summary.loc[df_summary['County'] == county_name]['Total Towns'])
-    df = pd.read_excel(onedrive_direct_link, sheet_name=county_name,
-                       # usecols=[0, 1, 2, 4, 7, 8, 27],
-                       # usecols=[0, 1, 2, 4, 7, 8, 18, 19],
-                       nrows=row_count)
+    df = read_sheet_shared(('county', selected_state, county_name), link, sheet_name=county_name,
+                           # usecols=[0, 1, 2, 4, 7, 8, 27],
+                           # usecols=[0, 1, 2, 4, 7, 8, 18, 19],
+                           columns=get_sheet_columns(county_sheet_columns, locations_field),
+                           nrows=row_count, compact=True)
     # df = pd.read_excel(onedrive_direct_link, sheet_name=county_name)
 
-    df['id'] = df['Town']
+    df_road_miles = load_road_miles(selected_state)
+    if df_road_miles is not None:
+        df = apply_road_miles_to_towns(df, df_road_miles)
+
+    df_coverage = load_ride_coverage(selected_state) if ride_coverage else None
+    if df_coverage is not None:
+        df = apply_ride_coverage_to_towns(df, df_coverage)
 
     return df.sort_values('Town')
 
@@ -352,6 +762,8 @@ def blank_figure():
 
 def usa_base_map():
     print('\nfunction blank_figure')
+    # plotly.express is only used by the figure builders that predate the precomputed maps, so it loads on first use.
+    import plotly.express as px
 
     fig = px.choropleth_mapbox(
         # fips=fips,
@@ -437,7 +849,7 @@ def get_center_coords_from_town_json(town_json, oid, locations_field):
     return avgLat, avgLon
 
 
-def create_county_map_from_state_data(df_towns, selected_state, selected_county, town_json):
+def create_county_map_from_state_data(df_towns, selected_state, selected_county):
     if not selected_county:
         print('...returning from create_county_map_from_state_data early because county not chosen')
         return
@@ -464,36 +876,85 @@ def create_county_map_from_state_data(df_towns, selected_state, selected_county,
     locations_field = dff.iloc[0]['GeoidPropertyName']
     print('...locations_field: ' + locations_field)
 
-    fig = px.choropleth_mapbox(df_towns, geojson=town_json, locations=locations_field, color='Actual Pct',
-                               color_continuous_scale=max_100_pct_color_scale,
-                               mapbox_style="carto-positron",
-                               zoom=zoom,
-                               center={"lat": county_latitude, "lon": county_longitude},
-                               opacity=0.75,
-                               range_color=[0, 1],
-                               hover_data={'County': True, 'Town': True, 'Actual Pct': ':.2%'},
-                               )
-    fig = fig.update_layout(margin={"r": 1, "t": 1, "l": 1, "b": 1})
-    fig.update_coloraxes(colorbar_tickformat='.0%')
+    fig = create_choropleth_figure(get_county_geometry_file(selected_state, selected_county), 'county', df_towns,
+                                   locations_field, 'Actual Pct', max_100_pct_color_scale, 1,
+                                   county_latitude, county_longitude, zoom)
+    # Slot for the selected town's markers, filled in by create_town_map's patch.
+    fig['data'].append(get_marker_trace())
+    fig['layout']['meta']['county'] = selected_county
     return fig
 
 
-def get_county_json_for_state(chosen_state, chosen_county):
-    print('function get_town_json_for_state ' + chosen_state)
+def get_county_geometry_file(chosen_state, chosen_county):
     if chosen_state == 'Maine':
-        r = open('../geojsonFiles/Maine_Town_and_Townships_Boundary_Polygons_Feature.json')
-        # r = open('New_England_County_Boundaries.geojson.json')
+        return '../geojsonFiles/Maine_Town_and_Townships_Boundary_Polygons_Feature.json'
+        # return 'New_England_County_Boundaries.geojson.json'
     elif chosen_state == 'New Hampshire':
-        r = open(get_county_json_for_new_hampshire(chosen_county))
-        # r = open('../geojsonFiles/New_Hampshire_County_Boundaries.geojson.json')
-        # r = open('../geojsonFiles?/New_Hampshire_Political_Boundaries_4.json')
+        return get_county_json_for_new_hampshire(chosen_county)
+        # return '../geojsonFiles/New_Hampshire_County_Boundaries.geojson.json'
+        # return '../geojsonFiles?/New_Hampshire_Political_Boundaries_4.json'
     else:
-        r = open('../geojsonFiles/New_England_County_Boundaries.geojson.json')
+        return '../geojsonFiles/New_England_County_Boundaries.geojson.json'
 
-    counties = json.load(r)
+
+def get_county_json_for_state(chosen_state, chosen_county):
+    print('function get_town_json_for_state ' + chosen_state)
+    counties = load_geometry_json(get_county_geometry_file(chosen_state, chosen_county))
     return counties
 
 
+def create_county_outline_json(geometry_json, locations=None):
+    # Features keep only their id, which is what the figures match locations against, and simplified geometry.
+    # shapely loads here rather than at boot, since outlines are mostly served precomputed.
+    import shapely
+    import shapely.geometry
+
+    features = geometry_json['features']
+    if locations is not None:
+        location_set = {str(location) for location in locations}
+        features = [feature for feature in features if str(feature.get('id')) in location_set]
+
+    geometries = shapely.simplify([shapely.geometry.shape(feature['geometry']) for feature in features],
+                                  outline_tolerance_degrees, preserve_topology=True)
+    geometries = shapely.transform(geometries, lambda coords: np.round(coords, 4))
+    return {'type': 'FeatureCollection',
+            'features': [{'type': 'Feature', 'id': feature.get('id'), 'geometry': shapely.geometry.mapping(geometry)}
+                         for feature, geometry in zip(features, geometries)]}
+
+
+def get_county_outline_json(selected_state, selected_county):
+    # Without a precomputed outline the county's towns are only known from its geometry file when the file holds
+    # that county alone; Maine's towns share one file, so those wait for the full map.
+    geometry_file = get_county_geometry_file(selected_state, selected_county)
+    df_state = df_StateWQData.loc[(df_StateWQData.State == selected_state) & df_StateWQData.CountyName.notna()]
+    if sum(get_county_geometry_file(selected_state, county) == geometry_file for county in df_state.CountyName) > 1:
+        return None
+    return get_shared(('outline', geometry_file, os.path.getmtime(geometry_file)),
+                      lambda: create_county_outline_json(load_geometry_json(geometry_file)), expire=None)
+
+
+def create_county_outline_figure(outline_json, df_summary, selected_state, selected_county):
+    # Every town is filled with the county's own Actual Pct from the summary already in the browser, on the county
+    # map's color scale, so the full map replaces it without a jump in colors.
+    dff = df_StateWQData[
+        (df_StateWQData['State'] == selected_state) & (df_StateWQData['CountyName'] == selected_county)]
+    df_county = df_summary.loc[df_summary.County.astype(str) == selected_county]
+    county_pct = round(float(df_county['Actual Pct'].iloc[0]), 4) if len(df_county) else 0
+    locations = [feature['id'] for feature in outline_json['features']]
+
+    trace = {'type': 'choroplethmapbox', 'geojson': get_geometry_url(outline_json), 'locations': locations,
+             'z': [county_pct] * len(locations), 'coloraxis': 'coloraxis', 'marker': {'opacity': 0.5},
+             'hoverinfo': 'skip', 'name': ''}
+    layout = dict(get_base_choropleth_layout('county'))
+    layout['mapbox'] = dict(layout['mapbox'], center={'lat': float(dff.iloc[0]['cLatitude']),
+                                                      'lon': float(dff.iloc[0]['cLongitude'])},
+                            zoom=float(dff.iloc[0]['Zoom']))
+    layout['coloraxis'] = {'colorbar': {'title': {'text': 'Actual Pct'}, 'tickformat': '.0%'},
+                           'colorscale': make_colorscale(max_100_pct_color_scale), 'cmin': 0, 'cmax': 1}
+    layout['meta'] = {'county': selected_county, 'outline': True}
+    return {'data': [trace], 'layout': layout}
+
+
 def get_county_json_for_new_hampshire(chosen_county):
     print('\nget_county_json_for_new_hampshire for ' + chosen_county + ' county')
     return '../geojsonFiles/NewHampshire/New_Hampshire_' + chosen_county + '_County_Boundaries.json'
@@ -518,21 +979,6 @@ def get_county_json_for_new_hampshire(chosen_county):
     #     return '../geojsonFiles/New_Hampshire_Political_Boundaries_4.json'
 
 
-def get_town_json_for_state(chosen_state):
-    print('function get_town_json_for_state ' + chosen_state)
-    if chosen_state == 'Maine':
-        r = open('../geojsonFiles/Maine_Town_and_Townships_Boundary_Polygons_Feature.json')
-        # r = open('New_England_County_Boundaries.geojson.json')
-    elif chosen_state == 'New Hampshire':
-        # r = open('../geojsonFiles/New_Hampshire_County_Boundaries.geojson.json')
-        r = open('../geojsonFiles/New_Hampshire_Political_Boundaries_4.json')
-    else:
-        r = open('../geojsonFiles/New_England_County_Boundaries.geojson.json')
-
-    counties = json.load(r)
-    return counties
-
-
 @callback(Output('county_dropdown', 'options'),
           Output('summary_data_store', 'data'),
           Output('state_table_store', 'data'),
@@ -550,15 +996,19 @@ def state_dropdown_clicked(selected_state):
         print('...get_counties: state_dropdown: ' + selected_state + ' not coded yet')
         return {}
 
+    state_artifact = read_artifact('state', selected_state, 'summary')
+    if state_artifact:
+        return state_artifact['county_options'], state_artifact['summary_data'], state_artifact['state_table']
+
     df_summary = load_state_summary(selected_state)
     # print(df_summary.County.unique())
 
     # clean data for display in table
     df_cleaned_summary = df_summary.dropna()
-    cleaned_summary_json = df_cleaned_summary.to_json(orient='split')
+    cleaned_summary_data = encode_data_store(df_cleaned_summary)
 
-    state_table = create_state_table_store(df_cleaned_summary)
-    return df_summary.County.unique(), cleaned_summary_json, state_table
+    state_table = create_state_table_store(df_cleaned_summary, selected_state)
+    return df_summary.County.unique(), cleaned_summary_data, state_table
 
 
 # @callback(Output('state_table_store', 'data'),
@@ -581,7 +1031,13 @@ def state_dropdown_clicked(selected_state):
 #     return table_data
 
 
-def create_state_table_store(df_cleaned_summary):
+def get_sparkline_markdown(selected_state, selected_county, selected_town=None):
+    parts = [selected_state, selected_county] + ([selected_town] if selected_town else [])
+    url = '/history/' + '/'.join(urllib.parse.quote(str(part), safe='') for part in parts) + '.svg'
+    return '![](' + url + '?' + urllib.parse.urlencode({'field': sparkline_field}) + ')'
+
+
+def create_state_table_store(df_cleaned_summary, selected_state):
     print('\nfunction create_state_table_store')
 
     # df_cleaned_summary = pd.read_json(summary_data, orient='split')
@@ -589,7 +1045,8 @@ def create_state_table_store(df_cleaned_summary):
     table_data = DataTable(
         style_header={'whiteSpace': 'normal', 'height': 'auto', 'fontWeight': 'bold', 'text-align': 'center'},
         columns=summary_columns,
-        data=df_cleaned_summary.to_dict('records'),
+        data=df_cleaned_summary.assign(Trend=[get_sparkline_markdown(selected_state, county) for county in
+                                              df_cleaned_summary.County]).to_dict('records'),
         # page_size=20,
         style_table={'overflowX': 'scroll'},
         id='state_table'
@@ -620,8 +1077,7 @@ clientside_callback(
           State('state_dropdown', 'value'),
           prevent_initial_call=True)
 def callback_toggle_percent_field(percent_field, summary_data, selected_state):
-    df_cleaned_summary = pd.read_json(summary_data, orient='split')
-    state_map = create_state_map(selected_state, df_cleaned_summary, percent_field)
+    state_map = get_state_map(selected_state, summary_data, percent_field)
     return state_map
 
 
@@ -633,15 +1089,25 @@ def callback_toggle_percent_field(percent_field, summary_data, selected_state):
 # Input('state_dropdown', 'value'), prevent_initial_call='initial_duplicate')
 def update_state_map_store(summary_data, selected_state, percent_field):
     print('\ncallback update_state_map_store')
-
-    df_cleaned_summary = pd.read_json(summary_data, orient='split')
+    # Changed rows appended by refresh_changed_data, which patches the state map itself.
+    if summary_data and ';' in summary_data:
+        raise PreventUpdate
 
     # create state map
-    state_map = create_state_map(selected_state, df_cleaned_summary, percent_field)
+    state_map = get_state_map(selected_state, summary_data, percent_field)
 
     return state_map
 
 
+def get_state_map(selected_state, summary_data, percent_field):
+    state_map = read_artifact('state', selected_state, 'map', percent_field)
+    if state_map:
+        return state_map
+
+    df_cleaned_summary = decode_data_store(summary_data)
+    return create_state_map(selected_state, df_cleaned_summary, percent_field)
+
+
 # @callback(Output('my_choropleth', 'figure', allow_duplicate=True),
 #           Input('state_map_store', 'data'),
 #           State('state_dropdown', 'value'), prevent_initial_call=True)
@@ -674,15 +1140,15 @@ def update_state_geometry_json_store(selected_state):
     # get state geometry json and store
     # state_geometry_json = get_town_json_for_state(selected_state)
     if selected_state == 'Maine':
-        r = open('../geojsonFiles/Maine_Town_and_Townships_Boundary_Polygons_Feature.json')
-        # r = open('New_England_County_Boundaries.geojson.json')
+        r = '../geojsonFiles/Maine_Town_and_Townships_Boundary_Polygons_Feature.json'
+        # r = 'New_England_County_Boundaries.geojson.json'
     elif selected_state == 'New Hampshire':
-        r = open('../geojsonFiles/New_Hampshire_County_Boundaries.geojson.json')
-        # r = open('../geojsonFiles/New_Hampshire_Political_Boundaries_4.json')
+        r = '../geojsonFiles/New_Hampshire_County_Boundaries.geojson.json'
+        # r = '../geojsonFiles/New_Hampshire_Political_Boundaries_4.json'
     else:
-        r = open('../geojsonFiles/New_England_County_Boundaries.geojson.json')
+        r = '../geojsonFiles/New_England_County_Boundaries.geojson.json'
 
-    state_geometry_json = json.load(r)
+    state_geometry_json = get_geometry_file_url(r)
 
     return state_geometry_json
 
@@ -710,15 +1176,18 @@ def update_state_geometry_json_store(selected_state):
 @callback(Output('town_dropdown', 'options'),
           Output('county_data_store', 'data'),
           Output('redisplay_map_signal', 'data'),
-          Output('percent_field', 'options'),
           Output('county_geometry_json_store', 'data'),
           Input('county_dropdown', 'value'),
           State('state_dropdown', 'value'),
           State('summary_data_store', 'data'),
           # State('county_data_store', 'data'),
-          State('percent_field', 'options'),
+          background=True,
+          running=[(Output('load_progress', 'style'), {'visibility': 'visible'}, {'visibility': 'hidden'})],
+          progress=[Output('load_progress', 'value'), Output('load_progress', 'label')],
+          progress_default=[0, ''],
+          cancel=[Input('state_dropdown', 'value')],
           prevent_initial_call=True)
-def county_dropdown_clicked(selected_county, selected_state, summary_data, radiobutton_options):
+def county_dropdown_clicked(set_progress, selected_county, selected_state, summary_data):
     print('\ncallback county_dropdown_clicked, called by ' + ctx.triggered_id)
 
     if not selected_state:
@@ -727,58 +1196,112 @@ def county_dropdown_clicked(selected_county, selected_state, summary_data, radio
 
     if not selected_county:
         print('...selected_county not provided.')
-        radiobutton_options[0]['disabled'] = False
-        radiobutton_options[1]['disabled'] = False
-        return [''], dash.no_update, {'map_to_redisplay': 'state'}, radiobutton_options, dash.no_update
+        return [''], dash.no_update, {'map_to_redisplay': 'state'}, dash.no_update
 
     if selected_state == 'New England':
         print('...selected_state: ' + selected_state + ' not coded yet')
         return {}
 
-    df_towns = load_county_by_name(selected_state, selected_county, summary_data)
-    df_cleaned_towns = df_towns.dropna()
-    cleaned_towns_json = df_cleaned_towns.to_json(orient='split')
+    set_progress((10, 'Loading ' + selected_county + ' county towns'))
 
-    radiobutton_options[0]['disabled'] = True
-    radiobutton_options[1]['disabled'] = True
+    county_artifact = read_artifact('county', selected_state, selected_county, 'data')
+    if county_artifact:
+        town_options = county_artifact['town_options']
+        cleaned_towns_data = county_artifact['county_data']
+    else:
+        df_towns = load_county_by_name(selected_state, selected_county, summary_data)
+        df_cleaned_towns = df_towns.dropna()
+        cleaned_towns_data = encode_data_store(df_cleaned_towns)
+        town_options = df_towns.Town.unique()
 
-    county_json = get_county_json_for_state(selected_state, selected_county)
+    # Only the URL of the county's geometry goes to the browser; the figure fetches it from there.
+    set_progress((70, 'Loading ' + selected_county + ' county boundaries'))
+    county_json = get_geometry_file_url(get_county_geometry_file(selected_state, selected_county))
 
-    return df_towns.Town.unique(), cleaned_towns_json, {'map_to_redisplay': 'none'}, radiobutton_options, county_json
+    return town_options, cleaned_towns_data, {'map_to_redisplay': 'none'}, county_json
 
 
-@callback(Output('my_choropleth', 'figure', allow_duplicate=True),
-          Output('table', 'children', allow_duplicate=True),
-          Output('data_card_header', 'children', allow_duplicate=True),
-          Output('percent_field', 'options', allow_duplicate=True),
-          Input('redisplay_map_signal', 'data'),
-          State('county_map_cache', 'data'),
-          State('state_map_store', 'data'),
+# The maps and the state table being swapped back in are already in the browser's stores, so going back up a level
+# is done there rather than sending them to the server and back.
+clientside_callback(
+    """
+    function(signal, county_map, state_map, selected_state, state_table, selected_county) {
+        const map_name = signal ? signal.map_to_redisplay : undefined;
+        if (map_name == undefined || map_name == 'none') {
+            throw window.dash_clientside.PreventUpdate;
+        }
+        if (map_name == 'county') {
+            return [county_map, dash_clientside.no_update, 'WandrerQuest data for ' + selected_county + ' county']
+        }
+        return [state_map, state_table, 'WandrerQuest data for ' + selected_state]
+     }
+    """,
+    Output('my_choropleth', 'figure', allow_duplicate=True),
+    Output('table', 'children', allow_duplicate=True),
+    Output('data_card_header', 'children', allow_duplicate=True),
+    Input('redisplay_map_signal', 'data'),
+    State('county_map_cache', 'data'),
+    State('state_map_store', 'data'),
+    State('state_dropdown', 'value'),
+    State('state_table_store', 'data'),
+    State('county_dropdown', 'value'),
+    prevent_initial_call=True)
+
+
+# The percent field only applies to the state map. Set here rather than by the county load, so that no output of
+# the graph card is pending while a county loads and the outline below is not hidden behind the loading spinner.
+clientside_callback(
+    """
+    function(selected_county, radiobutton_options) {
+        return radiobutton_options.map(option => Object.assign({}, option, {disabled: Boolean(selected_county)}))
+     }
+    """,
+    Output('percent_field', 'options'),
+    Input('county_dropdown', 'value'),
+    State('percent_field', 'options'),
+    prevent_initial_call=True)
+
+
+@callback(Output('county_outline_store', 'data'),
+          Input('county_dropdown', 'value'),
           State('state_dropdown', 'value'),
-          State('state_table_store', 'data'),
-          State('county_dropdown', 'value'),
-          State('percent_field', 'options'),
+          State('summary_data_store', 'data'),
           prevent_initial_call=True)
-def redisplay_map(signal, county_map, state_map, selected_state, state_table, selected_county, radiobutton_options):
-    # print(signal)
-    map_name = signal.get('map_to_redisplay')
-    # print('\ncallback redisplay_map for ' + selected_state)
-    print('\ncallback redisplay_map for map_name: ' + map_name)
-    print('...triggered by ' + ctx.triggered_id)
-    # print('...map_name: ' + map_name)
-
-    if map_name == 'none':
-        print('...PreventUpdate')
+def create_county_outline(selected_county, selected_state, summary_data):
+    # First paint of a county: simplified outlines from a local file or artifact, so it never waits on the workbook
+    # download that county_dropdown_clicked is doing.
+    print('\ncallback create_county_outline')
+    if not selected_state or not selected_county or not summary_data or selected_state == 'New England':
         raise PreventUpdate
-        # return dash.no_update, dash.no_update, ''
-        # return blank_figure(), dash.no_update, ''
 
-    if map_name == 'county':
-        return county_map, dash.no_update, 'WandrerQuest data for ' + selected_county + ' county', radiobutton_options
-    else:
-        radiobutton_options[0]['disabled'] = False
-        radiobutton_options[1]['disabled'] = False
-        return state_map, state_table, 'WandrerQuest data for ' + selected_state, radiobutton_options
+    outline_json = read_artifact('county', selected_state, selected_county, 'outline') or \
+        get_county_outline_json(selected_state, selected_county)
+    if not outline_json:
+        raise PreventUpdate
+
+    return create_county_outline_figure(outline_json, decode_data_store(summary_data), selected_state,
+                                        selected_county)
+
+
+clientside_callback(
+    """
+    function(county_outline, figure, selected_county) {
+        if (!county_outline || county_outline.layout.meta.county != selected_county) {
+            return dash_clientside.no_update
+        }
+        // The full map got there first.
+        const meta = figure && figure.layout ? figure.layout.meta : undefined;
+        if (meta && meta.county == selected_county && !meta.outline) {
+            return dash_clientside.no_update
+        }
+        return county_outline
+     }
+    """,
+    Output('my_choropleth', 'figure', allow_duplicate=True),
+    Input('county_outline_store', 'data'),
+    State('my_choropleth', 'figure'),
+    State('county_dropdown', 'value'),
+    prevent_initial_call=True)
 
 
 # @callback(Output('my_choropleth', 'figure', allow_duplicate=True),
@@ -810,10 +1333,26 @@ def redisplay_map(signal, county_map, state_map, selected_state, state_table, se
 
 @callback(Output('town_table_store', 'data'),
           Input('county_data_store', 'data'),
+          State('state_dropdown', 'value'),
+          State('county_dropdown', 'value'),
           prevent_initial_call=True)
-def create_town_table_from_county_data_store(county_data_json):
+def create_town_table_from_county_data_store(county_data_json, selected_state, selected_county):
     print('\ncallback create_town_table_from_county_data_store, triggered by ' + ctx.triggered_id)
 
+    town_table_data = read_artifact('county', selected_state, selected_county, 'table')
+    if town_table_data:
+        return town_table_data
+
+    df_cleaned_towns = decode_data_store(county_data_json)
+
+    town_table_data = create_town_table_store(df_cleaned_towns, selected_state)
+
+    return town_table_data
+
+
+def create_town_table_store(df_cleaned_towns, selected_state):
+    print('\nfunction create_town_table_store')
+
     town_columns = [
         # dict(id='State', name='State'),
         dict(id='County', name='County'),
@@ -822,18 +1361,20 @@ def create_town_table_from_county_data_store(county_data_json):
         dict(id='25 Pct', name='Wandrer Target', type='numeric', format=fixed),
         dict(id='Actual Pct', name='Actual Pct', type='numeric', format=percentage),
         dict(id='Actual (mi)', name='Actual Miles', type='numeric', format=fixed),
+        dict(id='Trend', name='Trend', presentation='markdown'),
         dict(id='pbpFIPS', name='pbpFIPS'),
         # dict(id='OBJECTID', name='OBJECTID'),
         # dict(id='Primary', name='Primary'),
         dict(id='Zoom', name='Zoom')
     ]
 
-    df_cleaned_towns = pd.read_json(county_data_json, orient='split')
-
     town_table_data = DataTable(
         style_header={'whiteSpace': 'normal', 'height': 'auto', 'fontWeight': 'bold', 'text-align': 'center'},
         columns=town_columns,
-        data=df_cleaned_towns.to_dict('records'),
+        # row ids are the town names, which town_table_cell_clicked reads back from active_cell
+        data=df_cleaned_towns.assign(id=df_cleaned_towns['Town'],
+                                     Trend=[get_sparkline_markdown(selected_state, county, town) for county, town in
+                                            zip(df_cleaned_towns.County, df_cleaned_towns.Town)]).to_dict('records'),
         # page_size=20,
         fixed_rows={'headers': True},
         style_table={'minHeight': '700px', 'height': '600px', 'maxHeight': '600px'},
@@ -901,10 +1442,13 @@ def create_county_map_from_county_geometry_json_store(county_geometry_json_store
                                                       county_data_store):
     print('\ncallback create_county_map_from_county_data_store, triggered by ' + ctx.triggered_id)
 
-    df_cleaned_towns = pd.read_json(county_data_store, orient='split')
+    county_map = read_artifact('county', selected_state, selected_county, 'map')
+    if county_map:
+        return county_map
 
-    county_map = create_county_map_from_state_data(df_cleaned_towns, selected_state, selected_county,
-                                                   county_geometry_json_store)
+    df_cleaned_towns = decode_data_store(county_data_store)
+
+    county_map = create_county_map_from_state_data(df_cleaned_towns, selected_state, selected_county)
 
     return county_map
 
@@ -943,241 +1487,802 @@ def get_town_json_for_town(locations_field, location_id, county_json):
     return county_json
 
 
+def get_town_views_cache_key(selected_state, selected_county, county_data):
+    # The views point at rows of the county figure, so they are keyed on the county data they were drawn from.
+    return ('town_views', selected_state, selected_county, hashlib.sha1(county_data.encode('utf-8')).hexdigest())
+
+
+def find_town_view(selected_state, selected_county, selected_town, county_data):
+    # A town view that is already built, from the current build's artifacts or the shared cache, or None. Never
+    # loads anything slow, so it is safe in a web worker.
+    town_view = read_artifact('town', selected_state, selected_county, selected_town)
+    # Builds from before town views kept a whole figure here.
+    if town_view and 'center' in town_view:
+        return town_view
+
+    town_views = frame_cache.get(get_town_views_cache_key(selected_state, selected_county, county_data))
+    return town_views.get(selected_town) if town_views else None
+
+
 @callback(
     Output(component_id='my_choropleth', component_property='figure', allow_duplicate=True),
+    Output('town_view_request_store', 'data'),
     Input(component_id='town_dropdown', component_property='value'),
     State(component_id='state_dropdown', component_property='value'),
     State(component_id='county_dropdown', component_property='value'),
-    State('summary_data_store', 'data'),
-    State('county_geometry_json_store', 'data'),
-    State('county_map_cache', 'data'),
-    State('county_data_store', 'data'), prevent_initial_call=True)
-def create_town_map(selected_town, selected_state, selected_county, summary_data, county_json, cached_county_map,
-                    county_data):
-    # TODO: Refactor this large callback into smaller chained ones that output just a single element. Each should be easier to make clientside.
-    # TODO: Refactor this callback to save figure in a dcc.Store, then write a clientside callback to display it.
-    # TODO: Trigger the clientside callback from the town dropdown and the dcc.Store used above. If town dropdown is blank return stored county map instead.
+    State('county_data_store', 'data'),
+    prevent_initial_call=True)
+def create_town_map(selected_town, selected_state, selected_county, county_data):
+    # A town is shown on the county figure already on screen: only the view, the highlighted town and the marker
+    # trace change, so a Patch of those goes out instead of a figure carrying the county's geometry. A view that is
+    # not built yet is left to create_town_views, which runs as a background job.
     print("\ncallback create_town_map")
-    # print('---Triggered by: ' + ctx.triggered_id)
-    if not selected_town:
-        print('...returning from create_town_map early because town not chosen')
-        return cached_county_map
-        # raise PreventUpdate
-
-    if not selected_county:
+    if not selected_county or not county_data:
         print('...returning from create_town_map early because county not chosen')
-        return cached_county_map
+        raise PreventUpdate
+
+    if not selected_town:
+        print('...returning to ' + selected_county + ' county view')
+        return get_county_view_patch(selected_state, selected_county), dash.no_update
 
     print('...selected_state: ' + selected_state)
     print('...selected_county: ' + selected_county)
     print('...selected_town: ' + selected_town)
 
-    df_county_data = pd.read_json(county_data, orient='split')
-    df_town_data = df_county_data[df_county_data['Town'] == selected_town]
-    # actual_pct_col = df_town_data['Actual Pct']
+    town_view = find_town_view(selected_state, selected_county, selected_town, county_data)
+    if town_view is None:
+        print('...no town view for ' + selected_town + '; building the county\'s in the background')
+        return dash.no_update, {'state': selected_state, 'county': selected_county, 'town': selected_town}
 
-    # df = load_county_by_name(selected_state, selected_county, summary_data)
-    df = load_town_boundaries(selected_state, selected_county, summary_data)
-    # print('...df')
-    # print(df)
+    return get_town_view_patch(town_view), dash.no_update
 
-    # filter by county and town.
-    df_towns = df[(df['County'] == selected_county) & (df['Town'] == selected_town)]
-    # print(df_towns)
+
+@callback(Output('my_choropleth', 'figure', allow_duplicate=True),
+          Input('town_view_request_store', 'data'),
+          State('county_data_store', 'data'),
+          background=True,
+          running=[(Output('load_progress', 'style'), {'visibility': 'visible'}, {'visibility': 'hidden'})],
+          progress=[Output('load_progress', 'value'), Output('load_progress', 'label')],
+          progress_default=[0, ''],
+          cancel=[Input('state_dropdown', 'value'), Input('county_dropdown', 'value')],
+          prevent_initial_call=True)
+def create_town_views(set_progress, town_request, county_data):
+    # Builds the views of every town in the county at once, since the markers download and the county geometry are
+    # shared by all of them, and keeps them in the shared cache, so the county's other towns are patched in by
+    # create_town_map without another job.
+    print('\ncallback create_town_views')
+    if not town_request or not county_data:
+        raise PreventUpdate
+    selected_state, selected_county = town_request['state'], town_request['county']
+
+    cache_key = get_town_views_cache_key(selected_state, selected_county, county_data)
+    town_views = frame_cache.get(cache_key) or {}
+    if town_request['town'] not in town_views:
+        town_views = create_county_town_views(decode_data_store(county_data), selected_state, selected_county,
+                                              set_progress)
+        add_town_views(cache_key, town_views)
+    if town_request['town'] not in town_views:
+        raise PreventUpdate
+    return get_town_view_patch(town_views[town_request['town']])
+
+
+def create_county_town_views(df_county_data, selected_state, selected_county, set_progress=None):
+    print('\nfunction create_county_town_views for ' + selected_county)
+    set_progress = set_progress or (lambda progress: None)
+    set_progress((10, 'Loading historical markers'))
+    df_markers = load_state_historical_markers(selected_state)
+    set_progress((50, 'Loading ' + selected_county + ' county boundaries'))
+    county_json = get_county_json_for_state(selected_state, selected_county)
+    set_progress((80, 'Locating ' + selected_county + ' county towns'))
+    return {town: create_town_view(df_county_data, df_markers, county_json, selected_state, selected_county, town)
+            for town in df_county_data['Town'].dropna().astype(str).unique()}
+
+
+def add_town_views(cache_key, town_views):
+    # Merged into the county's cached views, since the prefetch and a town's own job can be filling them at once.
+    frame_cache.set(cache_key, dict(frame_cache.get(cache_key) or {}, **town_views), expire=frame_cache_expire_seconds)
+
+
+def order_towns_by_interest(df_county_data):
+    # Towns still short of the 25% target come first, closest to it first, since those are the ones people look up.
+    df = df_county_data.assign(Town=df_county_data['Town'].astype(str),
+                               miles_to_target=df_county_data['25 Pct'] - df_county_data['Actual (mi)'])
+    df_below = df[df.miles_to_target > 0].sort_values('miles_to_target')
+    df_above = df[df.miles_to_target <= 0].sort_values('Actual Pct')
+    return list(df_below.Town) + list(df_above.Town)
+
+
+@callback(Output('town_view_prefetch_store', 'data'),
+          Input('county_map_cache', 'modified_timestamp'),
+          State('state_dropdown', 'value'),
+          State('county_dropdown', 'value'),
+          State('county_data_store', 'data'),
+          background=True,
+          cancel=[Input('state_dropdown', 'value'), Input('county_dropdown', 'value')],
+          prevent_initial_call=True)
+def prefetch_town_views(county_map_timestamp, selected_state, selected_county, county_data):
+    # Once a county is on screen, its town views are built in the order they are likely to be asked for and added
+    # to the cache find_town_view reads one at a time, so the first town clicked rarely waits for create_town_views.
+    print('\ncallback prefetch_town_views')
+    if not selected_state or not selected_county or not county_data or selected_state == 'New England':
+        raise PreventUpdate
+
+    cache_key = get_town_views_cache_key(selected_state, selected_county, county_data)
+    df_county_data = decode_data_store(county_data)
+    towns = [town for town in order_towns_by_interest(df_county_data)
+             if find_town_view(selected_state, selected_county, town, county_data) is None]
+    if towns:
+        df_markers = load_state_historical_markers(selected_state)
+        county_json = get_county_json_for_state(selected_state, selected_county)
+    for town in towns:
+        add_town_views(cache_key, {town: create_town_view(df_county_data, df_markers, county_json, selected_state,
+                                                          selected_county, town)})
+
+    print('...prefetched ' + str(len(towns)) + ' town views for ' + selected_county)
+    return {'state': selected_state, 'county': selected_county, 'towns': len(towns)}
+
+
+def create_town_view(df_county_data, df_markers, county_json, selected_state, selected_county, selected_town):
+    # What a town adds to its county's figure: where to look, which feature of data[0] to highlight and the town's
+    # historical markers. index is the town's position in the county figure, which is drawn from the same rows.
+    towns = df_county_data['Town'].astype(str).tolist()
+    index = towns.index(selected_town)
+    df_town_data = df_county_data.iloc[[index]]
 
     dff = df_StateWQData[
         (df_StateWQData['State'] == selected_state) & (df_StateWQData['CountyName'] == selected_county)]
     locations_field = dff.iloc[0]['GeoidPropertyName']
+    oid = int(df_town_data[locations_field].iloc[0])
 
-    if locations_field == 'pbpFIPS':
-        oid = int(df_towns.pbpFIPS)
+    town_json = get_town_json_for_town(locations_field, oid, county_json)
+    town_latitude, town_longitude = get_center_coords_from_town_json(town_json, oid, locations_field)
+
+    if df_markers is None:
+        df_town_markers = pd.DataFrame(columns=['Latitude', 'Longitude', 'Marker Description'])
     else:
-        oid = int(df_towns.OBJECTID)
+        df_town_markers = (
+            df_markers.loc[(df_markers['County'] == selected_county) & (df_markers['Town'] == selected_town)])
 
-    town_json = get_town_json_for_town(locations_field, oid, county_json)
+    return {'center': {'lat': town_latitude, 'lon': town_longitude},
+            'zoom': float(df_town_data.Zoom.iloc[0]),
+            'index': index,
+            'markers': {'lat': df_town_markers['Latitude'].tolist(),
+                        'lon': df_town_markers['Longitude'].tolist(),
+                        'text': df_town_markers['Marker Description'].astype(str).tolist()}}
 
-    town_latitude, town_longitude = get_center_coords_from_town_json(town_json, oid, locations_field)
 
-    # zoom = 9.5  # default zoom level for towns?
-    town_zoom = float(df_town_data.Zoom)
+def get_marker_trace(markers=None):
+    # Always data[1] of a county figure, empty until a town is shown.
+    markers = markers or {'lat': [], 'lon': [], 'text': []}
+    return {'type': 'scattermapbox', 'name': 'markers', 'mode': 'markers+text', 'lat': markers['lat'],
+            'lon': markers['lon'], 'text': markers['text'], 'marker': {'size': 25, 'color': 'green'},
+            'hoverinfo': 'text', 'showlegend': False}
 
-    if town_latitude:
-        print('...town_latitude: ' + str(town_latitude))
 
-    if town_longitude:
-        print('...town_longitude: ' + str(town_longitude))
+def get_town_view_patch(town_view):
+    patch = Patch()
+    patch['layout']['mapbox']['center'] = town_view['center']
+    patch['layout']['mapbox']['zoom'] = town_view['zoom']
+    patch['data'][0]['selectedpoints'] = [town_view['index']]
+    patch['data'][0]['unselected'] = {'marker': {'opacity': 0.2}}
+    patch['data'][1] = get_marker_trace(town_view['markers'])
+    return patch
 
-    df_markers = load_state_historical_markers(selected_state)
-    df_town_markers = (
-        df_markers.loc[(df_markers['County'] == selected_county) & (df_markers['Town'] == selected_town)])
-
-    map = create_town_map_figure_go(df_town_data, locations_field, town_json, town_latitude, town_longitude, town_zoom,
-                                    selected_town, df_town_markers)
-
-    return map
-
-
-def create_town_map_figure_px(df_town_data, locations_field, town_json, town_latitude, town_longitude, town_zoom,
-                              selected_town, df_town_markers):
-    print('\nfunction create_town_map_figure_px for ' + selected_town)
-
-    fig = px.choropleth_mapbox(df_town_data, geojson=town_json, locations=locations_field, color='Actual Pct',
-                               color_continuous_scale=max_50_pct_color_scale,
-                               mapbox_style="carto-positron",
-                               zoom=town_zoom,
-                               center={"lat": town_latitude, "lon": town_longitude},
-                               opacity=0.5,
-                               range_color=[0, 1],
-                               hover_data={'County': True, 'Town': True, 'Actual Pct': ':.2%'},
-                               )
-    fig = fig.update_layout(margin={"r": 1, "t": 1, "l": 1, "b": 1})
-    fig.update_coloraxes(colorbar_tickformat='.0%')
-
-    if len(df_town_markers) > 0:
-        fig.add_scattermapbox(
-            lat=df_town_markers['Latitude'],
-            lon=df_town_markers['Longitude'],
-            mode='markers+text',
-            text=df_town_markers['Marker Description'],
-            marker_size=25,
-            # marker_color='rgb(235, 0, 100)'
-            marker_color='green'
-        )
 
-    return fig
+def get_county_view_patch(selected_state, selected_county):
+    dff = df_StateWQData[
+        (df_StateWQData['State'] == selected_state) & (df_StateWQData['CountyName'] == selected_county)]
 
+    patch = Patch()
+    patch['layout']['mapbox']['center'] = {'lat': float(dff.iloc[0]['cLatitude']),
+                                           'lon': float(dff.iloc[0]['cLongitude'])}
+    patch['layout']['mapbox']['zoom'] = float(dff.iloc[0]['Zoom'])
+    patch['data'][0]['selectedpoints'] = None
+    patch['data'][1] = get_marker_trace()
+    return patch
 
-def create_town_map_figure_px2(df_town_data, locations_field, town_json, town_latitude, town_longitude, town_zoom,
-                               selected_town, df_town_markers):
-    print('\nfunction create_town_map_figure_px2 for ' + selected_town)
-
-    fig = px.choropleth_mapbox(df_town_data, geojson=town_json, locations=locations_field, color='Actual Pct',
-                                color_continuous_scale=max_50_pct_color_scale,
-                                mapbox_style="carto-positron",
-                                zoom=town_zoom,
-                                center={"lat": town_latitude, "lon": town_longitude},
-                                opacity=0.5,
-                                range_color=[0, 1],
-                                hover_data={'County': True, 'Town': True, 'Actual Pct': ':.2%'},
-                                )
-
-    # smap = go.Scattermapbox(
-    #     lat=df_town_markers['Latitude'],
-    #     lon=df_town_markers['Longitude'],
-    #     mode='markers+text',
-    #     text=df_town_markers['Marker Description'],
-    #     # marker={'size': 25, 'mode': 'markers+text'},
-    #     marker={'size': 25},
-    #     # marker_color='rgb(235, 0, 100)'
-    # )
-    #
-    # fig = {
-    #     'data': [cmap, smap]
-    # }
-
-    if len(df_town_markers) > 0:
-        fig.add_scattermapbox(
-            lat=df_town_markers['Latitude'],
-            lon=df_town_markers['Longitude'],
-            mode='markers+text',
-            text=df_town_markers['Marker Description'],
-            marker_size=25,
-            # marker_color='rgb(235, 0, 100)'
-            marker_color='green'
-    )
 
-    # fig = fig.update_layout(
-    #     margin={"r": 1, "t": 1, "l": 1, "b": 1},
-    # )
-    # fig.update_coloraxes(colorbar_tickformat='.0%')
+clientside_callback(
+    """
+    function(active_cell, state_table_data) {
+        if (!active_cell) {
+            return dash_clientside.no_update
+        }
+        return state_table_data[active_cell.row]['County']
+     }
+    """,
+    Output('county_dropdown', 'value'),
+    Input('state_table', 'active_cell'),
+    State('state_table', 'data'))
+
 
-    return fig
+clientside_callback(
+    """
+    function(active_cell) {
+        if (!active_cell) {
+            return dash_clientside.no_update
+        }
+        return active_cell.row_id
+     }
+    """,
+    Output('town_dropdown', 'value'),
+    Input('town_table', 'active_cell'))
 
 
-def create_town_map_figure_go(df_town_data, locations_field, town_json, town_latitude, town_longitude, town_zoom,
-                              selected_town, df_town_markers):
-    print('\nfunction create_town_map_figure_px for ' + selected_town)
-    print(df_town_markers)
-
-    fig = go.Figure()
-    fig.add_trace(
-        go.Choroplethmapbox(geojson=town_json, locations=df_town_data[locations_field], z=df_town_data['Actual Pct'],
-                            colorscale=max_50_pct_color_scale, zmin=0, zmax=100,
-                            marker_opacity=0.5, marker_line_width=2))
-
-    # fig = go.Choroplethmapbox(geojson=town_json, locations=df_town_data[locations_field], z=df_town_data['Actual Pct'],
-    #                         colorscale=max_50_pct_color_scale, zmin=0, zmax=100,
-    #                         marker_opacity=0.5, marker_line_width=2)
-
-    if len(df_town_markers) > 0:
-        fig.add_scattermapbox(
-            lat=df_town_markers['Latitude'],
-            lon=df_town_markers['Longitude'],
-            mode='markers+text',
-            text=df_town_markers['Marker Description'],
-            marker_size=25,
-            # marker_color='rgb(235, 0, 100)'
-            marker_color='green'
-        )
+clientside_callback(
+    """
+    function(clickData, figure) {
+        const no_update = [dash_clientside.no_update, dash_clientside.no_update];
+        if (!clickData || !figure || !figure.layout || !figure.layout.meta || !figure.layout.meta.drilldown) {
+            return no_update
+        }
+        const target = figure.layout.meta.drilldown[String(clickData.points[0].location)];
+        if (target == undefined) {
+            return no_update
+        } else if (target.length == 1) {
+            return [target[0], dash_clientside.no_update]
+        } else {
+            return [dash_clientside.no_update, target[1]]
+       }
+     }
+    """,
+    Output('county_dropdown', 'value', allow_duplicate=True),
+    Output('town_dropdown', 'value', allow_duplicate=True),
+    Input('my_choropleth', 'clickData'),
+    State('my_choropleth', 'figure'), prevent_initial_call=True)
+
+
+@functools.lru_cache(maxsize=2)
+def load_search_index(build_id):
+    # precompute.py writes the towns of every county; states it has not built are searchable by county only.
+    print('\nfunction load_search_index for build ' + str(build_id))
+    search_artifact = read_artifact('search', 'index')
+    entries = [tuple(entry) for entry in search_artifact['entries']] if search_artifact else []
+    indexed_states = {entry[0] for entry in entries}
+
+    df_counties = df_StateWQData.loc[df_StateWQData.CountyName.notna() & (df_StateWQData.State != 'New England')]
+    for selected_state, selected_county in zip(df_counties.State, df_counties.CountyName):
+        if selected_state not in indexed_states:
+            entries.append((selected_state, selected_county, None))
+    return build_search_index(entries)
+
+
+@callback(Output('town_search', 'options'),
+          Input('town_search', 'search_value'),
+          State('town_search', 'value'),
+          prevent_initial_call=True)
+def search_towns(search_value, search_target):
+    # Keeps the current options while the box is empty, so the picked result keeps its label.
+    if not search_value:
+        raise PreventUpdate
 
-    mapbox_token = 'pk.eyJ1Ijoia2tsYXNtYW4iLCJhIjoiY2xpMXY0YTIxMTBtbjNkbXZuaDl1bGQwMiJ9.TKxKGNAQ0eG9d72g3w92yA'
+    results = search(load_search_index(get_current_build_id()), search_value, search_result_limit)
+    options = [{'label': label, 'value': json.dumps(entry)} for label, entry in results]
+    if search_target and search_target not in [option['value'] for option in options]:
+        options.append({'label': get_entry_label(json.loads(search_target)), 'value': search_target})
+    return options
 
-    fig.update_layout(mapbox_zoom=town_zoom,
-                      mapbox_center={'lat': town_latitude, 'lon': town_longitude})
-    fig = fig.update_layout(margin={"r": 1, "t": 1, "l": 1, "b": 1})
-    fig.update_coloraxes(colorbar_tickformat='.0%')
-    fig.update_mapboxes(accesstoken=mapbox_token)
 
-    return fig
+# A search result is reached the way a user would click to it: state, then county once the state's counties are in,
+# then town once the county map is up, so only that town's county is loaded and the town view patches the county
+# figure it belongs on. search_target_store holds the place still being reached.
+clientside_callback(
+    """
+    function(search_target, selected_state) {
+        if (!search_target) {
+            return [dash_clientside.no_update, dash_clientside.no_update, dash_clientside.no_update]
+        }
+        const target = JSON.parse(search_target);
+        if (target[0] == selected_state) {
+            return [dash_clientside.no_update, dash_clientside.no_update, target]
+        }
+        // The old state's counties are cleared so the next step waits for the new state's.
+        return [target[0], [], target]
+     }
+    """,
+    Output('state_dropdown', 'value'),
+    Output('county_dropdown', 'options', allow_duplicate=True),
+    Output('search_target_store', 'data'),
+    Input('town_search', 'value'),
+    State('state_dropdown', 'value'),
+    prevent_initial_call=True)
+
+
+clientside_callback(
+    """
+    function(county_options, target, selected_state, selected_county) {
+        if (!target || target[0] != selected_state || !county_options) {
+            return dash_clientside.no_update
+        }
+        const counties = county_options.map(option => typeof option == 'object' ? option.value : option);
+        if (!counties.includes(target[1]) || selected_county == target[1]) {
+            return dash_clientside.no_update
+        }
+        return target[1]
+     }
+    """,
+    Output('county_dropdown', 'value', allow_duplicate=True),
+    Input('county_dropdown', 'options'),
+    Input('search_target_store', 'data'),
+    State('state_dropdown', 'value'),
+    State('county_dropdown', 'value'),
+    prevent_initial_call=True)
+
+
+clientside_callback(
+    """
+    function(county_map, target, selected_county, town_options) {
+        const no_update = [dash_clientside.no_update, dash_clientside.no_update];
+        if (!target || !county_map || selected_county != target[1]) {
+            return no_update
+        }
+        const meta = county_map.layout ? county_map.layout.meta : undefined;
+        if (meta && meta.county && meta.county != target[1]) {
+            return no_update
+        }
+        if (!target[2]) {
+            return [null, null]
+        }
+        const towns = (town_options || []).map(option => typeof option == 'object' ? option.value : option);
+        if (!towns.includes(target[2])) {
+            return no_update
+        }
+        return [target[2], null]
+     }
+    """,
+    Output('town_dropdown', 'value', allow_duplicate=True),
+    Output('search_target_store', 'data', allow_duplicate=True),
+    Input('county_map_cache', 'data'),
+    Input('search_target_store', 'data'),
+    State('county_dropdown', 'value'),
+    State('town_dropdown', 'options'),
+    prevent_initial_call=True)
+
+
+def get_plan_costs(df_towns):
+    # Miles still needed to bring each town up to its 25% target; 0 for towns already there.
+    return (df_towns['25 Pct'] - df_towns['Actual (mi)']).clip(lower=0).to_numpy(dtype='float64')
+
+
+def plan_towns_for_budget(df_towns, budget_miles):
+    # Every town over target counts the same, so taking the cheapest towns first gets the most of them for the
+    # budget; a sort and a running sum instead of a search.
+    df = df_towns.assign(cost=get_plan_costs(df_towns))
+    df = df.loc[df.cost > 0].sort_values('cost', kind='stable')
+    return df.loc[df.cost.cumsum().to_numpy() <= budget_miles]
+
+
+def plan_towns_for_goal(df_towns, goal_pct):
+    # The cheapest towns of each county still needed for that county's Pct Towns Cycled to reach goal_pct.
+    df = df_towns.assign(cost=get_plan_costs(df_towns), County=df_towns.County.astype(str))
+    df_counties = df.assign(cycled=df.cost == 0).groupby('County').agg(towns=('cost', 'size'), cycled=('cycled', 'sum'))
+    needed = (np.ceil(df_counties.towns * goal_pct / 100 - 1e-9) - df_counties.cycled).clip(lower=0)
+
+    df = df.loc[df.cost > 0].sort_values('cost', kind='stable')
+    rank = df.groupby('County').cumcount().to_numpy()
+    return df.loc[rank < df.County.map(needed).to_numpy()]
+
+
+def concat_state_towns(frames):
+    # The columns planning reads, from the town data of each county.
+    return pd.concat([df[['County', 'Town', '25 Pct', 'Actual (mi)']].astype({'County': str, 'Town': str})
+                      for df in frames], ignore_index=True)
+
+
+def load_state_towns(selected_state, summary_data):
+    # Towns of every county in the state, published by precompute as one frame. Without a build they are loaded
+    # county by county once per summary and shared by every worker.
+    state_towns = read_artifact('state', selected_state, 'towns')
+    if state_towns:
+        return decode_data_store(state_towns['towns_data'])
+
+    def loader():
+        df_state = df_StateWQData.loc[(df_StateWQData.State == selected_state) & df_StateWQData.CountyName.notna()]
+        return concat_state_towns([load_county_by_name(selected_state, selected_county, summary_data).dropna()
+                                   for selected_county in df_state.CountyName])
+    return get_shared(('state_towns', selected_state, hashlib.sha1(summary_data.encode()).hexdigest()), loader)
+
+
+@callback(Output('plan_store', 'data'),
+          Output('plan_summary', 'children'),
+          Input('plan_budget', 'value'),
+          Input('plan_goal', 'value'),
+          Input('county_data_store', 'data'),
+          State('state_dropdown', 'value'),
+          State('county_dropdown', 'value'),
+          State('summary_data_store', 'data'),
+          prevent_initial_call=True)
+def plan_rides(budget_miles, goal_pct, county_data, selected_state, selected_county, summary_data):
+    # A goal plans every county (or the selected one) up to that Pct Towns Cycled; a budget is spent on the cheapest
+    # towns. Only one of them can be set at a time. The plan covers the selected county, or the whole state when
+    # none is selected.
+    if (budget_miles is None and goal_pct is None) or not selected_state or selected_state == 'New England':
+        return None, ''
+    if budget_miles is not None and goal_pct is not None:
+        return None, 'Plan by a mile budget or by a towns cycled goal, not both: clear one of them.'
+
+    print('\ncallback plan_rides for ' + selected_state)
+    if selected_county and county_data:
+        df_towns = decode_data_store(county_data)
+    else:
+        df_towns = load_state_towns(selected_state, summary_data)
+
+    if goal_pct is not None:
+        df_plan = plan_towns_for_goal(df_towns, goal_pct)
+        summary = 'Reaching ' + str(goal_pct) + '% of towns cycled takes '
+    else:
+        df_plan = plan_towns_for_budget(df_towns, budget_miles)
+        summary = 'With ' + str(budget_miles) + ' miles, ride '
+
+    summary += str(len(df_plan)) + ' towns (' + str(round(df_plan.cost.sum(), 1)) + ' mi): ' + \
+        ', '.join(df_plan.Town.astype(str).head(10))
+    if len(df_plan) > 10:
+        summary += ', ...'
+
+    return df_plan[['County', 'Town']].astype(str).to_numpy().tolist(), summary
+
+
+# Outlines the planned towns, or the counties they are in, on whichever state or county map is showing. Runs on
+# every new figure so the layer survives navigation; the town maps carry no drilldown index and are left alone.
+clientside_callback(
+    """
+    function(plan, figure) {
+        if (!figure || !figure.data || !figure.layout || !figure.layout.meta || !figure.layout.meta.drilldown) {
+            return dash_clientside.no_update
+        }
+        const drilldown = Object.entries(figure.layout.meta.drilldown);
+        const state_map = drilldown.length && drilldown[0][1].length == 1;
+        const planned = new Set((plan || []).map(function(town) { return state_map ? town[0] : town.join('/') }));
+        const location_values = new Map(figure.data[0].locations.map(function(location) {
+            return [String(location), location]
+        }));
+        const locations = drilldown
+            .filter(function(entry) { return planned.has(entry[1].join('/')) })
+            .map(function(entry) { return location_values.get(entry[0]) });
+
+        const layers = figure.data.filter(function(trace) { return trace.name != 'plan' });
+        const current = figure.data.find(function(trace) { return trace.name == 'plan' });
+        if ((current ? current.locations : []).join() == locations.join()) {
+            return dash_clientside.no_update
+        }
+        if (locations.length) {
+            layers.push({type: 'choroplethmapbox', name: 'plan', geojson: figure.data[0].geojson,
+                         featureidkey: figure.data[0].featureidkey, locations: locations,
+                         z: locations.map(function() { return 1 }), showscale: false, hoverinfo: 'skip',
+                         colorscale: [[0, 'rgba(0,0,0,0)'], [1, 'rgba(0,0,0,0)']],
+                         marker: {line: {color: '#0d6efd', width: 4}}});
+        }
+        return Object.assign({}, figure, {data: layers})
+     }
+    """,
+    Output('my_choropleth', 'figure', allow_duplicate=True),
+    Input('plan_store', 'data'),
+    Input('my_choropleth', 'figure'), prevent_initial_call=True)
+
+
+@callback(Output('data_version_store', 'data'),
+          Input('state_dropdown', 'value'), prevent_initial_call=True)
+def update_data_version_store(selected_state):
+    if not selected_state:
+        return None
+    return get_state_data_versions(selected_state)
+
+
+def patch_choropleth_data(figure):
+    patch = Patch()
+    patch['data'][0]['z'] = figure['data'][0]['z']
+    patch['data'][0]['customdata'] = figure['data'][0]['customdata']
+    return patch
+
+
+def get_figure_locations(figure):
+    return [str(location) for location in figure['data'][0]['locations']] if figure and figure.get('data') else None
+
+
+# What the stores patched by refresh_changed_data are indexed by, so it can tell whether a patch by position still
+# lands on the same counties and towns without the figures and table being sent back to the server.
+clientside_callback(
+    """
+    function(state_map, state_table, county_map) {
+        function locations(figure) {
+            return figure && figure.data && figure.data.length ? figure.data[0].locations.map(String) : null
+        }
+        const rows = state_table && state_table.props ? state_table.props.data : null;
+        return {state_map: locations(state_map), county_map: locations(county_map),
+                state_table: rows ? rows.map(function(row) { return String(row.County) }) : null}
+     }
+    """,
+    Output('view_locations_store', 'data'),
+    Input('state_map_store', 'data'),
+    Input('state_table_store', 'data'),
+    Input('county_map_cache', 'data'))
+
+
+@callback(Output('data_version_store', 'data', allow_duplicate=True),
+          Output('summary_data_store', 'data', allow_duplicate=True),
+          Output('state_map_store', 'data', allow_duplicate=True),
+          Output('state_table_store', 'data', allow_duplicate=True),
+          Output('county_map_cache', 'data', allow_duplicate=True),
+          Output('county_data_store', 'data', allow_duplicate=True),
+          Input('data_version_interval', 'n_intervals'),
+          State('data_version_store', 'data'),
+          State('view_locations_store', 'data'),
+          State('state_dropdown', 'value'),
+          State('county_dropdown', 'value'),
+          State('town_dropdown', 'value'),
+          State('percent_field', 'value'),
+          prevent_initial_call=True)
+def refresh_changed_data(n_intervals, data_versions, view_locations, selected_state, selected_county, selected_town,
+                         percent_field):
+    # Only the view on screen is patched, and only with the new z arrays and rows. Versions of views that were not
+    # patched stay behind in data_version_store, so they are picked up on a later poll once they are on screen. A
+    # figure or table whose locations no longer match the new build's is replaced whole instead.
+    if not selected_state or not data_versions or data_versions.get('state_name') != selected_state:
+        raise PreventUpdate
+
+    current_versions = get_state_data_versions(selected_state)
+    if not current_versions or current_versions == data_versions:
+        raise PreventUpdate
+
+    print('\ncallback refresh_changed_data for ' + selected_state)
+    view_locations = view_locations or {}
+    applied_versions = dict(data_versions, counties=dict(data_versions['counties']))
+    summary_data = state_map = state_table = county_map = county_data = dash.no_update
+
+    state_artifact = None
+    if current_versions['state'] != data_versions['state']:
+        state_artifact = read_artifact('state', selected_state, 'summary')
+    changed_counties = {county for county, version in current_versions['counties'].items()
+                        if data_versions['counties'].get(county) != version}
+    if state_artifact and current_versions['summary'] != data_versions.get('summary'):
+        # The summary rows of the changed counties go out on any view, as the county views read it too, but only
+        # once: the summary's version moves on here, ahead of the state view's.
+        df_summary = decode_data_store(state_artifact['summary_data'])
+        summary_data = append_data_store_rows(df_summary[df_summary.County.isin(changed_counties)])
+        applied_versions['summary'] = current_versions['summary']
+
+    if not selected_county and state_artifact:
+        state_map_artifact = read_artifact('state', selected_state, 'map', percent_field)
+        if state_map_artifact:
+            if get_figure_locations(state_map_artifact) == view_locations.get('state_map'):
+                print('...patching state map')
+                state_map = patch_choropleth_data(state_map_artifact)
+            else:
+                print('...state map locations changed, redrawing it')
+                state_map = state_map_artifact
+
+            rows = state_artifact['state_table']['props']['data']
+            if [str(row['County']) for row in rows] == view_locations.get('state_table'):
+                print('...patching state table')
+                state_table = Patch()
+                for i, row in enumerate(rows):
+                    if row['County'] in changed_counties:
+                        state_table['props']['data'][i] = row
+            else:
+                print('...state table counties changed, redrawing it')
+                state_table = state_artifact['state_table']
+
+            applied_versions['state'] = current_versions['state']
+            applied_versions['counties'].update(current_versions['counties'])
+
+    elif selected_county and not selected_town and \
+            current_versions['counties'].get(selected_county) != data_versions['counties'].get(selected_county):
+        county_artifact = read_artifact('county', selected_state, selected_county, 'data')
+        county_map_artifact = read_artifact('county', selected_state, selected_county, 'map')
+        if county_artifact and county_map_artifact:
+            if get_figure_locations(county_map_artifact) == view_locations.get('county_map'):
+                print('...patching ' + selected_county + ' county map')
+                county_map = patch_choropleth_data(county_map_artifact)
+            else:
+                print('...' + selected_county + ' county map locations changed, redrawing it')
+                county_map = county_map_artifact
+
+            # The rows that changed since the build the session loaded, when that build is still on disk.
+            previous_county_artifact = read_artifact('county', selected_state, selected_county, 'data',
+                                                     build_id=data_versions['counties'].get(selected_county))
+            df_towns = decode_data_store(county_artifact['county_data'])
+            changed_towns = get_changed_rows(decode_data_store(previous_county_artifact['county_data']), df_towns,
+                                             'Town') if previous_county_artifact else None
+            if changed_towns is not None and changed_towns <= set(df_towns.Town):
+                county_data = append_data_store_rows(df_towns[df_towns.Town.isin(changed_towns)])
+            else:
+                # Towns were dropped, which appended rows cannot express, or there is nothing to compare against.
+                county_data = county_artifact['county_data']
+            applied_versions['counties'][selected_county] = current_versions['counties'][selected_county]
+
+    if applied_versions == data_versions:
+        raise PreventUpdate
+
+    return applied_versions, summary_data, state_map, state_table, county_map, county_data
+
+
+def get_sparkline_svg(values, bars=False, width=100, height=24):
+    # A bare polyline (or bars around a zero line, for deltas) scaled to the values' own range.
+    values = np.asarray(values, dtype='float64')
+    values = values[~np.isnan(values)]
+    svg = '<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d">' % (width, height)
+    if len(values) == 0:
+        return svg + '</svg>'
+
+    low = min(values.min(), 0) if bars else values.min()
+    high = max(values.max(), 0) if bars else values.max()
+    scale = (height - 2) / (high - low) if high > low else 0
+    y = height - 1 - (values - low) * scale if scale else np.full(len(values), height / 2)
+
+    if bars:
+        zero = height - 1 + low * scale
+        step = width / len(values)
+        for i, top in enumerate(y):
+            svg += '<rect x="%.1f" y="%.1f" width="%.1f" height="%.1f" fill="%s"/>' % (
+                i * step, min(top, zero), max(step - 1, 1), max(abs(zero - top), 1),
+                '#0d6efd' if values[i] >= 0 else '#dc3545')
+    else:
+        x = np.linspace(1, width - 1, len(values)) if len(values) > 1 else np.array([width / 2])
+        points = ' '.join('%.1f,%.1f' % point for point in zip(x, y))
+        svg += '<polyline fill="none" stroke="#0d6efd" stroke-width="1.5" points="%s"/>' % points
+        svg += '<circle cx="%.1f" cy="%.1f" r="2" fill="#0d6efd"/>' % (x[-1], y[-1])
+    return svg + '</svg>'
+
+
+@server.route('/history/<selected_state>/<selected_county>.svg')
+@server.route('/history/<selected_state>/<selected_county>/<selected_town>.svg')
+def history_sparkline(selected_state, selected_county, selected_town=None):
+    # ?field= picks the column, ?kind=monthly charts a county's or town's monthly change instead of its curve.
+    field = flask.request.args.get('field', sparkline_field)
+    etag = hashlib.sha1(repr((get_history_stamp(selected_state), flask.request.full_path)).encode()).hexdigest()
+    if flask.request.if_none_match.contains(etag):
+        return flask.Response(status=304)
+
+    if flask.request.args.get('kind') == 'monthly':
+        svg = get_sparkline_svg(get_monthly_deltas(selected_state, field, selected_county, selected_town), bars=True)
+    else:
+        svg = get_sparkline_svg(get_history(selected_state, field, selected_county, selected_town))
+
+    response = flask.Response(svg, mimetype='image/svg+xml')
+    response.set_etag(etag)
+    response.cache_control.max_age = 300
+    return response
+
+
+@server.route('/geometry/<name>.json')
+def geometry_asset(name):
+    # The URL names the content, so a copy once fetched is good forever.
+    if flask.request.if_none_match.contains(name):
+        return flask.Response(status=304)
+
+    asset = find_geometry_asset(name, flask.request.accept_encodings)
+    if asset is None:
+        flask.abort(404)
+    path, encoding = asset
+
+    if encoding is None:
+        with open(path, 'rb') as f:
+            response = flask.Response(zlib.decompress(f.read(), wbits=31), mimetype='application/json')
+    else:
+        response = flask.send_file(path, mimetype='application/json', etag=False, conditional=False)
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.set_etag(name)
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 60 * 60
+    response.cache_control.immutable = True
+    return response
+
+
+def get_frame_tag(df):
+    # A digest of a frame's columns and rows, in order, for frames built live rather than read from an artifact.
+    digest = hashlib.sha1(repr(list(df.columns)).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def get_api_summary(selected_state):
+    # The frame and a tag that changes when it does: the artifact's sha1 from the manifest, when there is one.
+    if selected_state not in states:
+        flask.abort(404)
+    build_id = get_current_build_id()
+    state_artifact = build_id and read_artifact('state', selected_state, 'summary', build_id=build_id)
+    if state_artifact:
+        return decode_data_store(state_artifact['summary_data']), get_artifact_sha1('state', selected_state, 'summary',
+                                                                                    build_id=build_id)
+    df_summary = load_state_summary(selected_state).dropna()
+    return df_summary, get_frame_tag(df_summary)
+
+
+def get_api_towns(selected_state, selected_county):
+    # Only counties with a sheet of their own in the registry have towns; New England's summary rows are counties of
+    # other states, with no county sheets behind them.
+    df_summary, summary_tag = get_api_summary(selected_state)
+    registered = ((df_StateWQData.State == selected_state) & (df_StateWQData.CountyName == selected_county)).any()
+    if not registered or selected_county not in set(df_summary.County.astype(str)):
+        flask.abort(404)
+    build_id = get_current_build_id()
+    county_artifact = build_id and read_artifact('county', selected_state, selected_county, 'data', build_id=build_id)
+    if county_artifact:
+        return decode_data_store(county_artifact['county_data']), get_artifact_sha1('county', selected_state,
+                                                                                     selected_county, 'data',
+                                                                                     build_id=build_id)
+    df_towns = load_county_by_name(selected_state, selected_county, encode_data_store(df_summary)).dropna()
+    return df_towns, get_frame_tag(df_towns)
+
+
+def get_api_chunks(df, output_format, compress):
+    # CSV goes out in blocks of api_csv_chunk_rows so a large result never sits in memory as one string.
+    if output_format == 'csv':
+        chunks = (df.iloc[i:i + api_csv_chunk_rows].to_csv(index=False, header=i == 0).encode('utf-8')
+                  for i in range(0, max(len(df), 1), api_csv_chunk_rows))
+    else:
+        # Percentages and miles are float32; 7 decimals is all they carry.
+        chunks = iter([df.to_json(orient='records', double_precision=7).encode('utf-8')])
+
+    if not compress:
+        yield from chunks
+        return
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        yield compressor.compress(chunk)
+    yield compressor.flush()
+
+
+def create_api_response(df, data_tag):
+    # ?format=csv for CSV, JSON records otherwise. The ETag comes from data_tag, which changes with the data, so a
+    # conditional request is answered without serializing anything. A gzip body is a different representation of
+    # the same data and gets its own tag.
+    output_format = 'csv' if flask.request.args.get('format') == 'csv' else 'json'
+    compress = flask.request.accept_encodings['gzip'] > 0
+    etag = data_tag + '-' + output_format + ('-gzip' if compress else '')
+    if flask.request.if_none_match.contains(etag):
+        response = flask.Response(status=304)
+    else:
+        response = flask.Response(get_api_chunks(df, output_format, compress),
+                                  mimetype='text/csv' if output_format == 'csv' else 'application/json')
+        if compress:
+            response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+@server.route('/api/<selected_state>/summary')
+def api_summary(selected_state):
+    return create_api_response(*get_api_summary(selected_state))
+
+
+@server.route('/api/<selected_state>/<selected_county>/towns')
+def api_towns(selected_state, selected_county):
+    return create_api_response(*get_api_towns(selected_state, selected_county))
+
+
+@server.route('/api/<selected_state>/markers')
+def api_markers(selected_state):
+    if selected_state not in states:
+        flask.abort(404)
+    df_markers = load_state_historical_markers(selected_state)
+    if df_markers is None:
+        flask.abort(404)
+    return create_api_response(df_markers, get_frame_tag(df_markers))
+
+
+def require_debug_routes():
+    if not (debug_routes or server.debug):
+        flask.abort(404)
+
+
+@server.route('/debug/cache-memory')
+def cache_memory_report():
+    require_debug_routes()
+    return flask.jsonify(get_cache_memory_report())
+
 
+@server.route('/debug/boot-profile')
+def boot_profile_report():
+    require_debug_routes()
+    return flask.jsonify(get_boot_profile())
 
-@callback(Output('county_dropdown', 'value'),
-          # State('county_dropdown', 'value'),
-          State('state_table_store', 'data'),
-          Input('state_table', 'active_cell'))
-def state_table_cell_clicked(active_table, active_cell):
-    if not active_cell:
-        return dash.no_update
-
-    print('\ncallback state_table_cell_clicked')
-    row = active_cell['row']
-    print(active_cell)
-    county = active_table['props']['data'][row]['County']
-    print('county: ' + county)
-    return county
-
-
-@callback(Output('town_dropdown', 'value'),
-          # State('county_dropdown', 'value'),
-          State('town_table_store', 'data'),
-          Input('town_table', 'active_cell'))
-def town_table_cell_clicked(active_table, active_cell):
-    if not active_cell:
-        return dash.no_update
-
-    print('\ncallback town_table_cell_clicked')
-    row_id = active_cell['row_id']
-    print(active_cell)
-    print('...town: ' + row_id)
-    return row_id
-
-
-@callback(Output('county_dropdown', 'value', allow_duplicate=True),
-          Output('town_dropdown', 'value', allow_duplicate=True),
-          Input('my_choropleth', 'clickData'), prevent_initial_call=True)
-def map_clicked(clickData):
-    # print(clickData)
-
-    if len(clickData['points'][0]['customdata']) == 3:
-        if isinstance(clickData['points'][0]['customdata'][1], (int, float)):
-            county = clickData['points'][0]['customdata'][0]
-            print('\ncallback map_clicked on county ' + county)
-            return county, dash.no_update
-        else:
-            town = clickData['points'][0]['customdata'][1]
-            print('\ncallback map_clicked on town ' + town)
-            return dash.no_update, town
 
+startup_finished('callbacks and routes')
 
 if __name__ == "__main__":
     # app.run_server(debug=True)
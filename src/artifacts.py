@@ -0,0 +1,136 @@
+import functools
+import gzip
+import hashlib
+import json
+import os
+import time
+import urllib.parse
+
+import plotly.io.json
+
+artifact_root = '../artifacts'
+current_build_file = os.path.join(artifact_root, 'CURRENT')
+
+
+def get_artifact_name(key):
+    # key is a tuple such as ('county', 'New Hampshire', 'Belknap', 'map'); its name is the manifest key.
+    return '/'.join(str(part) for part in key)
+
+
+def get_artifact_path(build_dir, key):
+    parts = [urllib.parse.quote(str(part), safe='') for part in key]
+    return os.path.join(build_dir, *parts) + '.json.gz'
+
+
+def create_build_dir():
+    # Versions are timestamps (history.py reads them as such), so a build started in the same second as the last one
+    # waits for the next: readers cache a build by its id and must never see two under one.
+    while True:
+        version = time.strftime('%Y%m%d%H%M%S', time.gmtime())
+        build_dir = os.path.join(artifact_root, version)
+        try:
+            os.makedirs(build_dir)
+            return build_dir
+        except FileExistsError:
+            time.sleep(0.1)
+
+
+def write_artifact(build_dir, key, value):
+    # Returns the manifest entry for the artifact. Paths are relative to artifact_root, so a later build can keep
+    # pointing at files an earlier build wrote.
+    path = get_artifact_path(build_dir, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = plotly.io.json.to_json_plotly(value).encode('utf-8')
+    with gzip.open(path, 'wb', compresslevel=6) as f:
+        f.write(data)
+    return {'path': os.path.relpath(path, artifact_root), 'sha1': hashlib.sha1(data).hexdigest()}
+
+
+def publish_build(build_dir, manifest):
+    print('\nfunction publish_build: ' + build_dir)
+    with open(os.path.join(build_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+    # Swap CURRENT in one rename so readers never see a half-written build.
+    tmp_file = current_build_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(os.path.basename(build_dir))
+    os.replace(tmp_file, current_build_file)
+
+
+def get_current_build_id():
+    try:
+        with open(current_build_file) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+@functools.lru_cache(maxsize=4)
+def load_manifest(build_id):
+    print('\nfunction load_manifest for build ' + build_id)
+    with open(os.path.join(artifact_root, build_id, 'manifest.json')) as f:
+        return json.load(f)
+
+
+def get_current_manifest():
+    build_id = get_current_build_id()
+    if not build_id:
+        return None
+    return load_manifest(build_id)
+
+
+def get_state_data_versions(selected_state):
+    # What a session compares against to find out which parts of the state changed since it loaded them.
+    manifest = get_current_manifest()
+    if not manifest:
+        return None
+
+    # 'summary' is the same version as 'state', kept apart because a session brings its summary rows up to date on
+    # any view and its state map and table only while they are on screen.
+    county_prefix = get_artifact_name(('county', selected_state)) + '/'
+    state_version = manifest['data_versions'].get(get_artifact_name(('state', selected_state)))
+    return {'state_name': selected_state,
+            'state': state_version,
+            'summary': state_version,
+            'counties': {name[len(county_prefix):]: version for name, version in manifest['data_versions'].items()
+                         if name.startswith(county_prefix)}}
+
+
+def get_artifact_sha1(*key, build_id=None):
+    # The sha1 of an artifact's contents, from the manifest alone, or None. Pass the build_id read_artifact was given
+    # for a sha1 that belongs to the same build even if CURRENT moved on in between.
+    manifest = load_manifest(build_id) if build_id else get_current_manifest()
+    entry = manifest and manifest['artifacts'].get(get_artifact_name(key))
+    return entry['sha1'] if entry else None
+
+
+@functools.lru_cache(maxsize=64)
+def _read_artifact(path):
+    with gzip.open(path, 'rb') as f:
+        return json.loads(f.read())
+
+
+def read_artifact(*key, build_id=None):
+    # Returns None when there is no published build or the build has no such artifact, so callers fall back to
+    # building live. The returned value is shared by every caller; treat it as read-only. build_id reads from an
+    # earlier build instead of CURRENT, or returns None once that build is gone.
+    if build_id:
+        # Ids are the timestamps create_build_dir names builds by; anything else is not a build.
+        if not str(build_id).isdigit():
+            return None
+        try:
+            manifest = load_manifest(build_id)
+        except FileNotFoundError:
+            return None
+    else:
+        manifest = get_current_manifest()
+    if not manifest:
+        return None
+
+    entry = manifest['artifacts'].get(get_artifact_name(key))
+    if not entry:
+        print('...artifact miss: ' + get_artifact_name(key))
+        return None
+
+    return _read_artifact(os.path.join(artifact_root, entry['path']))
@@ -0,0 +1,79 @@
+# Times the workbook reader backends against pd.read_excel on the real OneDrive workbooks. Run from src/:
+#
+#     python benchmark_workbooks.py [--state 'New Hampshire'] [--repeat 3]
+#
+# Each workbook is downloaded once up front, so only parsing is timed: the summary sheet plus every county sheet,
+# read the way the loaders read them.
+
+import argparse
+import io
+import time
+
+import pandas as pd
+
+import app
+from workbooks import backends, download_workbook, read_sheet
+
+# The positional columns the loaders used with pd.read_excel, kept here as the baseline.
+summary_usecols = {'New England': [0, 1, 3, 5, 8, 9, 19, 21, 29]}
+default_summary_usecols = [0, 2, 4, 7, 8, 18, 20, 28]
+county_usecols = [0, 1, 2, 4, 7, 8, 18, 19]
+
+
+def get_sheet_reads(selected_state):
+    # (sheet_name, columns, usecols, nrows) of every sheet the app reads from the state workbook.
+    df_state = app.df_StateWQData.loc[app.df_StateWQData.State == selected_state]
+    reads = [(0, app.get_sheet_columns(app.summary_sheet_columns, df_state.iloc[0]['GeoidPropertyName']),
+              summary_usecols.get(selected_state, default_summary_usecols), int(df_state.iloc[0]['CountyCount']))]
+
+    df_summary = app.load_state_summary(selected_state)
+    towns = dict(zip(df_summary.County.astype(str), df_summary['Total Towns']))
+    for selected_county, locations_field in zip(df_state.CountyName.dropna(),
+                                                df_state.loc[df_state.CountyName.notna(), 'GeoidPropertyName']):
+        reads.append((selected_county, app.get_sheet_columns(app.county_sheet_columns, locations_field),
+                      county_usecols, int(towns[selected_county])))
+    return reads
+
+
+def time_reads(read, reads, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        for sheet_name, columns, usecols, nrows in reads:
+            read(sheet_name, columns, usecols, nrows)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare workbook reader backends on the WandrerQuest workbooks.')
+    parser.add_argument('--state', action='append', help='state to benchmark; repeat for several (default: all)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per backend; the fastest is reported')
+    args = parser.parse_args()
+
+    for selected_state in args.state or list(app.states):
+        df_state = app.df_StateWQData.loc[app.df_StateWQData.State == selected_state]
+        data = download_workbook(app.create_onedrive_directdownload(df_state.iloc[0]['StateOneDriveLink']))
+        reads = get_sheet_reads(selected_state)
+
+        results = {'pd.read_excel': time_reads(
+            lambda sheet_name, columns, usecols, nrows: pd.read_excel(io.BytesIO(data), sheet_name=sheet_name,
+                                                                      usecols=usecols, nrows=nrows),
+            reads, args.repeat)}
+        for backend in backends:
+            try:
+                results[backend] = time_reads(
+                    lambda sheet_name, columns, usecols, nrows: read_sheet(data, sheet_name, columns, nrows, backend),
+                    reads, args.repeat)
+            except ImportError as e:
+                print('...skipping ' + backend + ': ' + repr(e))
+
+        print('\n' + selected_state + ': ' + str(len(reads)) + ' sheets, ' + str(round(len(data) / 1024)) + ' KiB')
+        baseline = results['pd.read_excel']
+        for name, elapsed in results.items():
+            print('  {:<14} {:8.1f} ms  {:5.1f}x'.format(name, elapsed * 1000, baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# Geometry served as static files from content-hashed URLs, so browsers keep it across sessions and views.
+#
+# Figures carry a /geometry/<hash>.json URL where the GeoJSON used to be: plotly.js fetches a choroplethmapbox
+# geojson given as a URL itself, and keeps what it fetched for the life of the page. Each asset is written once under
+# ../artifacts/geometry, next to the precomputed figures that point at it, as .json.gz and, when the brotli module is
+# installed, .json.br. The route in app.py sends the smaller one the browser accepts with an immutable cache header;
+# changed geometry gets a new hash, so a cached copy never needs revalidating.
+
+import gzip
+import hashlib
+import json
+import os
+import re
+
+try:
+    import brotli  # optional; without it only gzip is offered
+except ImportError:
+    brotli = None
+
+geometry_root = '../artifacts/geometry'
+# Compression happens once per asset, so both are set for size rather than speed.
+gzip_level = 9
+brotli_quality = 11
+asset_name_pattern = re.compile(r'^[0-9a-f]{20}$')
+
+
+def get_asset_path(name, encoding):
+    # encoding is 'gzip' or 'br'.
+    return os.path.join(geometry_root, name + ('.json.br' if encoding == 'br' else '.json.gz'))
+
+
+def write_asset_file(path, data):
+    tmp_file = path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_file, path)
+
+
+def get_geometry_url(geometry_json):
+    # Writes the asset if this content has not been written before and returns its URL.
+    data = json.dumps(geometry_json, separators=(',', ':')).encode('utf-8')
+    name = hashlib.sha256(data).hexdigest()[:20]
+
+    if not os.path.exists(get_asset_path(name, 'gzip')):
+        print('\nfunction get_geometry_url writing ' + name + ' (' + str(round(len(data) / 1024)) + ' KiB)')
+        os.makedirs(geometry_root, exist_ok=True)
+        if brotli is not None:
+            write_asset_file(get_asset_path(name, 'br'), brotli.compress(data, quality=brotli_quality))
+        # The .gz is written last; its presence means the asset is complete.
+        write_asset_file(get_asset_path(name, 'gzip'), gzip.compress(data, gzip_level, mtime=0))
+    return '/geometry/' + name + '.json'
+
+
+def find_geometry_asset(name, accept_encodings):
+    # (path, encoding) of the best stored copy the browser accepts, or None for an unknown asset. encoding is None
+    # when the browser takes neither and the gzip copy has to be sent decompressed.
+    if not asset_name_pattern.match(name) or not os.path.exists(get_asset_path(name, 'gzip')):
+        return None
+    for encoding in ('br', 'gzip'):
+        if encoding in accept_encodings and os.path.exists(get_asset_path(name, encoding)):
+            return get_asset_path(name, encoding), encoding
+    return get_asset_path(name, 'gzip'), None
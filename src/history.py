@@ -0,0 +1,161 @@
+# Append-only history of the county and town numbers, one point each time a build publishes a new value.
+#
+# Each snapshot is written as its own small Arrow part under ../data/history/<state>; only rows whose values changed
+# since the last point are kept. Parts are folded into one file sorted by (level, County, Town, time) once there are
+# more than compact_max_parts of them, so a town's curve is a sorted-index lookup rather than a scan of every
+# snapshot.
+
+import functools
+import glob
+import os
+
+import pandas as pd
+import pyarrow as pa
+
+history_root = '../data/history'
+history_fields = ['Actual (mi)', 'Actual Pct', 'Pct Towns Cycled']
+history_key = ['level', 'County', 'Town']
+compact_max_parts = 16
+
+
+def get_history_dir(selected_state):
+    return os.path.join(history_root, selected_state)
+
+
+def get_compacted_file(selected_state):
+    return os.path.join(get_history_dir(selected_state), 'history.arrow')
+
+
+def get_part_files(selected_state):
+    return sorted(glob.glob(os.path.join(get_history_dir(selected_state), 'part-*.arrow')))
+
+
+def write_table(df, path):
+    # pyarrow.feather loads on first use, as only builds and the sparkline routes read or write history.
+    import pyarrow.feather
+
+    tmp_file = path + '.tmp'
+    pyarrow.feather.write_feather(pa.Table.from_pandas(df, preserve_index=False), tmp_file, compression='zstd')
+    os.replace(tmp_file, path)
+
+
+def get_history_stamp(selected_state):
+    # Changes whenever a part is added or the parts are compacted; what the caches below are keyed on.
+    history_dir = get_history_dir(selected_state)
+    if not os.path.isdir(history_dir):
+        return None
+    return os.path.getmtime(history_dir), len(os.listdir(history_dir))
+
+
+@functools.lru_cache(maxsize=8)
+def _load_history(selected_state, stamp):
+    import pyarrow.feather
+
+    print('\nfunction load_history for ' + selected_state)
+    # compact_history puts history.arrow in place before it removes the parts folded into it, so a row can be read
+    # from both; a point is one (level, County, Town, version), and repeats of it are dropped. A part removed while
+    # the files are read is already in history.arrow, so they are read again.
+    while True:
+        files = [get_compacted_file(selected_state)] if os.path.exists(get_compacted_file(selected_state)) else []
+        files += get_part_files(selected_state)
+        if not files:
+            return None
+        try:
+            frames = [pyarrow.feather.read_table(path, memory_map=True).to_pandas() for path in files]
+            break
+        except FileNotFoundError:
+            continue
+    df = pd.concat(frames, ignore_index=True).drop_duplicates(history_key + ['version'])
+    df = df.sort_values(history_key + ['time'], ignore_index=True)
+
+    # Row range of every county and town, so a curve is a dict lookup and a slice.
+    keys = list(df[history_key].itertuples(index=False, name=None))
+    starts = [0] + [i for i in range(1, len(keys)) if keys[i] != keys[i - 1]]
+    ends = starts[1:] + [len(keys)]
+    return df, {keys[start]: (start, end) for start, end in zip(starts, ends)}
+
+
+def load_history(selected_state):
+    # Every point of the state sorted by (level, County, Town, time), Town being '' on county rows, and the row range
+    # of each (level, County, Town). Read-only.
+    stamp = get_history_stamp(selected_state)
+    if stamp is None:
+        return None
+    return _load_history(selected_state, stamp)
+
+
+def get_snapshot_rows(level, df, snapshot_time, version):
+    df_rows = pd.DataFrame({'level': level, 'County': df.County.astype(str),
+                            'Town': df.Town.astype(str) if 'Town' in df else '',
+                            'time': pd.Timestamp(snapshot_time), 'version': version})
+    for field in history_fields:
+        df_rows[field] = df[field].to_numpy(dtype='float32') if field in df else float('nan')
+    return df_rows
+
+
+def append_snapshot(selected_state, version, df_counties=None, df_towns=None):
+    # version is a build version (%Y%m%d%H%M%S, UTC). Rows equal to the latest point already stored are dropped, so
+    # publishing an unchanged county adds nothing.
+    snapshot_time = pd.to_datetime(version, format='%Y%m%d%H%M%S')
+    frames = []
+    if df_counties is not None:
+        frames.append(get_snapshot_rows('county', df_counties, snapshot_time, version))
+    if df_towns is not None:
+        frames.append(get_snapshot_rows('town', df_towns, snapshot_time, version))
+    if not frames:
+        return 0
+    df_snapshot = pd.concat(frames, ignore_index=True)
+
+    history = load_history(selected_state)
+    if history is not None:
+        df_history, ranges = history
+        df_latest = df_history.iloc[[end - 1 for start, end in ranges.values()]].set_index(history_key)[history_fields]
+        df_previous = df_latest.reindex(pd.MultiIndex.from_frame(df_snapshot[history_key])).to_numpy()
+        df_current = df_snapshot[history_fields].to_numpy()
+        unchanged = ((df_previous == df_current) | (pd.isna(df_previous) & pd.isna(df_current))).all(axis=1)
+        df_snapshot = df_snapshot.loc[~unchanged]
+    if df_snapshot.empty:
+        return 0
+
+    os.makedirs(get_history_dir(selected_state), exist_ok=True)
+    write_table(df_snapshot, os.path.join(get_history_dir(selected_state), 'part-' + version + '.arrow'))
+    print('...recorded ' + str(len(df_snapshot)) + ' history rows for ' + selected_state)
+
+    if len(get_part_files(selected_state)) > compact_max_parts:
+        compact_history(selected_state)
+    return len(df_snapshot)
+
+
+def compact_history(selected_state):
+    # Readers drop the rows seen in both history.arrow and a part not yet removed; see _load_history.
+    print('\nfunction compact_history for ' + selected_state)
+    part_files = get_part_files(selected_state)
+    df_history, ranges = load_history(selected_state)
+    write_table(df_history, get_compacted_file(selected_state))
+    for path in part_files:
+        os.remove(path)
+
+
+def get_history(selected_state, field, selected_county, selected_town=None, start=None, end=None):
+    # A county's or town's field over time, oldest first, optionally limited to [start, end].
+    history = load_history(selected_state)
+    key = ('town', selected_county, selected_town) if selected_town else ('county', selected_county, '')
+    if history is None or key not in history[1]:
+        return pd.Series(dtype='float32', name=field)
+
+    df_history, ranges = history
+    row_start, row_end = ranges[key]
+    values = pd.Series(df_history[field].to_numpy()[row_start:row_end], name=field,
+                       index=pd.DatetimeIndex(df_history.time.to_numpy()[row_start:row_end], name='time'))
+    if start is not None or end is not None:
+        values = values.loc[start:end]
+    return values
+
+
+def get_monthly_deltas(selected_state, field, selected_county, selected_town=None):
+    # Change of field within each calendar month, carrying the last value forward through months without a point.
+    values = get_history(selected_state, field, selected_county, selected_town)
+    if values.empty:
+        return values
+    monthly = values.resample('MS').last().ffill()
+    return monthly.diff().fillna(monthly.iloc[0] - values.iloc[0])
@@ -0,0 +1,275 @@
+# Builds every state, county and town map and table ahead of time and publishes them as artifacts the Dash
+# callbacks serve before falling back to building live. Run from src/, like the app:
+#
+#     python precompute.py [--state 'New Hampshire'] [--workers 4] [--refresh]
+#
+# --refresh diffs the workbooks against the snapshots in the current build and rebuilds only the counties and
+# towns whose rows changed; everything else keeps its artifacts and data version. --state without --refresh rebuilds
+# those states in full and carries the other states over from the current build.
+
+import argparse
+import concurrent.futures
+import os
+import time
+
+import pandas as pd
+
+import app
+from artifacts import create_build_dir, write_artifact, publish_build, get_artifact_name, get_current_manifest, \
+    read_artifact
+from history import append_snapshot
+
+percent_fields = ['Pct Towns Cycled', 'Actual Pct']
+
+
+def get_registry_counties(selected_state):
+    df_state = app.df_StateWQData.loc[app.df_StateWQData.State == selected_state]
+    return list(df_state.loc[df_state.CountyName.notna(), 'CountyName'])
+
+
+def build_state(build_dir, selected_state, df_summary):
+    print('\nfunction build_state for ' + selected_state)
+    entries = {}
+
+    df_cleaned_summary = df_summary.dropna()
+    summary_data = app.encode_data_store(df_cleaned_summary)
+
+    key = ('state', selected_state, 'summary')
+    entries[get_artifact_name(key)] = write_artifact(build_dir, key, {
+        'county_options': df_summary.County.unique(),
+        'summary_data': summary_data,
+        'state_table': app.create_state_table_store(df_cleaned_summary, selected_state),
+    })
+
+    for percent_field in percent_fields:
+        key = ('state', selected_state, 'map', percent_field)
+        entries[get_artifact_name(key)] = write_artifact(build_dir, key, app.create_state_map(selected_state,
+                                                                                               df_cleaned_summary,
+                                                                                               percent_field))
+
+    return summary_data, entries
+
+
+def build_state_towns(build_dir, manifest, selected_state, county_data):
+    # Every town of the state in one frame, for planning rides across the state. Counties not rebuilt in this build
+    # come from the artifacts it carries over; one with neither is left out until it builds.
+    frames = []
+    for selected_county in get_registry_counties(selected_state):
+        data = county_data.get(selected_county)
+        if data is None and get_artifact_name(('county', selected_state, selected_county, 'data')) in \
+                manifest['artifacts']:
+            data = read_artifact('county', selected_state, selected_county, 'data')['county_data']
+        if data:
+            frames.append(app.decode_data_store(data))
+
+    key = ('state', selected_state, 'towns')
+    return {get_artifact_name(key): write_artifact(build_dir, key, {
+        'towns_data': app.encode_data_store(app.concat_state_towns(frames))})} if frames else {}
+
+
+def build_county(build_dir, selected_state, selected_county, summary_data, previous_county_data=None):
+    # Runs in a pool process; everything it needs is loaded here so counties never wait on each other.
+    # Returns the new manifest entries, the towns now in the county and its town data, or None when nothing changed.
+    print('\nfunction build_county for ' + selected_county)
+    entries = {}
+
+    df_towns = app.load_county_by_name(selected_state, selected_county, summary_data)
+    df_cleaned_towns = df_towns.dropna()
+
+    towns = list(df_cleaned_towns.Town.unique())
+    if previous_county_data:
+        df_previous_towns = app.decode_data_store(previous_county_data)
+        changed_towns = app.get_changed_rows(df_previous_towns, df_cleaned_towns, 'Town')
+        if not changed_towns:
+            print('...' + selected_county + ' unchanged')
+            return None
+        # A town view points at its row in the county figure, so every view moves when the rows do.
+        if list(df_previous_towns.Town) != list(df_cleaned_towns.Town):
+            changed_towns = set(towns)
+        print('...' + selected_county + ' changed towns: ' + str(sorted(changed_towns)))
+    else:
+        changed_towns = set(towns)
+
+    county_data = app.encode_data_store(df_cleaned_towns)
+
+    key = ('county', selected_state, selected_county, 'data')
+    entries[get_artifact_name(key)] = write_artifact(build_dir, key, {'town_options': df_towns.Town.unique(),
+                                                                      'county_data': county_data})
+
+    key = ('county', selected_state, selected_county, 'table')
+    entries[get_artifact_name(key)] = write_artifact(build_dir, key,
+                                                     app.create_town_table_store(df_cleaned_towns, selected_state))
+
+    key = ('county', selected_state, selected_county, 'map')
+    entries[get_artifact_name(key)] = write_artifact(build_dir, key, app.create_county_map_from_state_data(
+        df_cleaned_towns, selected_state, selected_county))
+
+    locations_field = app.df_StateWQData.loc[(app.df_StateWQData.State == selected_state) &
+                                             (app.df_StateWQData.CountyName == selected_county),
+                                             'GeoidPropertyName'].iloc[0]
+    key = ('county', selected_state, selected_county, 'outline')
+    entries[get_artifact_name(key)] = write_artifact(build_dir, key, app.create_county_outline_json(
+        app.get_county_json_for_state(selected_state, selected_county), df_cleaned_towns[locations_field]))
+
+    df_markers = app.load_state_historical_markers(selected_state)
+    county_json = app.get_county_json_for_state(selected_state, selected_county)
+
+    for selected_town in towns:
+        if selected_town not in changed_towns:
+            continue
+        key = ('town', selected_state, selected_county, selected_town)
+        entries[get_artifact_name(key)] = write_artifact(build_dir, key, app.create_town_view(
+            df_cleaned_towns, df_markers, county_json, selected_state, selected_county, selected_town))
+
+    return entries, towns, county_data
+
+
+def merge_county_entries(manifest, selected_state, selected_county, entries, towns):
+    # Town views of towns that left the county go away; unchanged towns keep their earlier artifacts.
+    town_prefix = get_artifact_name(('town', selected_state, selected_county)) + '/'
+    current_towns = {town_prefix + town for town in towns}
+    for name in [name for name in manifest['artifacts'] if name.startswith(town_prefix)]:
+        if name not in current_towns:
+            del manifest['artifacts'][name]
+
+    manifest['artifacts'].update(entries)
+    manifest['data_versions'][get_artifact_name(('county', selected_state, selected_county))] = manifest['version']
+
+
+def get_entry_state(name):
+    # The state of a 'state/...', 'county/...' or 'town/...' artifact or data version name; None for build-wide ones
+    # such as the search index.
+    parts = name.split('/')
+    return parts[1] if parts[0] in ('state', 'county', 'town') and len(parts) > 1 else None
+
+
+def build_search_entries(manifest, county_towns):
+    # Every county of every state and the towns of each, from this build or, for counties it did not rebuild, from
+    # the county artifacts it carries over. Counties with neither are searchable by name only.
+    entries = []
+    for selected_state in app.states:
+        if selected_state == 'New England':
+            continue
+        for selected_county in get_registry_counties(selected_state):
+            entries.append((selected_state, selected_county, None))
+            towns = county_towns.get((selected_state, selected_county))
+            if towns is None and get_artifact_name(('county', selected_state, selected_county, 'data')) in \
+                    manifest['artifacts']:
+                towns = read_artifact('county', selected_state, selected_county, 'data')['town_options']
+            entries += [(selected_state, selected_county, town) for town in towns or [] if isinstance(town, str)]
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute WandrerQuest maps and tables as static artifacts.')
+    parser.add_argument('--state', action='append', help='state to build; repeat for several (default: all)')
+    parser.add_argument('--workers', type=int, default=None, help='county build processes (default: CPU count)')
+    parser.add_argument('--refresh', action='store_true',
+                        help='rebuild only what changed since the current build (default: rebuild everything)')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    app.refresh_shared_cache = True
+    selected_states = args.state or list(app.states)
+    build_dir = create_build_dir()
+    previous_manifest = get_current_manifest() if args.refresh or args.state else None
+    # Counties whose build failed keep stale artifacts while their state's summary moves on, so a later refresh
+    # would see their rows as unchanged; they are listed here and always rebuilt by the next refresh.
+    manifest = {'version': os.path.basename(build_dir), 'artifacts': {}, 'data_versions': {}, 'failed_counties': []}
+    previous_failures = set()
+    if previous_manifest:
+        previous_failures = {tuple(county) for county in previous_manifest.get('failed_counties', [])}
+        manifest['failed_counties'] = [list(county) for county in sorted(previous_failures)
+                                       if county[0] not in selected_states]
+        # A refresh starts from everything in the current build; a full build of some states keeps the others'.
+        for field in ('artifacts', 'data_versions'):
+            manifest[field].update({name: value for name, value in previous_manifest[field].items()
+                                    if args.refresh or get_entry_state(name) not in selected_states})
+    failures = []
+    # What changed in this build, recorded in the history once the build is published.
+    snapshots = {}
+    county_towns = {}
+    built_county_data = {}
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {}
+        for selected_state in selected_states:
+            df_summary = app.load_state_summary(selected_state)
+            registry_counties = get_registry_counties(selected_state)
+
+            failed_counties = {county for state, county in previous_failures if state == selected_state}
+            previous_summary = args.refresh and previous_manifest and read_artifact('state', selected_state, 'summary')
+            if previous_summary:
+                changed_counties = app.get_changed_rows(app.decode_data_store(previous_summary['summary_data']),
+                                                    df_summary.dropna(), 'County')
+                if not changed_counties and not failed_counties:
+                    print('...' + selected_state + ' unchanged')
+                    continue
+                # Counties never built before, or whose last build failed, are built now even if their summary row
+                # did not change.
+                counties = [county for county in registry_counties if county in changed_counties or
+                            county in failed_counties or not read_artifact('county', selected_state, county, 'data')]
+            else:
+                changed_counties = True
+                counties = registry_counties
+
+            if changed_counties:
+                summary_data, entries = build_state(build_dir, selected_state, df_summary)
+                manifest['artifacts'].update(entries)
+                manifest['data_versions'][get_artifact_name(('state', selected_state))] = manifest['version']
+            else:
+                print('...' + selected_state + ' summary unchanged; retrying ' + str(sorted(failed_counties)))
+                summary_data = previous_summary['summary_data']
+            snapshots[selected_state] = {'counties': df_summary.dropna(), 'towns': []}
+
+            # County drill-down is not wired up for the region view, same as county_dropdown_clicked.
+            if selected_state == 'New England':
+                continue
+
+            for selected_county in counties:
+                previous_county = args.refresh and previous_manifest and read_artifact('county', selected_state,
+                                                                                       selected_county, 'data')
+                # A failed county is rebuilt whole, since its artifacts may be older than the previous build.
+                future = executor.submit(build_county, build_dir, selected_state, selected_county, summary_data,
+                                         previous_county['county_data'] if previous_county and
+                                         selected_county not in failed_counties else None)
+                futures[future] = (selected_state, selected_county)
+
+        for future in concurrent.futures.as_completed(futures):
+            selected_state, selected_county = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print('...failed to build ' + selected_state + ' / ' + selected_county + ': ' + repr(e))
+                failures.append(futures[future])
+                manifest['failed_counties'].append([selected_state, selected_county])
+                continue
+            if result:
+                entries, towns, county_data = result
+                merge_county_entries(manifest, selected_state, selected_county, entries, towns)
+                county_towns[(selected_state, selected_county)] = [str(town) for town in towns]
+                built_county_data.setdefault(selected_state, {})[selected_county] = county_data
+                snapshots[selected_state]['towns'].append(app.decode_data_store(county_data))
+
+    for selected_state in snapshots:
+        if selected_state != 'New England':
+            manifest['artifacts'].update(build_state_towns(build_dir, manifest, selected_state,
+                                                           built_county_data.get(selected_state, {})))
+
+    key = ('search', 'index')
+    manifest['artifacts'][get_artifact_name(key)] = write_artifact(
+        build_dir, key, {'entries': build_search_entries(manifest, county_towns)})
+
+    publish_build(build_dir, manifest)
+    for selected_state, snapshot in snapshots.items():
+        append_snapshot(selected_state, manifest['version'], snapshot['counties'],
+                        pd.concat(snapshot['towns'], ignore_index=True) if snapshot['towns'] else None)
+    print('\npublished build ' + manifest['version'] + ' with ' + str(len(manifest['artifacts'])) + ' artifacts in ' +
+          str(round(time.perf_counter() - start, 1)) + 's')
+    if failures:
+        print('...counties that will be built live or keep their previous artifacts until the next refresh: ' +
+              str(failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+# Ingests GPX/FIT ride files and works out the miles covered in every town, the numbers the workbooks keep by hand
+# in 'Actual (mi)'. Run from src/, like the app:
+#
+#     python rides.py --state 'New Hampshire' ~/rides/*.gpx ~/rides/*.fit [--workers 8]
+#
+# Every track is cut into fix-to-fix segments, split into pieces no longer than a cell, and each piece is placed in
+# the town polygon its midpoint falls in, looked up in bulk through an STRtree. Road already ridden is not counted
+# twice: pieces are bucketed into small lat/lon cells, and only cells no earlier ride went through add miles.
+# Progress is kept in ../data/rides, so running again only reads the new files. When ../data/rides/<state>.feather
+# exists the app uses its miles in place of the workbook's (see apply_ride_coverage_to_towns in app.py).
+
+import argparse
+import concurrent.futures
+import gzip
+import os
+import pickle
+import time
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pandas as pd
+import shapely
+
+import app
+
+earth_radius_miles = 3958.8
+# ~11 m north-south; two passes through the same cell are taken to be the same stretch of road.
+cell_degrees = 1e-4
+# A cell holds at most its diagonal of road, so stops and loops inside one cell do not add miles.
+cell_max_miles = 0.0095
+# Longer hops are GPS dropouts or a paused recording, not road.
+segment_max_miles = 0.25
+# Segments are split into pieces shorter than a cell's ~11 m side, so a long hop from a smart-recording device marks
+# every cell it crosses, the same cells a 1 Hz recording of that road would.
+piece_max_miles = 0.005
+pending_max_cells = 1000000
+
+town_tree = None
+
+
+def read_gpx_points(track_file):
+    # Streams the file so large exports never sit in memory as a tree.
+    opener = gzip.open if track_file.endswith('.gz') else open
+    points = []
+    with opener(track_file, 'rb') as f:
+        for event, elem in ET.iterparse(f):
+            if elem.tag.endswith('}trkpt') or elem.tag == 'trkpt':
+                points.append((float(elem.get('lat')), float(elem.get('lon'))))
+                elem.clear()
+    return np.array(points, dtype=np.float64).reshape(-1, 2)
+
+
+def read_fit_points(track_file):
+    import fitparse  # only needed for FIT files
+
+    semicircles = 180 / 2 ** 31
+    points = []
+    for record in fitparse.FitFile(track_file).get_messages('record'):
+        values = record.get_values()
+        if values.get('position_lat') is not None and values.get('position_long') is not None:
+            points.append((values['position_lat'] * semicircles, values['position_long'] * semicircles))
+    return np.array(points, dtype=np.float64).reshape(-1, 2)
+
+
+def read_track_points(track_file):
+    name = track_file.lower()
+    if name.endswith('.gpx') or name.endswith('.gpx.gz'):
+        return read_gpx_points(track_file)
+    if name.endswith('.fit'):
+        return read_fit_points(track_file)
+    raise ValueError('unsupported track file: ' + track_file)
+
+
+def get_track_segments(points):
+    # Midpoints and haversine lengths of the pieces of every fix-to-fix segment, all at once.
+    lat = np.radians(points[:, 0])
+    lon = np.radians(points[:, 1])
+    dlat = lat[1:] - lat[:-1]
+    dlon = lon[1:] - lon[:-1]
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(dlon / 2) ** 2
+    miles = 2 * earth_radius_miles * np.arcsin(np.sqrt(a))
+
+    keep = np.flatnonzero(miles < segment_max_miles)
+    pieces = np.maximum(np.ceil(miles[keep] / piece_max_miles), 1).astype(np.int64)
+    segment_index = np.repeat(keep, pieces)
+    # Position of each piece's midpoint along its segment: 0.5 / n, 1.5 / n, ...
+    starts = np.cumsum(pieces) - pieces
+    fraction = (np.arange(len(segment_index)) - np.repeat(starts, pieces) + 0.5) / np.repeat(pieces, pieces)
+
+    start, end = points[:-1][segment_index], points[1:][segment_index]
+    mid_lat = start[:, 0] + (end[:, 0] - start[:, 0]) * fraction
+    mid_lon = start[:, 1] + (end[:, 1] - start[:, 1]) * fraction
+    return mid_lat, mid_lon, np.repeat(miles[keep] / pieces, pieces)
+
+
+def get_cell_keys(lat, lon):
+    lat_cells = np.floor(lat / cell_degrees).astype(np.int64)
+    lon_cells = np.floor(lon / cell_degrees).astype(np.int64)
+    return (lat_cells << 32) | (lon_cells & 0xffffffff)
+
+
+def is_covered(cells, covered):
+    # covered is sorted and unique.
+    index = np.minimum(np.searchsorted(covered, cells), max(len(covered) - 1, 0))
+    return covered[index] == cells if len(covered) else np.zeros(len(cells), dtype=bool)
+
+
+def load_town_polygons(selected_state):
+    # Town polygons of every registry county keyed by (County, Town); features are matched to towns on the
+    # county's GeoidPropertyName, the same way the county maps are drawn.
+    print('\nfunction load_town_polygons for ' + selected_state)
+    df_summary = app.load_state_summary(selected_state)
+    summary_data = app.encode_data_store(df_summary.dropna())
+    df_state = app.df_StateWQData.loc[(app.df_StateWQData.State == selected_state) &
+                                      app.df_StateWQData.CountyName.notna()]
+
+    polygons = []
+    keys = []
+    frames = []
+    for selected_county, locations_field in zip(df_state.CountyName, df_state.GeoidPropertyName):
+        df_towns = app.load_county_by_name(selected_state, selected_county, summary_data,
+                                           ride_coverage=False).dropna()
+        frames.append(df_towns[['County', 'Town', '25 Pct', 'Actual (mi)']].astype({'County': str, 'Town': str}))
+        towns = dict(zip(df_towns[locations_field], df_towns.Town.astype(str)))
+
+        geometry = app.load_geometry_json(app.get_county_geometry_file(selected_state, selected_county))
+        for feature in geometry['features']:
+            town = towns.get(feature['properties'].get(locations_field))
+            if town is not None:
+                polygons.append(shapely.geometry.shape(feature['geometry']))
+                keys.append((selected_county, town))
+
+    return polygons, keys, pd.concat(frames, ignore_index=True)
+
+
+def init_worker(polygons_wkb):
+    global town_tree
+    town_tree = shapely.STRtree(shapely.from_wkb(polygons_wkb))
+
+
+def ingest_file(track_file):
+    # Runs in a pool process. Returns the cells the ride went through, each with its town and miles, or None for a
+    # file that could not be read.
+    try:
+        points = read_track_points(track_file)
+    except Exception as e:
+        print('...skipping ' + track_file + ': ' + repr(e))
+        return track_file, None
+    if len(points) < 2:
+        return track_file, (np.empty(0, np.int64), np.empty(0, np.int32), np.empty(0, np.float64))
+
+    mid_lat, mid_lon, miles = get_track_segments(points)
+    segment_index, town_index = town_tree.query(shapely.points(mid_lon, mid_lat), predicate='within')
+    # A midpoint on a shared border can land in two towns; it counts for the first.
+    segment_index, first = np.unique(segment_index, return_index=True)
+    town_index = town_index[first]
+
+    cells = get_cell_keys(mid_lat[segment_index], mid_lon[segment_index])
+    cells, inverse, first = np.unique(cells, return_inverse=True, return_index=True)
+    cell_miles = np.minimum(np.bincount(inverse, weights=miles[segment_index]), cell_max_miles)
+    return track_file, (cells, town_index[first].astype(np.int32), cell_miles)
+
+
+def get_progress_file(selected_state):
+    return os.path.join(app.ride_coverage_dir, selected_state + '.pkl')
+
+
+def load_progress(selected_state):
+    try:
+        with open(get_progress_file(selected_state), 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return {'files': {}, 'cells': np.empty(0, np.int64), 'miles': {}}
+
+
+def save_progress(selected_state, progress):
+    tmp_file = get_progress_file(selected_state) + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(progress, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, get_progress_file(selected_state))
+
+
+def write_coverage(selected_state, progress, df_towns):
+    # One row per town, with the town's 25% target so the app can recount Pct Towns Cycled from it. Towns no ride
+    # went through keep the workbook's miles, so a first ingest does not zero the rest of the state.
+    ride_miles = pd.Series(progress['miles'], dtype='float64')
+    keys = pd.MultiIndex.from_arrays([df_towns.County, df_towns.Town])
+    df_coverage = df_towns.copy()
+    df_coverage['Actual (mi)'] = ride_miles.reindex(keys).fillna(df_towns['Actual (mi)'].set_axis(keys)).to_numpy()
+    tmp_file = app.get_ride_coverage_file(selected_state) + '.tmp'
+    df_coverage.reset_index(drop=True).to_feather(tmp_file)
+    os.replace(tmp_file, app.get_ride_coverage_file(selected_state))
+    return df_coverage
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute per-town coverage miles from GPX/FIT ride files.')
+    parser.add_argument('track_files', nargs='+', help='.gpx, .gpx.gz or .fit files')
+    parser.add_argument('--state', required=True, help='state whose towns the rides are counted against')
+    parser.add_argument('--workers', type=int, default=None, help='file parsing processes (default: CPU count)')
+    parser.add_argument('--rebuild', action='store_true', help='forget earlier runs and count every file again')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    os.makedirs(app.ride_coverage_dir, exist_ok=True)
+    progress = {'files': {}, 'cells': np.empty(0, np.int64), 'miles': {}} if args.rebuild \
+        else load_progress(args.state)
+
+    track_files = [track_file for track_file in args.track_files
+                   if progress['files'].get(os.path.abspath(track_file)) != os.path.getmtime(track_file)]
+    print('...' + str(len(track_files)) + ' new or changed of ' + str(len(args.track_files)) + ' files')
+
+    polygons, keys, df_towns = load_town_polygons(args.state)
+    town_miles = np.zeros(len(keys))
+    # Cells ridden since covered was last merged; kept small so checking a file stays cheap.
+    pending = np.empty(0, np.int64)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                                                initargs=(shapely.to_wkb(polygons),)) as executor:
+        for track_file, result in executor.map(ingest_file, track_files, chunksize=16):
+            if result is None:
+                continue
+            cells, town_index, cell_miles = result
+            # Cells ridden by an earlier file, in this run or a previous one, add nothing.
+            new = ~(is_covered(cells, progress['cells']) | is_covered(cells, pending))
+            np.add.at(town_miles, town_index[new], cell_miles[new])
+            pending = np.union1d(pending, cells[new])
+            if len(pending) > pending_max_cells:
+                progress['cells'] = np.union1d(progress['cells'], pending)
+                pending = pending[:0]
+            progress['files'][os.path.abspath(track_file)] = os.path.getmtime(track_file)
+
+    progress['cells'] = np.union1d(progress['cells'], pending)
+    for key, miles in zip(keys, town_miles):
+        if miles:
+            progress['miles'][key] = progress['miles'].get(key, 0) + miles
+
+    save_progress(args.state, progress)
+    df_coverage = write_coverage(args.state, progress, df_towns)
+    print('\ningested ' + str(len(track_files)) + ' files in ' + str(round(time.perf_counter() - start, 1)) + 's: ' +
+          str(round(town_miles.sum(), 1)) + ' new miles, ' + str(round(df_coverage['Actual (mi)'].sum(), 1)) +
+          ' covered in ' + args.state)
+
+
+if __name__ == '__main__':
+    main()
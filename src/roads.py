@@ -0,0 +1,243 @@
+# Measures the rideable road miles in every town from a local OpenStreetMap extract, the numbers the workbooks keep
+# in 'Total (mi)' and '25 Pct'. Run from src/, like the app:
+#
+#     python roads.py --state 'New Hampshire' new-hampshire-latest.osm.pbf [--workers 4] [--rebuild]
+#
+# The extract is streamed once into a table of rideable ways (.osm.pbf needs pyosmium; .osm.xml and .osm.xml.gz
+# are read with the standard library). Each county then cuts those ways at its town boundaries in its own process.
+# Ways and finished counties are kept under ../data/roads/<state>, so an interrupted run picks up at the county it
+# stopped on. When ../data/roads/<state>.feather exists the app uses its miles in place of the workbook's.
+
+import argparse
+import array
+import concurrent.futures
+import gzip
+import os
+import time
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pandas as pd
+import shapely
+
+import app
+from rides import load_town_polygons
+
+# Roads a bike may use; motorways and ways tagged against bikes or the public are left out.
+rideable_highways = {'trunk', 'trunk_link', 'primary', 'primary_link', 'secondary', 'secondary_link', 'tertiary',
+                     'tertiary_link', 'unclassified', 'residential', 'living_street', 'road', 'service', 'track',
+                     'cycleway', 'path'}
+excluded_services = {'driveway', 'parking_aisle', 'drive-through'}
+excluded_access = {'no', 'private'}
+miles_per_degree_latitude = 69.05
+target_fraction = 0.25
+
+
+def is_rideable(tags):
+    if tags.get('highway') not in rideable_highways or tags.get('area') == 'yes':
+        return False
+    if tags.get('service') in excluded_services:
+        return False
+    return tags.get('access') not in excluded_access and tags.get('bicycle') not in excluded_access
+
+
+def read_xml_ways(extract_file):
+    # Nodes come before ways in an .osm file, so node coordinates are collected first into flat arrays and looked up
+    # by id once all ways are known.
+    opener = gzip.open if extract_file.endswith('.gz') else open
+    node_ids = array.array('q')
+    node_lons = array.array('d')
+    node_lats = array.array('d')
+    way_refs = array.array('q')
+    way_sizes = []
+
+    with opener(extract_file, 'rb') as f:
+        for event, elem in ET.iterparse(f):
+            if elem.tag == 'node':
+                node_ids.append(int(elem.get('id')))
+                node_lons.append(float(elem.get('lon')))
+                node_lats.append(float(elem.get('lat')))
+                elem.clear()
+            elif elem.tag == 'way':
+                tags = {tag.get('k'): tag.get('v') for tag in elem.iter('tag')}
+                if is_rideable(tags):
+                    refs = [int(nd.get('ref')) for nd in elem.iter('nd')]
+                    way_refs.extend(refs)
+                    way_sizes.append(len(refs))
+                elem.clear()
+            elif elem.tag == 'relation':
+                elem.clear()
+
+    node_ids = np.frombuffer(node_ids, dtype=np.int64)
+    order = np.argsort(node_ids)
+    index = order[np.minimum(np.searchsorted(node_ids, way_refs, sorter=order), len(order) - 1)]
+    coords = np.column_stack([np.frombuffer(node_lons)[index], np.frombuffer(node_lats)[index]])
+    # Ways that reference nodes outside the extract are dropped whole.
+    found = node_ids[index] == np.frombuffer(way_refs, dtype=np.int64)
+    way_index = np.repeat(np.arange(len(way_sizes)), way_sizes)
+    complete = np.bincount(way_index, weights=~found, minlength=len(way_sizes)) == 0
+    return get_way_lines(coords, way_index, complete)
+
+
+def read_pbf_ways(extract_file):
+    import osmium  # only needed for .osm.pbf extracts
+
+    coords = []
+    way_sizes = []
+
+    class RideableWays(osmium.SimpleHandler):
+        def way(self, way):
+            if not is_rideable(way.tags):
+                return
+            try:
+                points = [(node.lon, node.lat) for node in way.nodes]
+            except osmium.InvalidLocationError:
+                return
+            coords.extend(points)
+            way_sizes.append(len(points))
+
+    RideableWays().apply_file(extract_file, locations=True, idx='flex_mem')
+    way_index = np.repeat(np.arange(len(way_sizes)), way_sizes)
+    return get_way_lines(np.array(coords, dtype=np.float64).reshape(-1, 2), way_index,
+                         np.ones(len(way_sizes), dtype=bool))
+
+
+def get_way_lines(coords, way_index, complete):
+    keep = complete[way_index]
+    coords = coords[keep]
+    way_index = way_index[keep]
+    # A linestring needs two distinct points; single-node ways are mapping errors.
+    sizes = np.bincount(way_index, minlength=len(complete))
+    keep = sizes[way_index] >= 2
+    # shapely wants the kept ways numbered 0..n-1 with none skipped.
+    way_numbers = np.unique(way_index[keep], return_inverse=True)[1]
+    return shapely.linestrings(coords[keep], indices=way_numbers)
+
+
+def read_ways(extract_file):
+    name = extract_file.lower()
+    if name.endswith('.osm.pbf'):
+        return read_pbf_ways(extract_file)
+    if name.endswith('.osm') or name.endswith('.osm.xml') or name.endswith('.osm.gz') or name.endswith('.osm.xml.gz'):
+        return read_xml_ways(extract_file)
+    raise ValueError('unsupported extract: ' + extract_file)
+
+
+def get_miles(lines):
+    # Lengths in miles of lon/lat lines, each segment's longitude scaled by the cosine of its own mid-latitude.
+    # Multi-part results of an intersection are split first, so their parts are not joined end to end.
+    parts, line_index = shapely.get_parts(lines, return_index=True)
+    coords, part_index = shapely.get_coordinates(parts, return_index=True)
+    same_part = part_index[1:] == part_index[:-1]
+    mid_lat = np.radians((coords[1:, 1] + coords[:-1, 1]) / 2)
+    segment_miles = np.hypot(np.diff(coords[:, 0]) * np.cos(mid_lat), np.diff(coords[:, 1])) * miles_per_degree_latitude
+    part_miles = np.bincount(part_index[1:][same_part], weights=segment_miles[same_part], minlength=len(parts))
+    return np.bincount(line_index, weights=part_miles, minlength=len(lines))
+
+
+def get_state_dir(selected_state):
+    return os.path.join(app.road_miles_dir, selected_state)
+
+
+def get_ways_file(selected_state):
+    return os.path.join(get_state_dir(selected_state), 'ways.feather')
+
+
+def get_county_file(selected_state, selected_county):
+    return os.path.join(get_state_dir(selected_state), selected_county + '.feather')
+
+
+def write_feather(df, path):
+    tmp_file = path + '.tmp'
+    df.reset_index(drop=True).to_feather(tmp_file)
+    os.replace(tmp_file, path)
+
+
+def load_ways(selected_state, extract_file, rebuild):
+    # The ways table is reused until the extract changes.
+    ways_file = get_ways_file(selected_state)
+    if not rebuild and os.path.exists(ways_file) and os.path.getmtime(ways_file) >= os.path.getmtime(extract_file):
+        print('...reusing ' + ways_file)
+        return
+    print('\nfunction load_ways from ' + extract_file)
+    lines = read_ways(extract_file)
+    write_feather(pd.DataFrame({'geometry': shapely.to_wkb(lines)}), ways_file)
+    print('...' + str(len(lines)) + ' rideable ways')
+
+
+def measure_county(selected_state, selected_county, polygons_wkb, towns):
+    # Runs in a pool process. Ways wholly inside a town count at full length; only ways crossing its boundary are
+    # intersected, which is a small share of them.
+    print('\nfunction measure_county for ' + selected_county)
+    polygons = shapely.from_wkb(polygons_wkb)
+    shapely.prepare(polygons)
+    lines = shapely.from_wkb(pd.read_feather(get_ways_file(selected_state)).geometry.to_numpy())
+
+    town_index, line_index = shapely.STRtree(lines).query(polygons, predicate='intersects')
+    inside = shapely.contains_properly(polygons[town_index], lines[line_index])
+    miles = np.empty(len(line_index))
+    miles[inside] = get_miles(lines[line_index[inside]])
+    miles[~inside] = get_miles(shapely.intersection(lines[line_index[~inside]], polygons[town_index[~inside]]))
+
+    total = np.bincount(town_index, weights=miles, minlength=len(polygons))
+    df = pd.DataFrame({'County': selected_county, 'Town': towns, 'Total (mi)': total})
+    # A town drawn as several features is summed.
+    df = df.groupby(['County', 'Town'], as_index=False)['Total (mi)'].sum()
+    df['25 Pct'] = df['Total (mi)'] * target_fraction
+    write_feather(df, get_county_file(selected_state, selected_county))
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute per-town road miles from an OpenStreetMap extract.')
+    parser.add_argument('extract_file', help='.osm.pbf, .osm.xml or .osm.xml.gz extract covering the state')
+    parser.add_argument('--state', required=True, help='state whose towns are measured')
+    parser.add_argument('--workers', type=int, default=None, help='county processes (default: CPU count)')
+    parser.add_argument('--rebuild', action='store_true', help='re-read the extract and measure every county again')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    os.makedirs(get_state_dir(args.state), exist_ok=True)
+    load_ways(args.state, args.extract_file, args.rebuild)
+    ways_mtime = os.path.getmtime(get_ways_file(args.state))
+
+    polygons, keys, df_towns = load_town_polygons(args.state)
+    counties = {}
+    for polygon, (selected_county, town) in zip(polygons, keys):
+        county_polygons, towns = counties.setdefault(selected_county, ([], []))
+        county_polygons.append(polygon)
+        towns.append(town)
+
+    frames = []
+    failures = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {}
+        for selected_county, (county_polygons, towns) in counties.items():
+            county_file = get_county_file(args.state, selected_county)
+            if os.path.exists(county_file) and os.path.getmtime(county_file) >= ways_mtime:
+                print('...' + selected_county + ' already measured')
+                frames.append(pd.read_feather(county_file))
+                continue
+            future = executor.submit(measure_county, args.state, selected_county, shapely.to_wkb(county_polygons),
+                                     towns)
+            futures[future] = selected_county
+
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                frames.append(future.result())
+            except Exception as e:
+                print('...failed to measure ' + futures[future] + ': ' + repr(e))
+                failures.append(futures[future])
+
+    if failures:
+        print('\nnot writing ' + app.get_road_miles_file(args.state) + '; run again to retry ' + str(failures))
+        return
+
+    df_road_miles = pd.concat(frames, ignore_index=True)
+    write_feather(df_road_miles, app.get_road_miles_file(args.state))
+    print('\nmeasured ' + str(len(df_road_miles)) + ' towns in ' + str(round(time.perf_counter() - start, 1)) +
+          's: ' + str(round(df_road_miles['Total (mi)'].sum(), 1)) + ' road miles in ' + args.state)
+
+
+if __name__ == '__main__':
+    main()
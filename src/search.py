@@ -0,0 +1,95 @@
+# Search over the town and county names of every configured state, behind the town search dropdown.
+#
+# An index is built from (state, county, town) entries, town being None for the county itself. Names match on the
+# start of any of their words (so 'new d' finds 'New Durham'); queries that match too little fall back to trigram
+# candidates ranked by similarity, which catches typos such as 'merideth'.
+
+import bisect
+import difflib
+import re
+import unicodedata
+
+fuzzy_min_ratio = 0.6
+
+
+def normalize(name):
+    name = unicodedata.normalize('NFKD', str(name)).encode('ascii', 'ignore').decode('ascii')
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', name.lower()).split())
+
+
+def get_trigrams(text):
+    text = '  ' + text + ' '
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def get_entry_label(entry):
+    selected_state, selected_county, selected_town = entry
+    if selected_town:
+        return selected_town + ', ' + selected_county + ' County, ' + selected_state
+    return selected_county + ' County, ' + selected_state
+
+
+def build_search_index(entries):
+    entries = sorted(set(tuple(entry) for entry in entries), key=lambda entry: (entry[2] is not None, entry))
+    names = [normalize(entry[2] or entry[1]) for entry in entries]
+
+    # Every word of every name with the entry it belongs to, sorted, so a prefix is a bisect away.
+    words = sorted((word, i) for i, name in enumerate(names) for word in set(name.split()))
+    trigrams = {}
+    for i, name in enumerate(names):
+        for trigram in get_trigrams(name):
+            trigrams.setdefault(trigram, []).append(i)
+
+    return {'entries': entries, 'labels': [get_entry_label(entry) for entry in entries], 'names': names,
+            'words': words, 'word_keys': [word for word, i in words], 'trigrams': trigrams}
+
+
+def get_prefix_matches(index, query):
+    # Entries where each query word starts some word of the name, best first: the name itself, the name's start,
+    # then any word's start.
+    query_words = query.split()
+    start = bisect.bisect_left(index['word_keys'], query_words[0])
+    candidates = set()
+    for word, i in index['words'][start:]:
+        if not word.startswith(query_words[0]):
+            break
+        candidates.add(i)
+
+    ranked = []
+    for i in candidates:
+        name = index['names'][i]
+        name_words = name.split()
+        if all(any(word.startswith(query_word) for word in name_words) for query_word in query_words[1:]):
+            rank = 0 if name == query else 1 if name.startswith(query) else 2
+            ranked.append((rank, name, i))
+    return [i for rank, name, i in sorted(ranked)]
+
+
+def get_fuzzy_matches(index, query, exclude):
+    query_trigrams = get_trigrams(query)
+    counts = {}
+    for trigram in query_trigrams:
+        for i in index['trigrams'].get(trigram, ()):
+            counts[i] = counts.get(i, 0) + 1
+
+    # Only names sharing a third of the query's trigrams are worth comparing character by character.
+    ranked = []
+    for i, count in counts.items():
+        if i in exclude or count * 3 < len(query_trigrams):
+            continue
+        ratio = difflib.SequenceMatcher(None, query, index['names'][i]).ratio()
+        if ratio >= fuzzy_min_ratio:
+            ranked.append((-ratio, i))
+    return [i for ratio, i in sorted(ranked)]
+
+
+def search(index, query, limit=10):
+    # Returns (label, (state, county, town)) of the best matches.
+    query = normalize(query)
+    if not query:
+        return []
+
+    matches = get_prefix_matches(index, query)[:limit]
+    if len(matches) < limit and len(query) >= 3:
+        matches += get_fuzzy_matches(index, query, set(matches))[:limit - len(matches)]
+    return [(index['labels'][i], index['entries'][i]) for i in matches]
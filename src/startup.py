@@ -0,0 +1,99 @@
+# Boot-time profile of app.py: how long each startup step takes before `server` is ready, and which imports the
+# time goes to. app.py calls startup_step() as each step ends and startup_finished() once `server` is ready; the
+# recorded steps are served at /debug/boot-profile when app.py's debug routes are on. Run from src/ to profile a
+# cold start in a fresh interpreter:
+#
+#     python startup.py [--imports 15]
+#
+# Imports are measured with python -X importtime and charged to the import line of app.py that first pulled them in.
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+# Counted from the first import of this module, which is app.py's first line.
+boot_start = time.perf_counter()
+boot_steps = []
+boot_last_mark = boot_start
+boot_ready = None
+
+
+def startup_step(name):
+    # Charges the time since the previous step ended (or since boot started) to name.
+    global boot_last_mark
+    now = time.perf_counter()
+    boot_steps.append((name, (now - boot_last_mark) * 1000))
+    boot_last_mark = now
+
+
+def startup_finished(name):
+    global boot_ready
+    startup_step(name)
+    boot_ready = (boot_last_mark - boot_start) * 1000
+    print('\nfunction startup_finished: server ready in ' + str(round(boot_ready)) + ' ms')
+
+
+def get_boot_profile():
+    # Times in ms, from the start of app.py to `server` being ready.
+    return {'total_ms': round(boot_ready if boot_ready is not None else (time.perf_counter() - boot_start) * 1000, 1),
+            'steps': [{'step': name, 'ms': round(ms, 1)} for name, ms in boot_steps]}
+
+
+def parse_import_times(stderr, root='app'):
+    # (module, cumulative ms) of the modules root imports itself, from python -X importtime output. Each line reads
+    # 'import time: self [us] | cumulative | <indent>module', nested imports indented two more spaces than their parent
+    # and printed before it.
+    lines = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        lines.append((len(name) - len(name.lstrip()), name.strip(), int(cumulative_us)))
+
+    root_line = next((i for i, (indent, name, cumulative_us) in enumerate(lines) if name == root), None)
+    if root_line is None:
+        return []
+    root_indent = lines[root_line][0]
+    imports = []
+    for indent, name, cumulative_us in reversed(lines[:root_line]):
+        if indent <= root_indent:
+            break
+        if indent == root_indent + 2:
+            imports.append((name, cumulative_us / 1000))
+    return imports
+
+
+def profile_cold_start():
+    # Imports app in a fresh interpreter, so nothing is already loaded, and returns its boot profile and the time
+    # of each of its direct imports.
+    script = 'import json, startup; import app; print(json.dumps(startup.get_boot_profile()))'
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', script], capture_output=True, text=True)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    if result.returncode != 0:
+        raise RuntimeError('importing app failed:\n' + result.stderr[-2000:])
+    profile = json.loads(result.stdout.strip().splitlines()[-1])
+    return profile, parse_import_times(result.stderr), elapsed_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Profile a cold start of the WandrerQuest app.')
+    parser.add_argument('--imports', type=int, default=15, help='slowest direct imports to list')
+    args = parser.parse_args()
+
+    profile, imports, elapsed_ms = profile_cold_start()
+    print('\nProcess start to exit: {:,.0f} ms; app.py to server ready: {:,.0f} ms'.format(elapsed_ms,
+                                                                                           profile['total_ms']))
+    print('\nStartup steps')
+    for step in profile['steps']:
+        print('  {:<36} {:8,.1f} ms'.format(step['step'], step['ms']))
+
+    print('\nSlowest imports (cumulative, charged to the line of app.py that first imports them)')
+    for name, ms in sorted(imports, key=lambda item: -item[1])[:args.imports]:
+        print('  {:<36} {:8,.1f} ms'.format(name, ms))
+
+
+if __name__ == '__main__':
+    main()
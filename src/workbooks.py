@@ -0,0 +1,100 @@
+# Reads sheets of the WandrerQuest workbooks into frames. Columns are picked by header name rather than position, and
+# reading stops after the rows asked for, so a sheet's trailing notes and side calculations are never parsed.
+#
+# Two backends:
+#   calamine - python-calamine's Rust parser, used when it is installed
+#   openpyxl - openpyxl in read-only mode, which streams rows and reads only up to the last wanted column
+# benchmark_workbooks.py compares them on the real workbooks.
+
+import io
+import urllib.request
+
+import pandas as pd
+
+
+def read_rows_calamine(data, sheet_name, columns, max_rows):
+    from python_calamine import CalamineWorkbook
+
+    workbook = CalamineWorkbook.from_filelike(io.BytesIO(data))
+    if isinstance(sheet_name, int):
+        sheet = workbook.get_sheet_by_index(sheet_name)
+    else:
+        sheet = workbook.get_sheet_by_name(sheet_name)
+    rows = sheet.to_python(skip_empty_area=False, nrows=max_rows)
+    if not rows:
+        return [], []
+
+    header = [str(name).strip() for name in rows[0]]
+    indexes = get_column_indexes(header, columns, sheet_name)
+    # calamine reads blank cells as ''.
+    return [header[i] for i in indexes], [[None if row[i] == '' else row[i] for i in indexes] for row in rows[1:]]
+
+
+def read_rows_openpyxl(data, sheet_name, columns, max_rows):
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        sheet = workbook.worksheets[sheet_name] if isinstance(sheet_name, int) else workbook[sheet_name]
+        header_row = next(sheet.iter_rows(max_row=1, values_only=True), None)
+        if header_row is None:
+            return [], []
+
+        header = ['' if name is None else str(name).strip() for name in header_row]
+        indexes = get_column_indexes(header, columns, sheet_name)
+        rows = sheet.iter_rows(min_row=2, max_row=max_rows, max_col=max(indexes) + 1 if indexes else 1,
+                               values_only=True)
+        return [header[i] for i in indexes], [[row[i] if i < len(row) else None for i in indexes] for row in rows]
+    finally:
+        workbook.close()
+
+
+backends = {
+    'calamine': read_rows_calamine,
+    'openpyxl': read_rows_openpyxl,
+}
+
+
+def get_default_backend():
+    try:
+        import python_calamine  # noqa: F401
+        return 'calamine'
+    except ImportError:
+        return 'openpyxl'
+
+
+def get_column_indexes(header, columns, sheet_name):
+    # columns is (wanted, required): wanted columns are read when the sheet has them, required ones must be there.
+    # None reads every named column.
+    if columns is None:
+        return [i for i, name in enumerate(header) if name]
+
+    wanted, required = columns
+    missing = [name for name in required if name not in header]
+    if missing:
+        raise KeyError('sheet ' + str(sheet_name) + ' has no column ' + ', '.join(missing) + '; header is ' +
+                       str([name for name in header if name]))
+    # A wanted name heading two columns could mean either, so the sheet is refused rather than one picked.
+    repeated = [name for name in wanted if header.count(name) > 1]
+    if repeated:
+        raise ValueError('sheet ' + str(sheet_name) + ' has more than one column ' + ', '.join(repeated))
+    return [header.index(name) for name in wanted if name in header]
+
+
+def download_workbook(url):
+    print('\nfunction download_workbook')
+    with urllib.request.urlopen(url) as response:
+        return response.read()
+
+
+def read_sheet(data, sheet_name=0, columns=None, nrows=None, backend=None):
+    # data is the workbook's bytes. Whole-number floats become integers, the way pd.read_excel reads them.
+    read_rows = backends[backend or get_default_backend()]
+    header, rows = read_rows(data, sheet_name, columns, nrows + 1 if nrows is not None else None)
+    df = pd.DataFrame(rows, columns=header).infer_objects()
+
+    for field in df.columns:
+        values = df[field]
+        if values.dtype == 'float64' and values.notna().all() and (values % 1 == 0).all():
+            df[field] = values.astype('int64')
+    return df
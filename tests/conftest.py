@@ -0,0 +1,136 @@
+# Runs app.py against local fixtures: a scratch copy of the repo layout whose sources and geometry point back at
+# the repo, and OneDrive workbooks generated from the New Hampshire town boundaries, so no test touches the network or
+# the repo's own data, cache and artifacts.
+
+import io
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+fixture_counties = ['Belknap', 'Carroll', 'Cheshire', 'Coos', 'Grafton', 'Hillsborough', 'Merrimack', 'Rockingham',
+                    'Strafford', 'Sullivan']
+
+
+def pytest_addoption(parser):
+    parser.addoption('--update-budgets', action='store_true',
+                     help='re-record tests/payload_budgets.json from this run instead of checking against it')
+
+
+def get_county_sheet(selected_county):
+    path = os.path.join(repo_root, 'geojsonFiles', 'NewHampshire',
+                        'New_Hampshire_' + selected_county + '_County_Boundaries.json')
+    with open(path) as f:
+        features = json.load(f)['features']
+    n = len(features)
+    return pd.DataFrame({'County': selected_county,
+                         'Town': [feature['properties']['pbpNAME'] for feature in features],
+                         'Total (mi)': np.linspace(10, 90, n), '25 Pct': np.linspace(2.5, 22.5, n),
+                         'Actual Pct': np.linspace(0, .9, n), 'Actual (mi)': np.linspace(0, 80, n),
+                         'pbpFIPS': [feature['properties']['pbpFIPS'] for feature in features], 'Zoom': 10.5,
+                         'OBJECTID': [feature['properties']['OBJECTID'] for feature in features]})
+
+
+def create_fixture_workbook(changed_county=None):
+    # Every sheet the loaders read, with a column they do not ask for and a totals row under the data, the way the
+    # real workbooks have them. The same workbook stands in for every state's link. changed_county gets a mile more
+    # on its first town, as if it had been ridden since.
+    n = len(fixture_counties)
+    sheets = {'Summary': pd.DataFrame({'County': fixture_counties, 'Total (mi)': np.linspace(100, 900, n),
+                                       '25 Pct': np.linspace(25, 225, n), 'Actual Pct': np.linspace(.05, .6, n),
+                                       'Actual (mi)': np.linspace(5, 500, n), 'Total Towns': 10,
+                                       'Pct Towns Cycled': np.linspace(.1, 1, n),
+                                       'geoid': [33001 + 2 * i for i in range(n)],
+                                       'OBJECTID': [33001 + 2 * i for i in range(n)]})}
+    for selected_county in fixture_counties:
+        sheets[selected_county] = get_county_sheet(selected_county)
+    if changed_county:
+        sheets['Summary'].loc[sheets['Summary'].County == changed_county, 'Actual (mi)'] += 1
+        sheets[changed_county].loc[0, 'Actual (mi)'] += 1
+    sheets['Highway Markers'] = pd.DataFrame({'County': ['Belknap'], 'Town': ['Meredith'], 'Latitude': [43.6],
+                                              'Longitude': [-71.5], 'Marker Description': ['Fixture marker']})
+
+    data = io.BytesIO()
+    with pd.ExcelWriter(data, engine='openpyxl') as writer:
+        for name, df in sheets.items():
+            df.insert(1, 'Notes', '')
+            df = pd.concat([df, pd.DataFrame([{df.columns[0]: 'Totals'}])], ignore_index=True)
+            df.to_excel(writer, sheet_name=name, index=False)
+    return data.getvalue()
+
+
+def create_fixture_tree(root):
+    os.makedirs(os.path.join(root, 'geojsonFiles', 'NewHampshire'))
+    os.makedirs(os.path.join(root, 'data'))
+    # src/ itself is a real directory, since the app's '..' paths would otherwise resolve into the repo.
+    os.makedirs(os.path.join(root, 'src'))
+    for filename in os.listdir(os.path.join(repo_root, 'src')):
+        if filename.endswith('.py'):
+            os.symlink(os.path.join(repo_root, 'src', filename), os.path.join(root, 'src', filename))
+    os.symlink(os.path.join(repo_root, 'data', 'StateWQData.xlsx'), os.path.join(root, 'data', 'StateWQData.xlsx'))
+    for dirpath, dirnames, filenames in os.walk(os.path.join(repo_root, 'geojsonFiles')):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            os.symlink(path, os.path.join(root, os.path.relpath(path, repo_root)))
+
+    # The repo has no region geometry; New Hampshire's counties stand in for it.
+    with open(os.path.join(repo_root, 'geojsonFiles', 'New_Hampshire_County_Boundaries.geojson.json')) as f:
+        region = json.load(f)
+    for feature in region['features']:
+        feature['properties']['OBJECTID'] = feature['properties']['geoid']
+    with open(os.path.join(root, 'geojsonFiles', 'New_England_County_Boundaries.geojson.json'), 'w') as f:
+        json.dump(region, f)
+
+
+@pytest.fixture(scope='session')
+def wq_app(tmp_path_factory):
+    # The app module, imported from src/ of the fixture tree with the working directory it expects.
+    root = str(tmp_path_factory.mktemp('wandrerquest'))
+    create_fixture_tree(root)
+    workbook = create_fixture_workbook()
+
+    cwd = os.getcwd()
+    os.chdir(os.path.join(root, 'src'))
+    sys.path.insert(0, os.path.join(root, 'src'))
+    import workbooks
+    workbooks.download_workbook = lambda url: workbook
+    import app
+    yield app
+    os.chdir(cwd)
+
+
+@pytest.fixture
+def precompute(wq_app, monkeypatch):
+    # Runs precompute.py's main with the given arguments against the fixture tree; every build is removed afterwards,
+    # so other tests see the app without one. Workers are forked, so patches made here reach them.
+    import precompute as precompute_module
+    import artifacts
+
+    def run(*args, workbook=None, failing_county=None):
+        workbook = workbook or create_fixture_workbook()
+        monkeypatch.setattr(wq_app, 'download_workbook', lambda url: workbook)
+        load_county_by_name = wq_app.load_county_by_name
+
+        def load_county(selected_state, selected_county, *load_args, **kwargs):
+            if selected_county == failing_county:
+                raise RuntimeError('fixture failure')
+            return load_county_by_name(selected_state, selected_county, *load_args, **kwargs)
+
+        with monkeypatch.context() as m:
+            m.setattr(wq_app, 'load_county_by_name', load_county)
+            m.setattr(sys, 'argv', ['precompute.py', '--workers', '2'] + list(args))
+            precompute_module.main()
+        return artifacts.get_current_manifest()
+
+    yield run
+    wq_app.refresh_shared_cache = False
+    shutil.rmtree(artifacts.artifact_root, ignore_errors=True)
+    shutil.rmtree('../data/history', ignore_errors=True)
+    # Build ids are timestamps, so a later test's build can reuse one of these.
+    for cached in (artifacts.load_manifest, artifacts._read_artifact, wq_app.get_region_map, wq_app.load_search_index):
+        cached.cache_clear()
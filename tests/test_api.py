@@ -0,0 +1,44 @@
+# Conditional requests to the /api routes.
+
+import gzip
+
+
+def test_api_etag_per_encoding(wq_app):
+    client = wq_app.server.test_client()
+    identity = client.get('/api/New Hampshire/summary?format=csv')
+    compressed = client.get('/api/New Hampshire/summary?format=csv', headers={'Accept-Encoding': 'gzip'})
+    assert identity.status_code == compressed.status_code == 200
+    assert gzip.decompress(compressed.data) == identity.data
+    assert identity.headers['ETag'] != compressed.headers['ETag']
+
+    # Each tag only matches the encoding it was served with.
+    assert client.get('/api/New Hampshire/summary?format=csv',
+                      headers={'If-None-Match': identity.headers['ETag']}).status_code == 304
+    assert client.get('/api/New Hampshire/summary?format=csv',
+                      headers={'If-None-Match': identity.headers['ETag'], 'Accept-Encoding': 'gzip'}).status_code == 200
+
+
+def test_api_refused_gzip_is_not_sent(wq_app):
+    client = wq_app.server.test_client()
+    response = client.get('/api/New Hampshire/summary', headers={'Accept-Encoding': 'gzip;q=0, identity'})
+    assert 'Content-Encoding' not in response.headers
+    assert response.get_json()
+
+
+def test_frame_tag_follows_row_order(wq_app):
+    df, data_tag = wq_app.get_api_summary('New Hampshire')
+    assert wq_app.get_frame_tag(df) == data_tag
+    assert wq_app.get_frame_tag(df) != wq_app.get_frame_tag(df.iloc[::-1])
+
+
+def test_api_etag_from_published_build(wq_app, precompute):
+    manifest = precompute('--state', 'New Hampshire')
+    response = wq_app.server.test_client().get('/api/New Hampshire/Belknap/towns')
+    assert response.headers['ETag'].strip('"').startswith(
+        manifest['artifacts']['county/New Hampshire/Belknap/data']['sha1'] + '-json')
+
+
+def test_api_towns_of_region_not_found(wq_app):
+    client = wq_app.server.test_client()
+    assert client.get('/api/New England/Belknap/towns').status_code == 404
+    assert client.get('/api/New Hampshire/Belknap/towns').status_code == 200
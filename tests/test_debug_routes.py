@@ -0,0 +1,19 @@
+# The /debug routes, which answer only when turned on.
+
+
+def test_cache_memory_is_hidden_by_default(wq_app, monkeypatch):
+    client = wq_app.server.test_client()
+    assert client.get('/debug/cache-memory').status_code == 404
+
+    monkeypatch.setattr(wq_app, 'debug_routes', True)
+    report = client.get('/debug/cache-memory').get_json()
+    assert report['memory_tier_max_bytes'] == wq_app.memory_cache_max_bytes
+
+
+def test_boot_profile_is_hidden_by_default(wq_app, monkeypatch):
+    client = wq_app.server.test_client()
+    assert client.get('/debug/boot-profile').status_code == 404
+
+    monkeypatch.setattr(wq_app, 'debug_routes', True)
+    profile = client.get('/debug/boot-profile').get_json()
+    assert profile['total_ms'] > 0 and profile['steps']
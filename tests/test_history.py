@@ -0,0 +1,23 @@
+# Reading the history while a compaction is part way through.
+
+import os
+
+import pandas as pd
+
+
+def test_history_rows_are_read_once_mid_compaction(wq_app, tmp_path, monkeypatch):
+    import history
+    monkeypatch.setattr(history, 'history_root', str(tmp_path))
+    state = 'New Hampshire'
+    for i, version in enumerate(['20240101000000', '20240201000000', '20240301000000']):
+        history.append_snapshot(state, version, pd.DataFrame({'County': ['Belknap'], 'Actual (mi)': [10.0 + i]}))
+
+    # history.arrow is in place but the parts folded into it are not removed yet.
+    part_files = history.get_part_files(state)
+    df_history, ranges = history.load_history(state)
+    history.write_table(df_history, history.get_compacted_file(state))
+    assert list(history.get_history(state, 'Actual (mi)', 'Belknap')) == [10.0, 11.0, 12.0]
+
+    for path in part_files:
+        os.remove(path)
+    assert list(history.get_history(state, 'Actual (mi)', 'Belknap')) == [10.0, 11.0, 12.0]
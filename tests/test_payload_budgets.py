@@ -0,0 +1,331 @@
+# Payload and latency budgets of every server-side callback.
+#
+# A scripted session browses the fixture state through /_dash-update-component the way the browser would: each step
+# sets one property, and every server callback with that property as an Input runs, its outputs feeding the next
+# callbacks in turn. Background callbacks are polled to completion. For each output id the largest request body,
+# response value, stored value (dcc.Store outputs only, after applying patches) and wall time seen are compared with
+# budgets derived from the baselines in tests/payload_budgets.json. Clientside callbacks never reach the server, so
+# they are not measured; the one refresh_changed_data reads is stood in for by get_view_locations.
+#
+# Each session's times are recorded with calibration_ms, the time the recording machine took over a fixed workload,
+# and scaled by how much slower or faster the machine checking them runs the same workload.
+#
+# A second session browses a published build and polls refresh_changed_data after a refresh changed one county.
+#
+#     python -m pytest tests                      # check against the budgets
+#     python -m pytest tests --update-budgets     # re-record the baselines after an intended change
+
+import gc
+import json
+import math
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import create_fixture_workbook
+
+budgets_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'payload_budgets.json')
+metrics = ['request_bytes', 'response_bytes', 'store_bytes', 'ms']
+background_poll_seconds = 0.05
+background_timeout_seconds = 120
+
+# (component id, property, value) set one after another, covering every server callback. evict_town_views stands
+# for a town clicked before prefetch_town_views got to it.
+evict_town_views = ('frame_cache', 'town_views', None)
+session_steps = [
+    ('state_dropdown', 'value', 'New Hampshire'),
+    ('percent_field', 'value', 'Actual Pct'),
+    ('county_dropdown', 'value', 'Belknap'),
+    ('town_dropdown', 'value', 'Meredith'),
+    evict_town_views,
+    ('town_dropdown', 'value', 'Gilford'),
+    ('plan_budget', 'value', 25),
+    ('plan_budget', 'value', None),
+    ('plan_goal', 'value', 50),
+    ('town_search', 'search_value', 'mer'),
+    ('data_version_interval', 'n_intervals', 1),
+    ('town_dropdown', 'value', None),
+    ('county_dropdown', 'value', None),
+]
+
+# The session over a published build; refresh_steps run after a refresh changed refresh_county's numbers.
+refresh_county = 'Carroll'
+refresh_session_steps = [
+    ('state_dropdown', 'value', 'New Hampshire'),
+    ('county_dropdown', 'value', refresh_county),
+]
+refresh_steps = [
+    ('data_version_interval', 'n_intervals', 1),
+    ('county_dropdown', 'value', None),
+    ('data_version_interval', 'n_intervals', 2),
+]
+
+
+def get_json_size(value):
+    return len(json.dumps(value, separators=(',', ':')).encode('utf-8'))
+
+
+def get_layout_values(layout, values=None):
+    # Every 'id.prop' value of the serialized layout the page loads from /_dash-layout.
+    values = {} if values is None else values
+    if isinstance(layout, list):
+        for item in layout:
+            get_layout_values(item, values)
+    elif isinstance(layout, dict) and 'props' in layout and 'type' in layout:
+        component_id = layout['props'].get('id')
+        for prop, value in layout['props'].items():
+            if isinstance(component_id, str):
+                values[component_id + '.' + prop] = value
+            get_layout_values(value, values)
+    return values
+
+
+def get_outputs(output):
+    # 'a.b' or '..a.b...c.d@hash..' -> [('a', 'b'), ('c', 'd@hash')]
+    return [tuple(part.split('.', 1)) for part in output.strip('.').split('...')]
+
+
+def apply_patch(value, patch):
+    # The Assign, Append, Delete and Add operations the app's patches use, applied the way dash-renderer applies them.
+    for operation in patch['operations']:
+        target = value
+        location = operation['location']
+        if operation['operation'] == 'Add' and not location:
+            value = value + operation['params']['value']
+            continue
+        for key in location[:-1]:
+            target = target[key]
+        if operation['operation'] == 'Assign':
+            if isinstance(target, list) and location[-1] == len(target):
+                target.append(operation['params']['value'])
+            else:
+                target[location[-1]] = operation['params']['value']
+        elif operation['operation'] == 'Append':
+            target[location[-1]].append(operation['params']['value'])
+        elif operation['operation'] == 'Delete':
+            del target[location[-1]]
+    return value
+
+
+class Session:
+    def __init__(self, client, dependencies, values):
+        self.client = client
+        self.dependencies = [dependency for dependency in dependencies if not dependency.get('clientside_function')]
+        self.values = values
+        self.measurements = {}
+        self.called = set()
+
+    def set(self, component_id, prop, value):
+        self.values[component_id + '.' + prop] = value
+        self.propagate([component_id + '.' + prop])
+
+    def propagate(self, changed):
+        # Each callback runs at most once per step, which is enough to settle this app's chains.
+        called = set()
+        while changed:
+            prop_id = changed.pop(0)
+            for dependency in self.dependencies:
+                inputs = [item['id'] + '.' + item['property'] for item in dependency['inputs']]
+                if prop_id not in inputs or dependency['output'] in called:
+                    continue
+                called.add(dependency['output'])
+                changed += self.call(dependency, prop_id)
+
+    def get_items(self, items):
+        return [{'id': item['id'], 'property': item['property'],
+                 'value': self.values.get(item['id'] + '.' + item['property'])} for item in items]
+
+    def call(self, dependency, prop_id):
+        outputs = get_outputs(dependency['output'])
+        body = {'output': dependency['output'],
+                'outputs': [{'id': component_id, 'property': prop.split('@')[0]} for component_id, prop in outputs],
+                'inputs': self.get_items(dependency['inputs']),
+                'state': self.get_items(dependency['state']),
+                'changedPropIds': [prop_id]}
+        # A multi-output callback ('..a.b..') takes a list even when it has one output.
+        if not dependency['output'].startswith('..'):
+            body['outputs'] = body['outputs'][0]
+        request_bytes = get_json_size(body)
+
+        # A collection left over from an earlier step, such as a precompute run, is not this callback's time.
+        gc.collect()
+        start = time.perf_counter()
+        response = self.client.post('/_dash-update-component', json=body)
+        if dependency.get('long') and response.status_code == 200 and 'cacheKey' in response.get_json():
+            job = response.get_json()
+            while 'response' not in job:
+                assert time.perf_counter() - start < background_timeout_seconds, \
+                    'background callback ' + dependency['output'] + ' did not finish'
+                time.sleep(background_poll_seconds)
+                response = self.client.post('/_dash-update-component?cacheKey=' + job['cacheKey'] + '&job=' +
+                                            str(job['job']), json=body)
+                if response.status_code == 204:
+                    break
+                job = dict(job, **response.get_json())
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self.called.add(dependency['output'])
+
+        assert response.status_code in (200, 204), dependency['output'] + ' failed: ' + str(response.status_code)
+        if response.status_code == 204:
+            return []
+
+        changed = []
+        for component_id, props in response.get_json().get('response', {}).items():
+            for prop, value in props.items():
+                output_id = component_id + '.' + prop
+                is_patch = isinstance(value, dict) and value.get('__dash_patch_update')
+                if is_patch and output_id in self.values:
+                    self.values[output_id] = apply_patch(self.values[output_id], value)
+                elif not is_patch:
+                    self.values[output_id] = value
+                changed.append(output_id)
+                # A store's modified_timestamp changes with its data, and callbacks can listen for either.
+                if prop == 'data':
+                    self.values[component_id + '.modified_timestamp'] = int(time.time() * 1000)
+                    changed.append(component_id + '.modified_timestamp')
+
+                self.measure(output_id, {'request_bytes': request_bytes, 'response_bytes': get_json_size(value),
+                                         'store_bytes': get_json_size(self.values.get(output_id))
+                                         if prop == 'data' else 0,
+                                         'ms': elapsed_ms})
+        return changed
+
+    def measure(self, output_id, measured):
+        current = self.measurements.setdefault(output_id, dict.fromkeys(metrics, 0))
+        for metric in metrics:
+            current[metric] = max(current[metric], measured[metric])
+
+
+def calibrate():
+    # Best of five runs of a fixed pandas and JSON workload, in ms: how fast this machine is, for scaling times.
+    df = pd.DataFrame(np.random.default_rng(0).random((20000, 8)))
+    times = []
+    for i in range(5):
+        start = time.perf_counter()
+        json.dumps(df.to_dict('records'))
+        times.append((time.perf_counter() - start) * 1000)
+    return min(times)
+
+
+def get_budget(baseline, headroom, speed):
+    # Bytes get headroom rounded up to the next KiB. Time is the baseline scaled by speed (this machine's
+    # calibration over the recording one's), times the headroom, plus a few ms for timer and scheduler noise.
+    budget = {}
+    for metric in metrics:
+        if metric == 'ms':
+            budget[metric] = baseline[metric] * speed * headroom['ms'] + headroom['noise_ms']
+        else:
+            budget[metric] = math.ceil(baseline[metric] * headroom['bytes'] / 1024) * 1024
+    return budget
+
+
+def get_baseline(measured):
+    return {metric: round(value, 1) if metric == 'ms' else value for metric, value in measured.items()}
+
+
+def format_value(metric, value):
+    return '{:,.0f} ms'.format(value) if metric == 'ms' else '{:,} B'.format(int(value))
+
+
+def create_report(measurements, baselines, headroom, speed):
+    lines = ['{:<40} {:<15} {:>14} {:>14} {:>8}  {}'.format('output', 'metric', 'measured', 'budget', 'change', '')]
+    failures = []
+    budgets = {output_id: get_budget(baseline, headroom, speed) for output_id, baseline in baselines.items()}
+    for output_id in sorted(set(measurements) | set(budgets)):
+        if output_id not in budgets:
+            failures.append(output_id + ': no budget; record one with --update-budgets')
+            continue
+        if output_id not in measurements:
+            failures.append(output_id + ': has a budget but was not produced; re-record with --update-budgets')
+            continue
+        for metric in metrics:
+            measured = measurements[output_id][metric]
+            budget = budgets[output_id][metric]
+            if not measured and not budget:
+                continue
+            change = '{:+.0%}'.format(measured / budget - 1) if budget else 'new'
+            status = 'OVER' if measured > budget else ''
+            lines.append('{:<40} {:<15} {:>14} {:>14} {:>8}  {}'.format(
+                output_id, metric, format_value(metric, measured), format_value(metric, budget), change, status))
+            if status:
+                failures.append(output_id + ' ' + metric + ': ' + format_value(metric, measured) + ' over budget of ' +
+                                format_value(metric, budget))
+    return '\n'.join(lines), failures
+
+
+def get_view_locations(values):
+    # What the view_locations_store clientside callback derives from the stores it watches.
+    def get_locations(figure):
+        return [str(location) for location in figure['data'][0]['locations']] if figure and figure.get('data') \
+            else None
+    state_table = values.get('state_table_store.data')
+    return {'state_map': get_locations(values.get('state_map_store.data')),
+            'county_map': get_locations(values.get('county_map_cache.data')),
+            'state_table': [str(row['County']) for row in state_table['props']['data']] if state_table else None}
+
+
+def check_budgets(request, measurements, budget_section):
+    # Compares with the baselines under budget_section, or records them with --update-budgets.
+    with open(budgets_file) as f:
+        budget_data = json.load(f)
+
+    if request.config.getoption('--update-budgets'):
+        budget_data[budget_section] = {'calibration_ms': round(calibrate(), 2),
+                                       'baselines': {output_id: get_baseline(measured)
+                                                     for output_id, measured in sorted(measurements.items())}}
+        with open(budgets_file, 'w') as f:
+            json.dump(budget_data, f, indent=1)
+            f.write('\n')
+        pytest.skip('baselines re-recorded in ' + budgets_file)
+
+    section = budget_data[budget_section]
+    speed = calibrate() / section['calibration_ms']
+    report, failures = create_report(measurements, section['baselines'], budget_data['headroom'], speed)
+    print('\nTimes scaled by {:.2f} for this machine\n'.format(speed) + report)
+    return report, failures
+
+
+def test_payload_budgets(wq_app, request):
+    client = wq_app.server.test_client()
+    assert client.get('/').status_code == 200
+    session = Session(client, client.get('/_dash-dependencies').get_json(),
+                      get_layout_values(client.get('/_dash-layout').get_json()))
+
+    for step in session_steps:
+        if step == evict_town_views:
+            for key in list(wq_app.frame_cache.iterkeys()):
+                if key[0] == 'town_views':
+                    wq_app.frame_cache.delete(key)
+        else:
+            session.set(*step)
+
+    report, failures = check_budgets(request, session.measurements, 'session')
+    not_called = [dependency['output'] for dependency in session.dependencies if dependency['output'] not in
+                  session.called]
+    failures += ['callback ' + output + ' never ran; add a step for it to session_steps' for output in not_called]
+    assert not failures, '\n' + '\n'.join(failures) + '\n\n' + report
+
+
+def test_refresh_payload_budgets(wq_app, precompute, request):
+    precompute('--state', 'New Hampshire')
+    client = wq_app.server.test_client()
+    session = Session(client, client.get('/_dash-dependencies').get_json(),
+                      get_layout_values(client.get('/_dash-layout').get_json()))
+    for component_id, prop, value in refresh_session_steps:
+        session.set(component_id, prop, value)
+    session.measurements = {}
+
+    precompute('--state', 'New Hampshire', '--refresh', workbook=create_fixture_workbook(refresh_county))
+    for component_id, prop, value in refresh_steps:
+        session.values['view_locations_store.data'] = get_view_locations(session.values)
+        session.set(component_id, prop, value)
+
+    # The refresh reached both views: the county's towns, then the state's table.
+    assert session.values['data_version_store.data'] == wq_app.get_state_data_versions('New Hampshire')
+    assert ';' in session.values['county_data_store.data'] and ';' in session.values['summary_data_store.data']
+
+    report, failures = check_budgets(request, session.measurements, 'refresh_session')
+    assert not failures, '\n' + '\n'.join(failures) + '\n\n' + report
@@ -0,0 +1,127 @@
+# Publishing builds with precompute.py, in full, for some states and as refreshes.
+
+import pytest
+
+from conftest import create_fixture_workbook
+
+state = 'New Hampshire'
+
+
+def test_state_build_keeps_other_states(precompute):
+    precompute('--state', state)
+    manifest = precompute('--state', 'New England')
+
+    assert 'county/New Hampshire/Belknap/map' in manifest['artifacts']
+    assert 'state/New Hampshire' in manifest['data_versions']
+    assert manifest['data_versions']['state/New England'] == manifest['version']
+    assert manifest['data_versions']['state/New Hampshire'] != manifest['version']
+
+
+def test_state_towns_cover_every_county(wq_app, precompute):
+    manifest = precompute('--state', state)
+    df_towns = wq_app.decode_data_store(wq_app.read_artifact('state', state, 'towns')['towns_data'])
+    county_towns = [wq_app.decode_data_store(wq_app.read_artifact(*name.split('/'))['county_data'])
+                    for name in manifest['artifacts'] if name.startswith('county/' + state) and name.endswith('/data')]
+    assert len(df_towns) == sum(len(df) for df in county_towns)
+    assert wq_app.load_state_towns(state, None).equals(df_towns)
+
+
+def test_refresh_retries_failed_counties(precompute):
+    first = precompute('--state', state)
+    # Carroll's numbers change, but its build fails: the summary moves on without it.
+    failed = precompute('--state', state, '--refresh', workbook=create_fixture_workbook('Carroll'),
+                        failing_county='Carroll')
+    assert failed['failed_counties'] == [[state, 'Carroll']]
+    assert failed['data_versions']['state/New Hampshire'] == failed['version']
+    assert failed['data_versions']['county/New Hampshire/Carroll'] == first['version']
+
+    # Nothing changes in the workbook since, yet the next refresh still rebuilds Carroll, and only Carroll.
+    retried = precompute('--state', state, '--refresh', workbook=create_fixture_workbook('Carroll'))
+    assert retried['failed_counties'] == []
+    assert retried['data_versions']['county/New Hampshire/Carroll'] == retried['version']
+    assert retried['data_versions']['county/New Hampshire/Belknap'] == first['version']
+    assert retried['data_versions']['state/New Hampshire'] == failed['version']
+
+
+def refresh_changed_data(client, data_versions, view_locations, selected_county=None):
+    # One poll of refresh_changed_data through the callback endpoint, returning its response by output id.
+    dependency = next(dependency for dependency in client.get('/_dash-dependencies').get_json()
+                      if dependency['inputs'][0]['id'] == 'data_version_interval')
+    values = {'data_version_store': data_versions, 'view_locations_store': view_locations, 'state_dropdown': state,
+              'county_dropdown': selected_county, 'town_dropdown': None, 'percent_field': 'Pct Towns Cycled'}
+    body = {'output': dependency['output'],
+            'outputs': [{'id': item.split('.')[0], 'property': item.split('.')[1].split('@')[0]}
+                        for item in dependency['output'].strip('.').split('...')],
+            'inputs': [dict(dependency['inputs'][0], value=1)],
+            'state': [dict(item, value=values[item['id']]) for item in dependency['state']],
+            'changedPropIds': ['data_version_interval.n_intervals']}
+    response = client.post('/_dash-update-component', json=body)
+    if response.status_code == 204:
+        return None
+    assert response.status_code == 200
+    return {component_id + '.' + prop: value for component_id, props in response.get_json()['response'].items()
+            for prop, value in props.items()}
+
+
+def get_view_locations(wq_app):
+    state_artifact = wq_app.read_artifact('state', state, 'summary')
+    return {'state_map': wq_app.get_figure_locations(wq_app.read_artifact('state', state, 'map', 'Pct Towns Cycled')),
+            'state_table': [row['County'] for row in state_artifact['state_table']['props']['data']],
+            'county_map': wq_app.get_figure_locations(wq_app.read_artifact('county', state, 'Carroll', 'map'))}
+
+
+def test_refresh_sends_changed_rows(wq_app, precompute):
+    precompute('--state', state)
+    client = wq_app.server.test_client()
+    data_versions = wq_app.get_state_data_versions(state)
+    view_locations = get_view_locations(wq_app)
+    summary_data = wq_app.read_artifact('state', state, 'summary')['summary_data']
+    county_data = wq_app.read_artifact('county', state, 'Carroll', 'data')['county_data']
+    precompute('--state', state, '--refresh', workbook=create_fixture_workbook('Carroll'))
+
+    # The Carroll county view gets its one changed town, and the summary its one changed county.
+    response = refresh_changed_data(client, data_versions, view_locations, 'Carroll')
+    for store, data in (('summary_data_store.data', summary_data), ('county_data_store.data', county_data)):
+        [operation] = response[store]['operations']
+        assert operation['operation'] == 'Add' and operation['location'] == []
+        assert len(wq_app.decode_data_store(operation['params']['value'][1:])) == 1
+        df_previous = wq_app.decode_data_store(data)
+        df = wq_app.decode_data_store(data + operation['params']['value'])
+        assert len(df) == len(df_previous)
+        assert df['Actual (mi)'].sum() == pytest.approx(df_previous['Actual (mi)'].sum() + 1)
+    assert response['county_map_cache.data']['__dash_patch_update']
+    assert response['data_version_store.data']['counties']['Carroll'] != data_versions['counties']['Carroll']
+    assert response['data_version_store.data']['state'] == data_versions['state']
+
+    # The state view is patched in place, unless its counties are no longer where the browser has them.
+    response = refresh_changed_data(client, data_versions, view_locations)
+    assert response['state_map_store.data']['__dash_patch_update']
+    assert [operation['location'] for operation in response['state_table_store.data']['operations']] == \
+        [['props', 'data', view_locations['state_table'].index('Carroll')]]
+
+    view_locations['state_map'] = view_locations['state_map'][::-1]
+    view_locations['state_table'] = view_locations['state_table'][1:]
+    response = refresh_changed_data(client, data_versions, view_locations)
+    assert response['state_map_store.data']['data'][0]['locations']
+    assert response['state_table_store.data']['props']['data']
+
+
+def test_refresh_appends_summary_once(wq_app, precompute):
+    precompute('--state', state)
+    client = wq_app.server.test_client()
+    data_versions = wq_app.get_state_data_versions(state)
+    view_locations = get_view_locations(wq_app)
+    precompute('--state', state, '--refresh', workbook=create_fixture_workbook('Carroll'))
+
+    # A county view other than the changed one takes the summary rows, and nothing more on the next poll.
+    response = refresh_changed_data(client, data_versions, view_locations, 'Belknap')
+    assert response['summary_data_store.data']['operations']
+    assert 'county_data_store.data' not in response
+    applied_versions = response['data_version_store.data']
+    assert applied_versions['state'] == data_versions['state']
+    assert refresh_changed_data(client, applied_versions, view_locations, 'Belknap') is None
+
+    # The state view still gets its map and table, without the summary rows again.
+    response = refresh_changed_data(client, applied_versions, view_locations)
+    assert 'summary_data_store.data' not in response
+    assert response['state_map_store.data']['__dash_patch_update']
@@ -0,0 +1,46 @@
+# Counting ride miles per town from GPS tracks.
+
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def get_counted_cells(rides, points):
+    lat, lon, miles = rides.get_track_segments(points)
+    cells, inverse = np.unique(rides.get_cell_keys(lat, lon), return_inverse=True)
+    return cells, np.minimum(np.bincount(inverse, weights=miles), rides.cell_max_miles)
+
+
+def test_sparse_and_dense_tracks_cover_the_same_cells(wq_app):
+    import rides
+
+    # ~100 m north along a meridian: one smart-recording hop, then the same road at 1 Hz (~5 m a fix).
+    sparse = np.array([[43.6000, -71.5000], [43.6009, -71.5000]])
+    dense = np.column_stack([np.linspace(43.6000, 43.6009, 20), np.full(20, -71.5000)])
+    sparse_cells, sparse_miles = get_counted_cells(rides, sparse)
+    dense_cells, dense_miles = get_counted_cells(rides, dense)
+
+    assert set(sparse_cells) == set(dense_cells)
+    assert np.isclose(sparse_miles.sum(), 0.0621, atol=0.002)
+    assert np.isclose(sparse_miles.sum(), dense_miles.sum(), rtol=0.02)
+    # A later ride over the same road adds nothing.
+    assert rides.is_covered(dense_cells, np.sort(sparse_cells)).all()
+
+
+def test_write_coverage_keeps_workbook_miles_of_unridden_towns(wq_app):
+    import rides
+
+    os.makedirs(wq_app.ride_coverage_dir, exist_ok=True)
+    df_towns = pd.DataFrame({'County': ['Belknap', 'Belknap'], 'Town': ['Meredith', 'Alton'], '25 Pct': [5.0, 6.0],
+                             'Actual (mi)': [3.0, 4.0]})
+    progress = {'files': {}, 'cells': np.empty(0, np.int64), 'miles': {('Belknap', 'Meredith'): 7.5}}
+    try:
+        df_coverage = rides.write_coverage('Fixture', progress, df_towns)
+        assert df_coverage['Actual (mi)'].tolist() == [7.5, 4.0]
+        assert pd.read_feather(wq_app.get_ride_coverage_file('Fixture'))['Actual (mi)'].tolist() == [7.5, 4.0]
+
+        df_coverage = rides.write_coverage('Fixture', dict(progress, miles={}), df_towns)
+        assert df_coverage['Actual (mi)'].tolist() == [3.0, 4.0]
+    finally:
+        os.remove(wq_app.get_ride_coverage_file('Fixture'))
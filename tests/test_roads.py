@@ -0,0 +1,40 @@
+# Reading rideable ways from an OpenStreetMap XML extract.
+
+import numpy as np
+import shapely
+
+extract = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+ <node id="1" lat="43.60" lon="-71.50"/>
+ <node id="2" lat="43.61" lon="-71.50"/>
+ <node id="3" lat="43.61" lon="-71.49"/>
+ <way id="10"><nd ref="1"/><nd ref="2"/><tag k="highway" v="residential"/></way>
+ <way id="11"><nd ref="2"/><nd ref="99"/><tag k="highway" v="residential"/></way>
+ <way id="12"><nd ref="3"/><tag k="highway" v="residential"/></way>
+ <way id="13"><nd ref="2"/><nd ref="3"/><tag k="highway" v="tertiary"/></way>
+ <way id="14"><nd ref="1"/><nd ref="3"/><tag k="highway" v="motorway"/></way>
+</osm>
+"""
+
+
+def test_read_xml_ways_drops_incomplete_ways(wq_app, tmp_path):
+    import roads
+
+    extract_file = tmp_path / 'clipped.osm'
+    extract_file.write_text(extract)
+    lines = roads.read_xml_ways(str(extract_file))
+
+    # Way 11 references a node outside the extract and way 12 has one node; 14 is not rideable.
+    assert len(lines) == 2
+    assert [shapely.get_coordinates(line).tolist() for line in lines] == [[[-71.50, 43.60], [-71.50, 43.61]],
+                                                                          [[-71.50, 43.61], [-71.49, 43.61]]]
+    assert np.allclose(roads.get_miles(lines), [0.6905, 0.5], atol=0.01)
+
+
+def test_get_miles_splits_multipart_lines(wq_app):
+    import roads
+
+    north = shapely.linestrings([[-71.5, 43.60], [-71.5, 43.61]])
+    east = shapely.linestrings([[-71.5, 43.61], [-71.49, 43.61]])
+    apart = shapely.multilinestrings([north, shapely.linestrings([[-71.4, 43.7], [-71.4, 43.71]])])
+    assert np.allclose(roads.get_miles(np.array([north, east, apart])), [0.6905, 0.5, 1.381], atol=0.001)
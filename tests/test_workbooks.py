@@ -0,0 +1,20 @@
+# Picking a sheet's columns by header name.
+
+import io
+
+import pandas as pd
+import pytest
+
+
+def test_repeated_wanted_header_is_refused(wq_app):
+    import workbooks
+    data = io.BytesIO()
+    pd.DataFrame([['Belknap', 1.0, 2.0, 3.0]], columns=['County', 'Actual (mi)', 'Notes', 'Actual (mi) ']).to_excel(
+        data, index=False)
+    columns = (['County', 'Actual (mi)'], ['County'])
+    with pytest.raises(ValueError, match='more than one column Actual'):
+        workbooks.read_sheet(data.getvalue(), columns=columns, backend='openpyxl')
+
+    # A repeated header that is not wanted is no reason to refuse the sheet.
+    assert list(workbooks.read_sheet(data.getvalue(), columns=(['County', 'Notes'], ['County']),
+                                     backend='openpyxl').columns) == ['County', 'Notes']